@@ -2,6 +2,7 @@
 ASGI config for DRF_Chat project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+HTTP goes to Django, WebSocket connections to the chat push channel.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
@@ -13,4 +14,12 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'DRF_Chat.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from chat.consumers import websocket_application  # noqa: E402 (needs the apps to be loaded)
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'websocket':
+        return await websocket_application(scope, receive, send)
+    return await django_application(scope, receive, send)
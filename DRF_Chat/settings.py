@@ -9,7 +9,9 @@ https://docs.djangoproject.com/en/4.2/topics/settings/
 For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
+import os
 from datetime import timedelta
+from importlib.util import find_spec
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -43,6 +45,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'chat.metrics.MetricsMiddleware',
+    'chat.routers.ReplicaRoutingMiddleware',
+    'chat.compression.CompressionMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -73,6 +78,8 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'DRF_Chat.wsgi.application'
 
+ASGI_APPLICATION = 'DRF_Chat.asgi.application'
+
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
@@ -80,9 +87,59 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Keep connections (and their pragmas, see CHAT_SQLITE) between requests
+        'CONN_MAX_AGE': 600,
+        'CONN_HEALTH_CHECKS': True,
+        'TEST': {
+            # A file instead of the in-memory default so WAL and concurrent connections behave as in production
+            'NAME': BASE_DIR / 'test_db.sqlite3',
+        },
     }
 }
 
+# Read replicas (chat.routers): every alias but `default` serves reads. To try it
+# locally with SQLite copies: CHAT_SQLITE_REPLICAS=replica1.sqlite3,replica2.sqlite3
+for index, name in enumerate(filter(None, os.environ.get('CHAT_SQLITE_REPLICAS', '').split(','))):
+    DATABASES[f'replica{index + 1}'] = {
+        **DATABASES['default'],
+        'NAME': BASE_DIR / name,
+        'TEST': {'MIRROR': 'default'},
+    }
+
+DATABASE_ROUTERS = ['chat.routers.ReplicaRouter']
+
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'chat': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'chat',
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    },
+    # Shared by all the worker processes (token revocations, replica stickiness,
+    # send throttling with Redis): a table of the database (created by
+    # `manage.py migrate`), or Redis with CHAT_REDIS_URL=redis://host:6379/0
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'chat_shared_cache',
+        'OPTIONS': {
+            'MAX_ENTRIES': 100000,
+        },
+    },
+}
+
+if os.environ.get('CHAT_REDIS_URL'):
+    CACHES['shared'] = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.environ['CHAT_REDIS_URL'],
+    }
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -126,14 +183,21 @@ REST_FRAMEWORK = {
     # Use Django's standard `django.contrib.auth` permissions,
     # or allow read-only access for unauthenticated users.
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'chat.authentication.StatelessJWTAuthentication',
     ),
+    # Compact formats selected with Accept (chat.renderers), MessagePack only with the msgpack package
+    'DEFAULT_RENDERER_CLASSES': [
+        'rest_framework.renderers.JSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+        'chat.renderers.ColumnarJSONRenderer',
+    ] + (['chat.renderers.MessagePackRenderer'] if find_spec('msgpack') else []),
 
         "DEFAULT_PAGINATION_CLASS": "rest_framework.pagination.LimitOffsetPagination",
         "PAGE_SIZE": 3,
 }
 
 SIMPLE_JWT = {
+    # Also how long a user deactivated with QuerySet.update() keeps access (see chat.authentication)
     "ACCESS_TOKEN_LIFETIME": timedelta(minutes=60),
     "REFRESH_TOKEN_LIFETIME": timedelta(days=1),
     "ROTATE_REFRESH_TOKENS": False,
@@ -165,10 +229,149 @@ SIMPLE_JWT = {
     "SLIDING_TOKEN_LIFETIME": timedelta(minutes=5),
     "SLIDING_TOKEN_REFRESH_LIFETIME": timedelta(days=1),
 
-    "TOKEN_OBTAIN_SERIALIZER": "rest_framework_simplejwt.serializers.TokenObtainPairSerializer",
-    "TOKEN_REFRESH_SERIALIZER": "rest_framework_simplejwt.serializers.TokenRefreshSerializer",
+    "TOKEN_OBTAIN_SERIALIZER": "chat.serializers.TokenObtainPairSerializer",
+    "TOKEN_REFRESH_SERIALIZER": "chat.serializers.TokenRefreshSerializer",
     "TOKEN_VERIFY_SERIALIZER": "rest_framework_simplejwt.serializers.TokenVerifySerializer",
     "TOKEN_BLACKLIST_SERIALIZER": "rest_framework_simplejwt.serializers.TokenBlacklistSerializer",
     "SLIDING_TOKEN_OBTAIN_SERIALIZER": "rest_framework_simplejwt.serializers.TokenObtainSlidingSerializer",
     "SLIDING_TOKEN_REFRESH_SERIALIZER": "rest_framework_simplejwt.serializers.TokenRefreshSlidingSerializer",
 }
+
+# Chat
+# Real-time delivery over WebSocket (served by DRF_Chat/asgi.py). A broker for
+# multi-node fanout subclasses chat.broker.BaseBroker and overrides publish()
+
+CHAT_WEBSOCKET_PATH = '/ws/chat/'
+
+CHAT_BROKER = {
+    'BACKEND': 'chat.broker.InProcessBroker',
+    'OPTIONS': {
+        'queue_size': 100,
+    },
+}
+
+# Long polling fallback (chat.views.MessagesSinceView), timeouts in seconds
+CHAT_LONG_POLL = {
+    'TIMEOUT': 25,
+    'MAX_TIMEOUT': 60,
+    'LIMIT': 100,
+}
+
+# Cache of Thread lists, Message pages and Thread memberships (chat.cache), CACHE
+# is an alias of CACHES. Invalidations only reach the workers sharing CACHE: a
+# process-local cache (LocMemCache) keeps entries LOCAL_TIMEOUT seconds, TIMEOUT otherwise
+CHAT_CACHE = {
+    'ENABLED': True,
+    'CACHE': 'chat',
+    'TIMEOUT': 300,
+    'LOCAL_TIMEOUT': 5,
+}
+
+# Stateless JWT authentication (chat.authentication): revocations of deactivated
+# users live in CACHE (shared by the workers) and are read again every
+# REVOCATION_CACHE_TTL seconds, full User rows are cached per process for
+# USER_CACHE_TTL seconds; both per-process caches hold LOCAL_CACHE_SIZE users
+CHAT_AUTH = {
+    'CACHE': 'shared',
+    'USER_CACHE_TTL': 30,
+    'REVOCATION_CACHE_TTL': 5,
+    'LOCAL_CACHE_SIZE': 10000,
+}
+
+# Message search (chat.search): BACKEND None uses the FTS5 index on SQLite and
+# `icontains` on other databases
+CHAT_SEARCH = {
+    'BACKEND': None,
+    'PAGE_SIZE': 20,
+    'MAX_PAGE_SIZE': 100,
+    'SNIPPET_TOKENS': 12,
+}
+
+# Bulk Message import (chat.ingest): at most MAX_BATCH_SIZE Messages per request,
+# inserted CHUNK_SIZE at a time
+CHAT_INGEST = {
+    'MAX_BATCH_SIZE': 5000,
+    'CHUNK_SIZE': 500,
+}
+
+# Per-request metrics (chat.metrics): query count, DB/render/total time per view
+# at /api/metrics/ and in Server-Timing headers; PUBLIC skips the admin check
+CHAT_METRICS = {
+    'ENABLED': True,
+    'SERVER_TIMING': True,
+    'PUBLIC': False,
+}
+
+# SQLite profile (chat.sqlite): pragmas applied to every new connection and a
+# process-wide lock serializing the write transactions of the chat
+CHAT_SQLITE = {
+    'ENABLED': True,
+    'PRAGMAS': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 20000,
+        'cache_size': -20000,
+        'mmap_size': 268435456,
+        'temp_store': 'MEMORY',
+    },
+    'SERIALIZE_WRITES': True,
+    'WRITE_LOCK_TIMEOUT': 30,
+}
+
+# Read replica routing (chat.routers): REPLICAS None uses every DATABASES alias
+# but `default`; users read from the primary for STICKY_SECONDS after a write,
+# the pin lives in CACHE shared by the workers (any of them serves the next request)
+CHAT_REPLICAS = {
+    'REPLICAS': None,
+    'STICKY_SECONDS': 10,
+    'CACHE': 'shared',
+}
+
+# Side effects of writes (chat.outbox): stored in the transaction of the write,
+# then handled by WORKERS threads; MODE 'sync' handles them in the request
+CHAT_OUTBOX = {
+    'MODE': 'async',
+    'WORKERS': 2,
+    'QUEUE_SIZE': 1000,
+    'POLL_INTERVAL': 5,
+    'MAX_ATTEMPTS': 5,
+    'RETRY_DELAY': 1,
+}
+
+# Archive of old Thread history (chat.archive, `manage.py archive_messages`):
+# read Messages older than AGE_DAYS move out of the live table, BATCH_SIZE at a time
+CHAT_ARCHIVE = {
+    'AGE_DAYS': 180,
+    'BATCH_SIZE': 1000,
+}
+
+# Token bucket throttling of Message sends (chat.throttling), per user and per
+# Thread: RATE refills a bucket of BURST tokens; MODE 'queue' waits up to
+# MAX_DELAY seconds for a token instead of answering 429, holding the worker
+# thread (at most MAX_WAITING requests per process wait). LocalBucketStore keeps
+# the buckets in the process; with CHAT_REDIS_URL CacheBucketStore shares them
+# between the processes through `cache` (a LocMemCache is refused outside DEBUG)
+CHAT_THROTTLE = {
+    'ENABLED': True,
+    'STORE': 'chat.throttling.LocalBucketStore',
+    'OPTIONS': {},
+    'RATES': {
+        'user': {'RATE': '60/m', 'BURST': 20},
+        'thread': {'RATE': '120/m', 'BURST': 40},
+    },
+    'MODE': 'reject',
+    'MAX_DELAY': 2,
+    'MAX_WAITING': 4,
+}
+
+if os.environ.get('CHAT_REDIS_URL'):
+    CHAT_THROTTLE.update(STORE='chat.throttling.CacheBucketStore', OPTIONS={'cache': 'shared'})
+
+# Response compression (chat.compression): the first of ENCODINGS the client
+# accepts, for bodies of at least MIN_SIZE bytes; 'br' needs the brotli package
+CHAT_COMPRESSION = {
+    'ENABLED': True,
+    'MIN_SIZE': 1024,
+    'ENCODINGS': ('br', 'gzip'),
+    'BROTLI_QUALITY': 5,
+}
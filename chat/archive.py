@@ -0,0 +1,75 @@
+"""
+Archive of old Thread history
+
+archive_messages() moves Messages older than AGE_DAYS from the live table into
+ArchivedMessage in batches, so the live table and its indexes only hold recent
+history. In each Thread only the Messages older than its oldest unread Message
+are moved, and never its last_message: every archived Message of a Thread is
+older than all of its live Messages, so the history pages through the live
+table first and then falls through into the archive (MessageCursorPagination)
+Search (chat.search) covers the archive too, through its own FTS index
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+
+from chat import cache
+from chat.models import Thread, Message, ArchivedMessage
+from chat.sqlite import serialized_write
+
+DEFAULTS = {
+    'AGE_DAYS': 180,
+    'BATCH_SIZE': 1000,
+}
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_ARCHIVE', {})}
+
+
+def archivable(cutoff):
+    """
+    Messages created before cutoff that can move to the archive
+    """
+    unread_before = Message.objects.filter(thread=OuterRef('thread'), is_read=False).filter(
+        Q(created__lt=OuterRef('created')) | Q(created=OuterRef('created'), id__lte=OuterRef('id'))
+    )
+    return Message.objects.filter(created__lt=cutoff).exclude(
+        id__in=Thread.objects.filter(last_message__isnull=False).values('last_message_id')
+    ).exclude(Exists(unread_before))
+
+
+def archive_messages(cutoff=None, batch_size=None):
+    """
+    Move the archivable Messages created before cutoff (default: AGE_DAYS ago),
+    batch_size per transaction; returns the number of Messages moved
+    """
+    config = get_config()
+    if cutoff is None:
+        cutoff = timezone.now() - timedelta(days=config['AGE_DAYS'])
+    batch_size = batch_size or config['BATCH_SIZE']
+    columns = [field.attname for field in ArchivedMessage._meta.concrete_fields]
+    moved = 0
+    while True:
+        with serialized_write():
+            rows = list(archivable(cutoff).order_by('id').values(*columns)[:batch_size])
+            if not rows:
+                return moved
+            ArchivedMessage.objects.bulk_create([ArchivedMessage(**row) for row in rows])
+            Message.objects.filter(id__in=[row['id'] for row in rows]).delete()
+            for thread_id in {row['thread_id'] for row in rows}:
+                cache.invalidate_thread(thread_id)
+        moved += len(rows)
+
+
+def history(thread_ids, after=None):
+    """
+    Archived Messages of the given Threads (newer than the id after), for reads
+    that cover the whole history
+    """
+    messages = ArchivedMessage.objects.filter(thread_id__in=thread_ids)
+    if after is not None:
+        messages = messages.filter(id__gt=after)
+    return messages
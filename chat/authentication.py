@@ -0,0 +1,127 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTStatelessUserAuthentication
+from rest_framework_simplejwt.settings import api_settings
+
+DEFAULTS = {
+    'CACHE': 'default',
+    'USER_CACHE_TTL': 30,
+    # Seconds a process trusts what it read of a revocation in CACHE
+    'REVOCATION_CACHE_TTL': 5,
+    # Entries of each per-process cache, the oldest ones are dropped first
+    'LOCAL_CACHE_SIZE': 10000,
+}
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_AUTH', {})}
+
+
+def revocation_key(user_id):
+    return f'chat:revoked:{user_id}'
+
+
+def revoke_user(user_id):
+    """
+    Reject the still valid tokens of the user until they expire
+    """
+    lifetime = max(api_settings.ACCESS_TOKEN_LIFETIME, api_settings.REFRESH_TOKEN_LIFETIME)
+    timeout = int(lifetime.total_seconds())
+    caches[get_config()['CACHE']].set(revocation_key(user_id), True, timeout)
+    revocation_cache.invalidate(user_id)
+    user_cache.invalidate(user_id)
+
+
+def restore_user(user_id):
+    caches[get_config()['CACHE']].delete(revocation_key(user_id))
+    revocation_cache.invalidate(user_id)
+    user_cache.invalidate(user_id)
+
+
+def is_revoked(user_id):
+    return revocation_cache.get(user_id)
+
+
+class StatelessJWTAuthentication(JWTStatelessUserAuthentication):
+    """
+    JWT authentication trusting the signed claims: request.user is a TokenUser
+    built from the access token without loading the User row; users revoked
+    with revoke_user() (deactivated or deleted) are rejected. The other
+    processes see a revocation within REVOCATION_CACHE_TTL seconds
+
+    Revocations follow the User signals, which QuerySet.update() skips: such a
+    user keeps access until the access token expires, refreshing it fails
+    (TokenRefreshSerializer reads the User row)
+    """
+    def get_user(self, validated_token):
+        user = super().get_user(validated_token)
+        if is_revoked(user.id):
+            raise AuthenticationFailed('User is inactive', code='user_inactive')
+        return user
+
+
+class LocalCache:
+    """
+    Short-TTL per-process cache of load(key), bounded to LOCAL_CACHE_SIZE entries
+    """
+    ttl_setting = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = OrderedDict()
+
+    def load(self, key):
+        raise NotImplementedError
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            cached = self._values.get(key)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+        value = self.load(key)
+        config = get_config()
+        with self._lock:
+            self._values.pop(key, None)
+            while self._values and len(self._values) >= config['LOCAL_CACHE_SIZE']:
+                self._values.popitem(last=False)
+            self._values[key] = (now + config[self.ttl_setting], value)
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._values.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class UserCache(LocalCache):
+    """
+    User rows for the endpoints needing the full model, None for a missing user
+    """
+    ttl_setting = 'USER_CACHE_TTL'
+
+    def load(self, user_id):
+        return User.objects.filter(pk=user_id).first()
+
+
+class RevocationCache(LocalCache):
+    """
+    Revocations read from CACHE, so an authenticated request doesn't read the shared cache every time
+    """
+    ttl_setting = 'REVOCATION_CACHE_TTL'
+
+    def load(self, user_id):
+        return caches[get_config()['CACHE']].get(revocation_key(user_id), False)
+
+
+user_cache = UserCache()
+revocation_cache = RevocationCache()
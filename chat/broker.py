@@ -0,0 +1,118 @@
+import asyncio
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+DEFAULTS = {
+    'BACKEND': 'chat.broker.InProcessBroker',
+    'OPTIONS': {},
+}
+
+
+class Subscription:
+    """
+    Events published to one user, consumed by a single connection on its event loop
+    """
+    def __init__(self, user_id, queue_size=100):
+        self.user_id = user_id
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.dropped = 0
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # Slow consumer, the client has to resync over the REST API
+            self.dropped += 1
+
+    async def get(self):
+        return await self.queue.get()
+
+
+class BaseBroker:
+    """
+    Fan out events to the connections of users
+
+    `publish` may be called from any thread; backends for multi-node fanout
+    override it to ship the event to every node, each node then calls
+    `deliver` to hand it to its local subscriptions
+    """
+    def __init__(self, queue_size=100):
+        self.queue_size = queue_size
+        self._subscriptions = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def subscribe(self, user_id):
+        """
+        Register a Subscription of user_id, must be called from the event loop of the consumer
+        """
+        subscription = Subscription(user_id, self.queue_size)
+        with self._lock:
+            self._subscriptions[user_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.user_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.user_id]
+
+    def publish(self, user_ids, event):
+        raise NotImplementedError
+
+    def deliver(self, user_ids, event):
+        """
+        Hand the event to the Subscriptions of user_ids living in this process
+        """
+        with self._lock:
+            subscriptions = [sub for user_id in set(user_ids) for sub in self._subscriptions.get(user_id, ())]
+        for subscription in subscriptions:
+            subscription.loop.call_soon_threadsafe(subscription.put, event)
+        return len(subscriptions)
+
+
+class InProcessBroker(BaseBroker):
+    """
+    Broker for a single process, events never leave it
+    """
+    def publish(self, user_ids, event):
+        return self.deliver(user_ids, event)
+
+
+_broker = None
+
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        config = {**DEFAULTS, **getattr(settings, 'CHAT_BROKER', {})}
+        _broker = import_string(config['BACKEND'])(**config['OPTIONS'])
+    return _broker
+
+
+def _reset_broker(setting, **kwargs):
+    global _broker
+    if setting == 'CHAT_BROKER':
+        _broker = None
+
+
+setting_changed.connect(_reset_broker)
+
+
+def publish_to_thread(thread_id, event):
+    """
+    Publish the event to every participant of the Thread once the current transaction commits
+    """
+    def publish():
+        from chat.models import Thread
+        user_ids = Thread.participants.through.objects.filter(thread_id=thread_id).values_list('user_id', flat=True)
+        get_broker().publish(list(user_ids), event)
+
+    transaction.on_commit(publish)
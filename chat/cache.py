@@ -0,0 +1,131 @@
+import hashlib
+import threading
+import uuid
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+
+from chat.routers import use_primary
+
+DEFAULTS = {
+    'ENABLED': True,
+    'CACHE': 'default',
+    'TIMEOUT': 300,
+    # Used instead of TIMEOUT by a cache local to the process (LocMemCache)
+    'LOCAL_TIMEOUT': 5,
+}
+
+
+class CacheStats:
+    """
+    Hit/miss counters of the chat cache per namespace, local to the process
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(lambda: {'hits': 0, 'misses': 0})
+
+    def record(self, namespace, hit):
+        with self._lock:
+            self._counters[namespace]['hits' if hit else 'misses'] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                namespace: {**counters, 'hit_ratio': counters['hits'] / ((counters['hits'] + counters['misses']) or 1)}
+                for namespace, counters in self._counters.items()
+            }
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+
+
+stats = CacheStats()
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_CACHE', {})}
+
+
+def get_cache():
+    return caches[get_config()['CACHE']]
+
+
+def get_timeout():
+    """
+    Lifetime of the cached data: the invalidations of a worker never reach the
+    cache of another process, so a process-local cache keeps it LOCAL_TIMEOUT seconds
+    """
+    config = get_config()
+    return config['LOCAL_TIMEOUT'] if isinstance(get_cache(), LocMemCache) else config['TIMEOUT']
+
+
+def version_key(kind, object_id):
+    return f'chat:version:{kind}:{object_id}'
+
+
+def get_or_build(namespace, scope, params, build):
+    """
+    Return the cached result of build() for the given params
+
+    scope is a list of (kind, id) pairs, e.g. [('user', 1)] or [('thread', 5)];
+    invalidating any of them makes the cached result unreachable. Versions are
+    random tokens so an evicted version can never bring stale data back; build()
+    reads from the primary so a lagging replica never gets cached
+    """
+    config = get_config()
+    if not config['ENABLED']:
+        return build()
+    cache = get_cache()
+
+    keys = [version_key(kind, object_id) for kind, object_id in scope]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, uuid.uuid4().hex, None)
+            versions[key] = cache.get(key)
+    digest = hashlib.md5(repr(([versions[key] for key in keys], params)).encode()).hexdigest()
+    data_key = f'chat:{namespace}:{digest}'
+
+    data = cache.get(data_key)
+    stats.record(namespace, data is not None)
+    if data is None:
+        with use_primary():
+            data = build()
+        cache.set(data_key, data, get_timeout())
+    return data
+
+
+def invalidate(scope):
+    """
+    Invalidate every cached result depending on the given (kind, id) pairs, now
+    and again once the current transaction commits so a reader racing the
+    writer can't keep the old state cached
+    """
+    if not get_config()['ENABLED'] or not scope:
+        return
+    keys = [version_key(kind, object_id) for kind, object_id in scope]
+
+    def bump():
+        get_cache().set_many({key: uuid.uuid4().hex for key in keys}, None)
+
+    bump()
+    transaction.on_commit(bump)
+
+
+def invalidate_thread(thread_id, user_ids=None):
+    """
+    Invalidate the Message pages of the Thread and the Thread lists of its participants
+    """
+    if user_ids is None:
+        from chat.models import Thread
+        user_ids = Thread.participants.through.objects.filter(thread_id=thread_id).values_list('user_id', flat=True)
+    invalidate([('thread', thread_id)] + [('user', user_id) for user_id in user_ids])
+
+
+def clear():
+    get_cache().clear()
+    stats.reset()
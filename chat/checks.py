@@ -0,0 +1,18 @@
+from django.core.checks import Error, register
+from django.core.exceptions import ImproperlyConfigured
+
+from chat import throttling
+
+
+@register()
+def check_throttle_store(app_configs, **kwargs):
+    """
+    Refuse to start with a throttle store the worker processes would not share
+    """
+    if not throttling.get_config()['ENABLED']:
+        return []
+    try:
+        throttling.get_store()
+    except ImproperlyConfigured as exc:
+        return [Error(str(exc), hint="Point CHAT_THROTTLE['OPTIONS']['cache'] at a shared cache.", id='chat.E001')]
+    return []
@@ -0,0 +1,126 @@
+"""
+Response compression negotiated with Accept-Encoding
+
+Brotli (when the optional brotli package is installed) or gzip for bodies of
+at least MIN_SIZE bytes, smaller ones are not worth the CPU; streamed responses
+(exports) are gzipped on the fly. When CHAT_COMPRESSION['ENABLED'] is off the
+middleware removes itself from the stack (MiddlewareNotUsed)
+"""
+import re
+from importlib.util import find_spec
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.utils.cache import patch_vary_headers
+from django.utils.text import compress_sequence, compress_string
+
+if find_spec('brotli') is not None:
+    import brotli
+else:
+    brotli = None
+
+DEFAULTS = {
+    'ENABLED': True,
+    'MIN_SIZE': 1024,
+    # In order of preference, 'br' is skipped without the brotli package
+    'ENCODINGS': ('br', 'gzip'),
+    'BROTLI_QUALITY': 5,
+}
+
+ENCODING_RE = re.compile(r'^\s*([\w*-]+)\s*(?:;\s*q\s*=\s*([0-9.]+))?\s*$')
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_COMPRESSION', {})}
+
+
+def accepted_encodings(header):
+    """
+    Encodings of an Accept-Encoding header, without the ones refused with q=0
+    """
+    encodings = set()
+    for part in header.split(','):
+        match = ENCODING_RE.match(part)
+        if match is None:
+            continue
+        try:
+            quality = float(match.group(2) or 1)
+        except ValueError:
+            continue
+        if quality > 0:
+            encodings.add(match.group(1).lower())
+    return encodings
+
+
+class CompressionMiddleware:
+    """
+    Compress the responses with the preferred encoding the client accepts
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        config = get_config()
+        if not config['ENABLED']:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.min_size = config['MIN_SIZE']
+        self.encodings = [encoding for encoding in config['ENCODINGS'] if encoding != 'br' or brotli is not None]
+        self.brotli_quality = config['BROTLI_QUALITY']
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        return self.compress(request, self.get_response(request))
+
+    async def __acall__(self, request):
+        return self.compress(request, await self.get_response(request))
+
+    def choose(self, request, streaming):
+        accepted = accepted_encodings(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        for encoding in self.encodings:
+            if encoding in accepted and not (streaming and encoding == 'br'):
+                return encoding
+        return None
+
+    @staticmethod
+    async def acompress_sequence(sequence):
+        # One gzip member per chunk (as GZipMiddleware does), a gzip stream may hold several
+        async for chunk in sequence:
+            yield compress_string(chunk)
+
+    def compress(self, request, response):
+        if response.has_header('Content-Encoding'):
+            return response
+        if not response.streaming and len(response.content) < self.min_size:
+            return response
+        patch_vary_headers(response, ('Accept-Encoding',))
+        encoding = self.choose(request, response.streaming)
+        if encoding is None:
+            return response
+
+        if response.streaming:
+            if response.is_async:
+                response.streaming_content = self.acompress_sequence(response.streaming_content)
+            else:
+                response.streaming_content = compress_sequence(response.streaming_content)
+            del response.headers['Content-Length']
+        else:
+            if encoding == 'br':
+                content = brotli.compress(response.content, quality=self.brotli_quality)
+            else:
+                content = compress_string(response.content)
+            if len(content) >= len(response.content):
+                return response
+            response.content = content
+            response.headers['Content-Length'] = str(len(content))
+        # The compressed body is no longer byte for byte the one the ETag was computed for
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response.headers['ETag'] = 'W/' + etag
+        response.headers['Content-Encoding'] = encoding
+        return response
@@ -0,0 +1,102 @@
+import asyncio
+import json
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import TokenError, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+
+from chat.broker import get_broker
+
+CLOSE_UNAUTHORIZED = 4401
+CLOSE_NOT_FOUND = 4404
+
+
+def get_raw_token(scope):
+    """
+    Access token from the `token` query parameter (browsers can't set headers on
+    a WebSocket) or from the usual Authorization header
+    """
+    query = parse_qs(scope.get('query_string', b'').decode())
+    if query.get('token'):
+        return query['token'][0].encode()
+    authentication = JWTAuthentication()
+    for name, value in scope.get('headers', ()):
+        if name == b'authorization':
+            return authentication.get_raw_token(value)
+    return None
+
+
+@sync_to_async
+def get_active_user_id(user_id):
+    return User.objects.filter(pk=user_id, is_active=True).values_list('id', flat=True).first()
+
+
+async def authenticate(scope):
+    """
+    Return the id of the user owning the access token of the connection, or None
+    """
+    raw_token = get_raw_token(scope)
+    if raw_token is None:
+        return None
+    try:
+        validated_token = JWTAuthentication().get_validated_token(raw_token)
+    except (InvalidToken, TokenError):
+        return None
+    return await get_active_user_id(validated_token[api_settings.USER_ID_CLAIM])
+
+
+def frame_type(text):
+    """
+    `type` of a client frame, None for a frame that is not a JSON object
+    """
+    try:
+        return json.loads(text).get('type')
+    except (ValueError, AttributeError):
+        return None
+
+
+async def websocket_application(scope, receive, send):
+    """
+    Push the events of all Threads of the authenticated user over a WebSocket
+
+    Server -> client: {"type": "message.created" | "message.read" | ..., "thread": <id>, ...}
+    Client -> server: {"type": "ping"} answered with {"type": "pong"}
+    """
+    event = await receive()
+    if event['type'] != 'websocket.connect':
+        return
+    if scope['path'] != getattr(settings, 'CHAT_WEBSOCKET_PATH', '/ws/chat/'):
+        await send({'type': 'websocket.close', 'code': CLOSE_NOT_FOUND})
+        return
+    user_id = await authenticate(scope)
+    if user_id is None:
+        await send({'type': 'websocket.close', 'code': CLOSE_UNAUTHORIZED})
+        return
+    await send({'type': 'websocket.accept'})
+
+    broker = get_broker()
+    subscription = broker.subscribe(user_id)
+    receiving = asyncio.ensure_future(receive())
+    publishing = asyncio.ensure_future(subscription.get())
+    try:
+        while True:
+            done, _ = await asyncio.wait({receiving, publishing}, return_when=asyncio.FIRST_COMPLETED)
+            if publishing in done:
+                await send({'type': 'websocket.send', 'text': json.dumps(publishing.result(), default=str)})
+                publishing = asyncio.ensure_future(subscription.get())
+            if receiving in done:
+                event = receiving.result()
+                if event['type'] == 'websocket.disconnect':
+                    break
+                # Malformed frames are ignored, they never close the connection
+                if event.get('text') and frame_type(event['text']) == 'ping':
+                    await send({'type': 'websocket.send', 'text': json.dumps({'type': 'pong'})})
+                receiving = asyncio.ensure_future(receive())
+    finally:
+        receiving.cancel()
+        publishing.cancel()
+        broker.unsubscribe(subscription)
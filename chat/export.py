@@ -0,0 +1,94 @@
+"""
+Streaming export of Thread history as NDJSON or CSV
+
+Messages are read in id order with a chunked database iterator and written out
+chunk by chunk, so memory stays constant whatever the size of the Thread; an
+export resumes after a given Message id and covers the archive (chat.archive) too
+Under ASGI the chunks go through aiter_chunks(): Django reads a sync iterator
+whole (sync_to_async(list)) before sending anything
+"""
+import csv
+import heapq
+import json
+from operator import itemgetter
+
+from asgiref.sync import sync_to_async
+
+from chat import archive
+from chat.models import Message
+from chat.read_serializers import MessageRowSerializer
+
+FORMATS = {
+    'ndjson': 'application/x-ndjson; charset=utf-8',
+    'csv': 'text/csv; charset=utf-8',
+}
+
+CHUNK_SIZE = 2000
+
+
+def iter_messages(thread_ids, after=None, chunk_size=CHUNK_SIZE):
+    """
+    Messages of the given Threads as API dicts (same shape as MessageSerializer),
+    oldest first, archived ones included
+    """
+    serializer = MessageRowSerializer()
+    messages = Message.objects.filter(thread_id__in=thread_ids)
+    if after is not None:
+        messages = messages.filter(id__gt=after)
+    rows = [
+        queryset.order_by('id').values(*serializer.columns).iterator(chunk_size=chunk_size)
+        for queryset in (archive.history(thread_ids, after), messages)
+    ]
+    return map(serializer.to_representation, heapq.merge(*rows, key=itemgetter('id')))
+
+
+class LineBuffer:
+    """
+    File-like object for csv.writer handing back the line it was given
+    """
+    def write(self, value):
+        return value
+
+
+def ndjson_lines(messages):
+    for message in messages:
+        yield json.dumps(message, ensure_ascii=False) + '\n'
+
+
+def csv_lines(messages):
+    writer = csv.writer(LineBuffer())
+    columns = [key for key, _, _ in MessageRowSerializer.fields]
+    yield writer.writerow(columns)
+    for message in messages:
+        yield writer.writerow([message[column] for column in columns])
+
+
+def stream(messages, format, chunk_size=CHUNK_SIZE):
+    """
+    Encode the messages in the given format, yielding strings of up to chunk_size lines
+    """
+    lines = ndjson_lines(messages) if format == 'ndjson' else csv_lines(messages)
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= chunk_size:
+            yield ''.join(chunk)
+            chunk = []
+    if chunk:
+        yield ''.join(chunk)
+
+
+async def aiter_chunks(chunks):
+    """
+    The chunks of stream() as an async iterator, each one read in the sync
+    thread where the database cursor of the export lives
+    """
+    next_chunk = sync_to_async(next)
+    try:
+        while True:
+            chunk = await next_chunk(chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+    finally:
+        await sync_to_async(chunks.close)()
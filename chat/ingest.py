@@ -0,0 +1,88 @@
+"""
+Bulk ingestion of Messages (migrations from other systems, traffic replay)
+
+The whole batch goes in with one transaction: Messages are inserted with
+bulk_create in chunks, then the touched Threads (updated, last_message) and
+their read states are brought up to date with one pass per batch instead of
+once per Message. The read states only get the counts of the batch added
+(read_state_deltas()), the rest of the history is not read again
+"""
+from collections import defaultdict
+
+from django.conf import settings
+from django.db.models import OuterRef, Subquery
+from django.utils import timezone
+
+from chat import cache
+from chat.models import Thread, Message, ThreadReadState
+from chat.sqlite import serialized_write
+
+DEFAULTS = {
+    'MAX_BATCH_SIZE': 5000,
+    'CHUNK_SIZE': 500,
+}
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_INGEST', {})}
+
+
+def memberships(thread_ids):
+    """
+    {(thread_id, user_id), ...} of the given Threads, loaded with one query
+    """
+    return set(
+        Thread.participants.through.objects.filter(thread_id__in=thread_ids).values_list('thread_id', 'user_id')
+    )
+
+
+def read_state_deltas(messages, participants):
+    """
+    {(thread_id, user_id): [unread, newest read id]} of the new Messages for
+    every participant of their Thread but the sender
+    """
+    deltas = {}
+    for message in messages:
+        for user_id in participants[message.thread_id]:
+            if user_id == message.sender_id:
+                continue
+            delta = deltas.setdefault((message.thread_id, user_id), [0, None])
+            if not message.is_read:
+                delta[0] += 1
+            elif delta[1] is None or message.id > delta[1]:
+                delta[1] = message.id
+    return deltas
+
+
+def ingest_messages(items, chunk_size=None):
+    """
+    Insert already validated Messages, dicts of thread, sender, text and
+    optionally created and is_read; returns the created Messages
+    """
+    chunk_size = chunk_size or get_config()['CHUNK_SIZE']
+    now = timezone.now()
+    messages = [
+        Message(
+            thread_id=item['thread'], sender_id=item['sender'], text=item['text'],
+            created=item.get('created') or now, is_read=item.get('is_read', False)
+        )
+        for item in items
+    ]
+    thread_ids = {message.thread_id for message in messages}
+
+    newest = Message.objects.filter(thread=OuterRef('pk')).order_by('-created', '-id').values('id')[:1]
+    with serialized_write():
+        messages = Message.objects.bulk_create(messages, batch_size=chunk_size)
+        threads = Thread.objects.filter(pk__in=thread_ids)
+        threads.update(last_message=Subquery(newest), updated=now)
+        participants = defaultdict(list)
+        for thread_id, user_id in memberships(thread_ids):
+            participants[thread_id].append(user_id)
+        if all(message.pk is not None for message in messages):
+            ThreadReadState.objects.messages_added(read_state_deltas(messages, participants))
+        else:
+            # Without INSERT ... RETURNING the ids (watermarks) are unknown
+            ThreadReadState.objects.rebuild(threads)
+        for thread_id in thread_ids:
+            cache.invalidate_thread(thread_id, participants[thread_id])
+    return messages
@@ -0,0 +1,147 @@
+"""
+In-process load testing of the API: a request mix (generated or replayed from
+NDJSON) is sent through the Django test client by concurrent worker threads,
+each request authenticated with a real access token of its user
+
+A request is {"method": "GET", "path": "/api/threads/", "user": <user id>,
+"data": {...} (optional), "endpoint": "<label>" (optional, defaults to the URL name)}
+"""
+import json
+import logging
+import math
+import queue
+import random
+import threading
+import time
+from collections import defaultdict
+
+from django.db import connections
+from django.urls import resolve, reverse
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from chat.authentication import user_cache
+from chat.models import Thread
+
+# (endpoint, weight) of the generated mix
+MIX = (
+    ('threads_list_create', 30),
+    ('messages_list_create', 30),
+    ('message_create', 15),
+    ('thread_read', 10),
+    ('unread_summary', 10),
+    ('messages_search', 5),
+)
+
+
+def generate_requests(count, seed=0):
+    """
+    Random requests of the MIX over the existing Threads, each sent by one of their participants
+    """
+    rng = random.Random(seed)
+    memberships = list(Thread.participants.through.objects.order_by('id').values_list('thread_id', 'user_id'))
+    endpoints, weights = zip(*MIX)
+    requests = []
+    for endpoint in rng.choices(endpoints, weights, k=count):
+        thread_id, user_id = rng.choice(memberships)
+        request = {'endpoint': endpoint, 'method': 'GET', 'user': user_id}
+        if endpoint == 'threads_list_create':
+            request['path'] = reverse('threads_list_create')
+        elif endpoint == 'messages_list_create':
+            request['path'] = reverse('messages_list_create', kwargs={'thread_id': thread_id})
+        elif endpoint == 'message_create':
+            request.update(method='POST', path=reverse('messages_list_create', kwargs={'thread_id': thread_id}),
+                           data={'text': 'load test ' * rng.randint(1, 8)})
+        elif endpoint == 'thread_read':
+            request.update(method='POST', path=reverse('thread_read', kwargs={'thread_id': thread_id}))
+        elif endpoint == 'unread_summary':
+            request['path'] = reverse('unread_summary', kwargs={'pk': user_id})
+        else:
+            request['path'] = reverse('messages_search') + '?q=lorem'
+        requests.append(request)
+    return requests
+
+
+def read_requests(lines):
+    return [json.loads(line) for line in lines if line.strip()]
+
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile of sorted values
+    """
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+class Result:
+    def __init__(self):
+        self.timings = []
+        self.errors = 0
+
+
+def run(requests, concurrency=8):
+    """
+    Send the requests with `concurrency` worker threads, returns
+    ({endpoint: Result}, wall time in seconds)
+    """
+    pending = queue.Queue()
+    for request in requests:
+        pending.put(request)
+    tokens = {user_id: str(AccessToken.for_user(user_cache.get(user_id)))
+              for user_id in {request['user'] for request in requests}}
+    results = defaultdict(Result)
+    lock = threading.Lock()
+
+    def worker():
+        client = APIClient(raise_request_exception=False)
+        try:
+            while True:
+                try:
+                    request = pending.get_nowait()
+                except queue.Empty:
+                    return
+                endpoint = request.get('endpoint') or resolve(request['path'].split('?')[0]).url_name
+                client.credentials(HTTP_AUTHORIZATION=f'Bearer {tokens[request["user"]]}')
+                start = time.perf_counter()
+                response = client.generic(
+                    request['method'], request['path'], json.dumps(request.get('data') or {}),
+                    content_type='application/json'
+                )
+                elapsed = time.perf_counter() - start
+                with lock:
+                    results[endpoint].timings.append(elapsed)
+                    results[endpoint].errors += response.status_code >= 400
+        finally:
+            connections.close_all()
+
+    # Failed requests are counted, not logged one by one
+    request_logger = logging.getLogger('django.request')
+    request_logger_disabled, request_logger.disabled = request_logger.disabled, True
+    workers = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    try:
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+    finally:
+        request_logger.disabled = request_logger_disabled
+    return dict(results), time.perf_counter() - start
+
+
+def summarize(results, wall_time):
+    """
+    Rows of (endpoint, requests, errors, requests/s, p50, p95, p99 in ms), the total last
+    """
+    rows = []
+    everything = Result()
+    for endpoint, result in sorted(results.items()) + [('total', everything)]:
+        if result is not everything:
+            everything.timings += result.timings
+            everything.errors += result.errors
+        timings = sorted(result.timings)
+        rows.append((
+            endpoint, len(timings), result.errors, round(len(timings) / wall_time, 1),
+            *(round(percentile(timings, p) * 1000, 2) for p in (50, 95, 99))
+        ))
+    return rows
@@ -0,0 +1,25 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chat import archive
+
+
+class Command(BaseCommand):
+    """
+    Move old Messages from the live table into the archive (chat.archive)
+    """
+    help = 'Archive read Messages older than the given number of days'
+
+    def add_arguments(self, parser):
+        config = archive.get_config()
+        parser.add_argument('--days', type=int, default=config['AGE_DAYS'],
+                            help='Archive Messages older than this many days')
+        parser.add_argument('--batch-size', type=int, default=config['BATCH_SIZE'],
+                            help='Messages moved per transaction')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        moved = archive.archive_messages(cutoff, options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Archived {moved} message(s) created before {cutoff:%Y-%m-%d %H:%M}'))
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+
+from chat import export
+from chat.models import Thread
+
+
+class Command(BaseCommand):
+    """
+    Export the history of Threads as NDJSON or CSV with constant memory
+    """
+    help = 'Export the Messages of Threads (oldest first) as NDJSON or CSV'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--thread', type=int, action='append', dest='threads',
+                            help='Only export the given Thread id (may be repeated)')
+        parser.add_argument('--format', choices=tuple(export.FORMATS), default='ndjson')
+        parser.add_argument('--after', type=int, help='Resume after the given Message id')
+        parser.add_argument('--output', help='Write to this file instead of stdout')
+        parser.add_argument('--chunk-size', type=int, default=export.CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        thread_ids = options['threads'] or Thread.objects.values_list('id', flat=True)
+        messages = export.iter_messages(thread_ids, options['after'], options['chunk_size'])
+        chunks = export.stream(messages, options['format'], options['chunk_size'])
+
+        if options['output'] is None:
+            for chunk in chunks:
+                self.stdout.write(chunk, ending='')
+            return
+        with open(options['output'], 'w', encoding='utf-8', newline='') as output:
+            for chunk in chunks:
+                output.write(chunk)
+        self.stderr.write(self.style.SUCCESS(f'Exported to {options["output"]}'))
@@ -0,0 +1,56 @@
+import json
+import sys
+from itertools import islice
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat import ingest
+from chat.serializers import MessageBatchSerializer
+
+
+class Command(BaseCommand):
+    """
+    Import Messages from NDJSON (the output of export_threads works as is)
+    """
+    help = 'Import Messages from an NDJSON file, one {"thread", "sender", "text", "created"} object per line'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='NDJSON file, - for stdin')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Messages validated and inserted per transaction')
+
+    def handle(self, *args, **options):
+        batch_size = min(options['batch_size'], ingest.get_config()['MAX_BATCH_SIZE'])
+        source = sys.stdin if options['path'] == '-' else open(options['path'], encoding='utf-8')
+        created = 0
+        try:
+            lines = (line for line in source if line.strip())
+            while batch := list(islice(lines, batch_size)):
+                messages = []
+                for number, line in enumerate(batch, created + 1):
+                    try:
+                        messages.append(json.loads(line))
+                    except json.JSONDecodeError as exc:
+                        raise CommandError(f'Message {number}: invalid JSON ({exc})')
+                serializer = MessageBatchSerializer(data={'messages': messages})
+                if not serializer.is_valid():
+                    raise CommandError(f'Invalid messages: {self.number_errors(serializer.errors, created)}')
+                created += len(serializer.save())
+                if options['verbosity'] > 1:
+                    self.stdout.write(f'Imported {created} message(s) so far')
+        finally:
+            if source is not sys.stdin:
+                source.close()
+        self.stdout.write(self.style.SUCCESS(f'Imported {created} message(s)'))
+
+    @staticmethod
+    def number_errors(errors, offset):
+        """
+        Errors keyed by the number of the Message in the file (from 1) instead of its index in the batch
+        """
+        errors = errors['messages']
+        if isinstance(errors, list):
+            errors = dict(enumerate(errors))
+        elif not isinstance(errors, dict):
+            return errors
+        return {offset + index + 1: error for index, error in errors.items() if error}
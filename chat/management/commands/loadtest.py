@@ -0,0 +1,72 @@
+import json
+import os
+import tempfile
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from chat import loadtest
+from chat.seeding import seed_chat
+
+
+class Command(BaseCommand):
+    """
+    Seed a throwaway database and measure latency percentiles and throughput
+    per endpoint under concurrent load
+    """
+    help = 'Replay a recorded or generated request mix against the API in-process and report p50/p95/p99 and requests/s'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=2000, help='Number of generated requests')
+        parser.add_argument('--concurrency', type=int, default=8, help='Number of concurrent clients')
+        parser.add_argument('--users', type=int, default=100)
+        parser.add_argument('--threads', type=int, default=500)
+        parser.add_argument('--messages', type=int, default=20000)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--replay', help='NDJSON file of requests to send instead of a generated mix')
+        parser.add_argument('--record', help='Write the requests that were sent to this NDJSON file')
+        parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+        parser.add_argument('--use-current-database', action='store_true',
+                            help='Run against the configured database (as is, no seeding) instead of a fresh one')
+
+    def handle(self, *args, **options):
+        if options['requests'] < 1 or options['concurrency'] < 1:
+            raise CommandError('--requests and --concurrency must be positive')
+        if options['use_current_database']:
+            return self.load(options)
+
+        setup_test_environment()
+        # A file database: the worker threads need their own connections to it
+        test_name = os.path.join(tempfile.mkdtemp(), 'loadtest.sqlite3')
+        connection.settings_dict['TEST'] = {**connection.settings_dict.get('TEST', {}), 'NAME': test_name}
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            seed_chat(options['users'], options['threads'], options['messages'], seed=options['seed'])
+            self.load(options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+    def load(self, options):
+        if options['replay']:
+            with open(options['replay'], encoding='utf-8') as source:
+                requests = loadtest.read_requests(source)
+        else:
+            requests = loadtest.generate_requests(options['requests'], options['seed'])
+        if not requests:
+            raise CommandError('No requests to send')
+        if options['record']:
+            with open(options['record'], 'w', encoding='utf-8') as output:
+                output.writelines(json.dumps(request) + '\n' for request in requests)
+
+        results, wall_time = loadtest.run(requests, options['concurrency'])
+        rows = loadtest.summarize(results, wall_time)
+        header = ('endpoint', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms')
+        if options['json']:
+            self.stdout.write(json.dumps([dict(zip(header, row)) for row in rows], indent=2))
+            return
+        widths = [max(len(str(row[i])) for row in (header, *rows)) for i in range(len(header))]
+        for row in (header, *rows):
+            self.stdout.write('  '.join(str(cell).ljust(width) for cell, width in zip(row, widths)))
+        self.stdout.write(f'{len(requests)} requests in {wall_time:.2f}s with {options["concurrency"]} clients')
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chat import outbox
+from chat.models import OutboxEvent
+
+
+class Command(BaseCommand):
+    """
+    Handle the events left in the outbox (chat.outbox), e.g. after a crash or from cron
+    """
+    help = 'Handle the pending side effects of writes stored in the outbox'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--include-failed', action='store_true',
+                            help='Also retry the events that used up their attempts')
+
+    def handle(self, *args, **options):
+        if options['include_failed']:
+            OutboxEvent.objects.filter(attempts__gte=outbox.get_config()['MAX_ATTEMPTS']).update(
+                attempts=0, available_at=timezone.now()
+            )
+        handled, failed = outbox.process_pending()
+        self.stdout.write(self.style.SUCCESS(f'Handled {handled} event(s)'))
+        if failed:
+            self.stdout.write(self.style.WARNING(f'{failed} event(s) failed and will be retried'))
+        self.stdout.write(f'{OutboxEvent.objects.count()} event(s) left in the outbox')
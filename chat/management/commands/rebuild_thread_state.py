@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import OuterRef, Subquery
+
+from chat.models import Thread, Message, ThreadReadState
+
+
+class Command(BaseCommand):
+    """
+    Rebuild denormalized Thread state (last_message pointer, read states) from the Message table
+    """
+    help = 'Backfill or rebuild denormalized Thread state from existing Messages'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--thread', type=int, action='append', dest='threads',
+                            help='Only rebuild the given Thread id (may be repeated)')
+
+    def handle(self, *args, **options):
+        threads = Thread.objects.all()
+        if options['threads']:
+            threads = threads.filter(pk__in=options['threads'])
+
+        newest = Message.objects.filter(thread=OuterRef('pk')).order_by('-created', '-id').values('id')[:1]
+        with transaction.atomic():
+            updated = threads.update(last_message=Subquery(newest))
+            read_states = ThreadReadState.objects.rebuild(threads)
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt last_message for {updated} thread(s)'))
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {read_states} read state(s)'))
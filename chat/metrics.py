@@ -0,0 +1,250 @@
+"""
+Per-request instrumentation: SQL query count, DB time, serialization time,
+render time and total latency per view name, aggregated into in-process
+histograms exposed in the Prometheus text format (MetricsView) and optionally
+as Server-Timing headers
+
+Serialization is what runs inside serializing() blocks: the to_representation()
+of the chat serializers and the row serializers of RowListMixin
+
+When CHAT_METRICS['ENABLED'] is off the middleware removes itself from the
+stack (MiddlewareNotUsed) and no query wrapper is installed
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+from chat import cache
+
+DEFAULTS = {
+    'ENABLED': False,
+    'SERVER_TIMING': True,
+    # Serve /api/metrics/ to anybody (e.g. a scraper on a private network) instead of admins only
+    'PUBLIC': False,
+}
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERIES_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+HISTOGRAMS = {
+    'chat_request_duration_seconds': ('Total latency of the request', SECONDS_BUCKETS),
+    'chat_request_db_seconds': ('Time spent executing SQL', SECONDS_BUCKETS),
+    'chat_request_serialize_seconds': ('Time spent serializing objects into response data', SECONDS_BUCKETS),
+    'chat_request_render_seconds': ('Time spent rendering the response body', SECONDS_BUCKETS),
+    'chat_request_queries': ('Number of SQL queries', QUERIES_BUCKETS),
+}
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_METRICS', {})}
+
+
+def format_labels(labels):
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in labels) + '}'
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            yield f'{name}_bucket{format_labels(labels + (("le", bound),))} {cumulative}'
+        yield f'{name}_sum{format_labels(labels)} {self.sum}'
+        yield f'{name}_count{format_labels(labels)} {self.count}'
+
+
+class MetricsRegistry:
+    """
+    Histograms per view and request counters per view and status, local to the process
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._requests = {}
+
+    def observe(self, view, status, values):
+        """
+        values = {histogram name: observed value}
+        """
+        with self._lock:
+            for name, value in values.items():
+                histogram = self._histograms.get((name, view))
+                if histogram is None:
+                    histogram = self._histograms[(name, view)] = Histogram(HISTOGRAMS[name][1])
+                histogram.observe(value)
+            self._requests[(view, status)] = self._requests.get((view, status), 0) + 1
+
+    def render(self):
+        """
+        Prometheus text exposition of the histograms, request and chat cache counters
+        """
+        lines = []
+        with self._lock:
+            for name, (help_text, _) in HISTOGRAMS.items():
+                lines += [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+                for (histogram_name, view), histogram in sorted(self._histograms.items()):
+                    if histogram_name == name:
+                        lines += histogram.render(name, (('view', view),))
+            lines += ['# HELP chat_requests_total Requests per view and status', '# TYPE chat_requests_total counter']
+            lines += [
+                f'chat_requests_total{format_labels((("view", view), ("status", status)))} {count}'
+                for (view, status), count in sorted(self._requests.items())
+            ]
+        lines += ['# HELP chat_cache_requests_total Chat cache lookups', '# TYPE chat_cache_requests_total counter']
+        for namespace, counters in sorted(cache.stats.snapshot().items()):
+            for result, counter in (('hit', 'hits'), ('miss', 'misses')):
+                labels = format_labels((('namespace', namespace), ('result', result)))
+                lines.append(f'chat_cache_requests_total{labels} {counters[counter]}')
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._requests.clear()
+
+
+registry = MetricsRegistry()
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.serialize_time = 0.0
+        self.serializing = False
+        self.render_started = None
+        self.render_time = 0.0
+
+    def rendered(self, response):
+        self.render_time += time.perf_counter() - self.render_started
+        return response
+
+
+_current = ContextVar('chat_request_metrics', default=None)
+
+
+def record_query(execute, sql, params, many, context):
+    metrics = _current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.queries += 1
+        metrics.db_time += time.perf_counter() - started
+
+
+@contextmanager
+def serializing():
+    """
+    Count the time spent in the block as serialization of the current request,
+    nested blocks (a serializer inside another one) are counted once
+    """
+    metrics = _current.get()
+    if metrics is None or metrics.serializing:
+        yield
+        return
+    metrics.serializing = True
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.serializing = False
+        metrics.serialize_time += time.perf_counter() - started
+
+
+def install_query_recorder(connection, **kwargs):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+class MetricsMiddleware:
+    """
+    Record the metrics of every request into `registry` and add a Server-Timing header
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        config = get_config()
+        if not config['ENABLED']:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.server_timing = config['SERVER_TIMING']
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+        connection_created.connect(install_query_recorder, dispatch_uid='chat_metrics_query_recorder')
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        for connection in connections.all(initialized_only=True):
+            install_query_recorder(connection)
+        metrics = request._chat_metrics = RequestMetrics()
+        token = _current.set(metrics)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, metrics, response)
+
+    async def __acall__(self, request):
+        # Queries run in sync_to_async threads, their connections get the
+        # recorder when they are created and see the context variable
+        metrics = request._chat_metrics = RequestMetrics()
+        token = _current.set(metrics)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, metrics, response)
+
+    def process_template_response(self, request, response):
+        metrics = getattr(request, '_chat_metrics', None)
+        if metrics is not None:
+            metrics.render_started = time.perf_counter()
+            response.add_post_render_callback(metrics.rendered)
+        return response
+
+    def finish(self, request, metrics, response):
+        total = time.perf_counter() - metrics.started
+        match = request.resolver_match
+        view = match.view_name if match is not None else 'unresolved'
+        registry.observe(view, response.status_code, {
+            'chat_request_duration_seconds': total,
+            'chat_request_db_seconds': metrics.db_time,
+            'chat_request_serialize_seconds': metrics.serialize_time,
+            'chat_request_render_seconds': metrics.render_time,
+            'chat_request_queries': metrics.queries,
+        })
+        if self.server_timing:
+            response['Server-Timing'] = (
+                f'db;dur={metrics.db_time * 1000:.2f};desc="{metrics.queries} queries", '
+                f'serialize;dur={metrics.serialize_time * 1000:.2f}, '
+                f'render;dur={metrics.render_time * 1000:.2f}, total;dur={total * 1000:.2f}'
+            )
+        return response
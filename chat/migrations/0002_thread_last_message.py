@@ -0,0 +1,28 @@
+# Generated by Django 4.2 on 2026-10-18 15:20
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+import django.db.models.deletion
+
+
+def backfill_last_message(apps, schema_editor):
+    Thread = apps.get_model('chat', 'Thread')
+    Message = apps.get_model('chat', 'Message')
+    newest = Message.objects.filter(thread=OuterRef('pk')).order_by('-created', '-id').values('id')[:1]
+    Thread.objects.update(last_message=Subquery(newest))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='thread',
+            name='last_message',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat.message'),
+        ),
+        migrations.RunPython(backfill_last_message, migrations.RunPython.noop),
+    ]
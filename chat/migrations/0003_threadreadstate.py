@@ -0,0 +1,52 @@
+# Generated by Django 4.2 on 2026-10-18 15:21
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Max, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+import django.db.models.deletion
+
+
+def backfill_read_states(apps, schema_editor):
+    Thread = apps.get_model('chat', 'Thread')
+    Message = apps.get_model('chat', 'Message')
+    ThreadReadState = apps.get_model('chat', 'ThreadReadState')
+    memberships = Thread.participants.through.objects.values_list('thread_id', 'user_id')
+    ThreadReadState.objects.bulk_create(
+        [ThreadReadState(thread_id=thread_id, user_id=user_id) for thread_id, user_id in memberships.iterator()],
+        ignore_conflicts=True
+    )
+    incoming = Message.objects.filter(thread=OuterRef('thread')).exclude(sender=OuterRef('user')).order_by()
+    unread = incoming.filter(is_read=False).values('thread').annotate(total=Count('id')).values('total')
+    last_read = incoming.filter(is_read=True).values('thread').annotate(newest=Max('id')).values('newest')
+    ThreadReadState.objects.update(
+        unread_count=Coalesce(Subquery(unread), Value(0)),
+        last_read_message_id=Subquery(last_read)
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chat', '0002_thread_last_message'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ThreadReadState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('last_read_message_id', models.BigIntegerField(blank=True, null=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('thread', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_states', to='chat.thread')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='thread_read_states', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='threadreadstate',
+            constraint=models.UniqueConstraint(fields=('thread', 'user'), name='chat_readstate_thread_user_uniq'),
+        ),
+        migrations.RunPython(backfill_read_states, migrations.RunPython.noop),
+    ]
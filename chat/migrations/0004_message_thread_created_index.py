@@ -0,0 +1,17 @@
+# Generated by Django 4.2 on 2026-10-18 15:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_threadreadstate'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['thread', '-created', '-id'], name='chat_msg_thread_created_idx'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2 on 2026-10-18 15:22
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_message_thread_created_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='message',
+            name='thread',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='chat.thread'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(('is_read', False)), fields=['thread', 'sender'], name='chat_msg_unread_idx'),
+        ),
+        # Threads of a participant (inbox and pair lookup) without touching the table rows
+        migrations.RunSQL(
+            'CREATE INDEX chat_thread_participants_user_thread_idx ON chat_thread_participants (user_id, thread_id)',
+            'DROP INDEX chat_thread_participants_user_thread_idx',
+        ),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 4.2 on 2026-10-18 15:25
+
+from collections import defaultdict
+
+from django.db import migrations, models
+from django.db.models import Count, Max, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def backfill_pair_key(apps, schema_editor):
+    """
+    Give every 2-participant Thread its pair key, merging duplicate Threads of
+    the same pair into the oldest one
+    """
+    Thread = apps.get_model('chat', 'Thread')
+    Message = apps.get_model('chat', 'Message')
+    ThreadReadState = apps.get_model('chat', 'ThreadReadState')
+
+    participants = defaultdict(list)
+    for thread_id, user_id in Thread.participants.through.objects.values_list('thread_id', 'user_id').iterator():
+        participants[thread_id].append(user_id)
+    pairs = defaultdict(list)
+    for thread_id, user_ids in participants.items():
+        if len(user_ids) == 2:
+            pairs[':'.join(str(user_id) for user_id in sorted(user_ids))].append(thread_id)
+
+    merged = []
+    for pair_key, thread_ids in pairs.items():
+        keep, *duplicates = sorted(thread_ids)
+        if duplicates:
+            Message.objects.filter(thread_id__in=duplicates).update(thread_id=keep)
+            newest = Thread.objects.filter(pk__in=thread_ids).aggregate(newest=Max('updated'))['newest']
+            Thread.objects.filter(pk__in=duplicates).delete()
+            Thread.objects.filter(pk=keep).update(updated=newest)
+            merged.append(keep)
+        Thread.objects.filter(pk=keep).update(pair_key=pair_key)
+
+    if merged:
+        newest = Message.objects.filter(thread=OuterRef('pk')).order_by('-created', '-id').values('id')[:1]
+        Thread.objects.filter(pk__in=merged).update(last_message=Subquery(newest))
+        incoming = Message.objects.filter(thread=OuterRef('thread')).exclude(sender=OuterRef('user')).order_by()
+        unread = incoming.filter(is_read=False).values('thread').annotate(total=Count('id')).values('total')
+        last_read = incoming.filter(is_read=True).values('thread').annotate(newest=Max('id')).values('newest')
+        ThreadReadState.objects.filter(thread_id__in=merged).update(
+            unread_count=Coalesce(Subquery(unread), Value(0)),
+            last_read_message_id=Subquery(last_read)
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_message_hot_path_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='thread',
+            name='pair_key',
+            field=models.CharField(blank=True, editable=False, max_length=41, null=True),
+        ),
+        migrations.RunPython(backfill_pair_key, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2026-10-18 15:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_thread_pair_key'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='thread',
+            name='pair_key',
+            field=models.CharField(blank=True, editable=False, max_length=41, null=True, unique=True),
+        ),
+    ]
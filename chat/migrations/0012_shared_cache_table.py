@@ -0,0 +1,20 @@
+# Generated by Django 4.2 on 2026-10-18 18:05
+
+from django.core.management import call_command
+from django.db import migrations
+
+
+def create_cache_tables(apps, schema_editor):
+    # Tables of the DatabaseCache entries of CACHES (the `shared` cache), no-op when they exist
+    call_command('createcachetable', database=schema_editor.connection.alias, verbosity=0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0011_archivedmessage'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_cache_tables, migrations.RunPython.noop),
+    ]
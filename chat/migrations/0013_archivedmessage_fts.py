@@ -0,0 +1,46 @@
+# Generated by Django 4.2 on 2026-10-18 19:10
+
+from django.db import migrations
+
+# External content FTS5 index of ArchivedMessage.text, kept in sync like
+# chat_message_fts (0008): archived history stays searchable (chat.search)
+CREATE_SQL = [
+    "CREATE VIRTUAL TABLE chat_archivedmessage_fts USING fts5("
+    "text, content='chat_archivedmessage', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER chat_archivedmessage_fts_insert AFTER INSERT ON chat_archivedmessage BEGIN "
+    "INSERT INTO chat_archivedmessage_fts(rowid, text) VALUES (new.id, new.text); END",
+    "CREATE TRIGGER chat_archivedmessage_fts_delete AFTER DELETE ON chat_archivedmessage BEGIN "
+    "INSERT INTO chat_archivedmessage_fts(chat_archivedmessage_fts, rowid, text) VALUES ('delete', old.id, old.text); END",
+    "CREATE TRIGGER chat_archivedmessage_fts_update AFTER UPDATE OF text ON chat_archivedmessage BEGIN "
+    "INSERT INTO chat_archivedmessage_fts(chat_archivedmessage_fts, rowid, text) VALUES ('delete', old.id, old.text); "
+    "INSERT INTO chat_archivedmessage_fts(rowid, text) VALUES (new.id, new.text); END",
+    "INSERT INTO chat_archivedmessage_fts(chat_archivedmessage_fts) VALUES ('rebuild')",
+]
+
+DROP_SQL = [
+    'DROP TRIGGER IF EXISTS chat_archivedmessage_fts_update',
+    'DROP TRIGGER IF EXISTS chat_archivedmessage_fts_delete',
+    'DROP TRIGGER IF EXISTS chat_archivedmessage_fts_insert',
+    'DROP TABLE IF EXISTS chat_archivedmessage_fts',
+]
+
+
+def run(statements):
+    def forwards(apps, schema_editor):
+        # Other databases use chat.search.DatabaseSearchBackend
+        if schema_editor.connection.vendor != 'sqlite':
+            return
+        for statement in statements:
+            schema_editor.execute(statement)
+    return forwards
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0012_shared_cache_table'),
+    ]
+
+    operations = [
+        migrations.RunPython(run(CREATE_SQL), run(DROP_SQL)),
+    ]
@@ -0,0 +1,91 @@
+import hashlib
+
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import quote_etag
+
+from chat import metrics
+from chat.models import Thread
+
+
+class ConditionalGetMixin:
+    """
+    Answer If-None-Match with 304 Not Modified after a single cheap aggregate
+    query, before any serialization happens
+
+    get_state() returns anything that changes whenever the response would. There
+    is no Last-Modified: deletes, archiving and imports of older Messages change
+    a response without any newer timestamp, so only the ETag can validate it
+    """
+    def get_state(self):
+        raise NotImplementedError
+
+    def get(self, request, *args, **kwargs):
+        digest = hashlib.sha1(repr((
+            self.get_state(), request.user.id, request.get_full_path(), request.META.get('HTTP_ACCEPT')
+        )).encode()).hexdigest()
+        etag = quote_etag(digest)
+
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = super().get(request, *args, **kwargs)
+        if response.status_code in (200, 304):
+            response['ETag'] = etag
+            patch_vary_headers(response, ('Accept', 'Authorization'))
+        return response
+
+
+class RowListMixin:
+    """
+    List through `row_serializer_class` (see chat.read_serializers) from
+    .values() rows instead of building model instances for serializer_class
+    """
+    row_serializer_class = None
+
+    def get_row_serializer(self):
+        return self.row_serializer_class()
+
+    def serialize_rows(self, queryset):
+        serializer = self.get_row_serializer()
+        rows = list(queryset.values(*serializer.columns))
+        with metrics.serializing():
+            return serializer.serialize_many(rows)
+
+    def list_rows(self):
+        """
+        Response data of the paginated list, same shape as ListModelMixin.list
+        """
+        serializer = self.get_row_serializer()
+        rows = self.filter_queryset(self.get_queryset()).values(*serializer.columns)
+        page = self.paginate_queryset(rows)
+        items = list(rows) if page is None else page
+        with metrics.serializing():
+            data = serializer.serialize_many(items)
+        if page is None:
+            return data
+        return self.get_paginated_response(data).data
+
+
+class ThreadQueryMixin:
+    """
+    Shared queryset of the Thread views (see ThreadQuerySet.for_api): the
+    participants of a whole page are prefetched with one query whatever the page
+    size; ?expand=participants renders them as {id, username} instead of ids
+    """
+    expandable = ('participants',)
+
+    def get_expand(self):
+        expand = self.request.query_params.get('expand', '').split(',')
+        return tuple(field for field in self.expandable if field in expand)
+
+    def get_thread_queryset(self, queryset=None):
+        if queryset is None:
+            queryset = Thread.objects.all()
+        return queryset.for_api(self.request.user, self.get_expand())
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['expand'] = self.get_expand()
+        return context
+
+    def get_row_serializer(self):
+        return self.row_serializer_class(expand=self.get_expand())
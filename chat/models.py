@@ -1,15 +1,46 @@
 from django.db import models
+from django.db.models import Count, F, Max, OuterRef, Prefetch, Q, Subquery, Value
+from django.db.models.functions import Coalesce, Greatest, NullIf
 from django.contrib.auth.models import User
+from django.utils import timezone
+
+from chat.sqlite import serialized_write
+
+
+class ThreadQuerySet(models.QuerySet):
+    def with_unread_count(self, user):
+        """
+        Annotate every Thread with the unread counter of the given user
+        """
+        unread = ThreadReadState.objects.filter(thread=OuterRef('pk'), user_id=user.id).values('unread_count')[:1]
+        return self.annotate(unread_count=Coalesce(Subquery(unread), Value(0)))
+
+    def for_api(self, user, expand=()):
+        """
+        Threads as ThreadSerializer renders them for the given user: last_message
+        joined, unread counter annotated and the participants of all the Threads
+        prefetched with a single query (with their username for expand=participants)
+        """
+        fields = ('id', 'username') if 'participants' in expand else ('id',)
+        participants = Prefetch('participants', queryset=User.objects.only(*fields).order_by('id'))
+        return self.select_related('last_message').with_unread_count(user).prefetch_related(participants)
 
 
 class Thread(models.Model):
     """
     Thread Model
     participants = [value1, value2] - ONLY 2 values
+    pair_key = "<smaller user id>:<bigger user id>" - unique, one Thread per pair of users
     """
     participants = models.ManyToManyField(User, related_name='threads', verbose_name='Participant')
+    pair_key = models.CharField(max_length=41, unique=True, null=True, blank=True, editable=False)
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
+    last_message = models.ForeignKey(
+        'Message', null=True, blank=True, on_delete=models.SET_NULL, related_name='+', editable=False
+    )
+
+    objects = ThreadQuerySet.as_manager()
 
     class Meta:
         ordering = ['-updated']
@@ -17,6 +48,44 @@ class Thread(models.Model):
     def __str__(self):
         return f'Thread {self.id}'
 
+    @staticmethod
+    def make_pair_key(user_ids):
+        """
+        Canonical key of a pair of users, independent of their order
+        """
+        return ':'.join(str(user_id) for user_id in sorted(user_ids))
+
+    def refresh_last_message(self):
+        """
+        Point last_message at the newest Message of this Thread (or None)
+        """
+        self.last_message = self.messages.order_by('-created', '-id').first()
+        Thread.objects.filter(pk=self.pk).update(last_message=self.last_message)
+
+
+class MessageQuerySet(models.QuerySet):
+    def mark_read(self, thread_id, reader_id, up_to_message_id=None):
+        """
+        Mark the unread Messages of the Thread sent to the reader as read with a
+        single UPDATE, up to up_to_message_id (inclusive) or all of them
+        The watermark is the newest Message of the Thread not after
+        up_to_message_id, so an id of another Thread or beyond the last Message
+        never moves it past the history
+        Returns (number of Messages marked read, read watermark)
+        """
+        unread = self.filter(thread_id=thread_id, is_read=False).exclude(sender_id=reader_id)
+        if up_to_message_id is not None:
+            unread = unread.filter(id__lte=up_to_message_id)
+            newest = self.filter(thread_id=thread_id, id__lte=up_to_message_id)
+        else:
+            newest = unread
+        with serialized_write():
+            watermark = newest.aggregate(newest=Max('id'))['newest']
+            count = unread.update(is_read=True)
+            if watermark is not None:
+                ThreadReadState.objects.mark_read(thread_id, reader_id, watermark)
+        return count, watermark
+
 
 class Message(models.Model):
     """
@@ -24,9 +93,194 @@ class Message(models.Model):
     """
     sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sender')
     text = models.TextField()
-    thread = models.ForeignKey(Thread, on_delete=models.CASCADE, related_name='messages')
-    created = models.DateTimeField(auto_now_add=True, db_index=True)
+    thread = models.ForeignKey(Thread, on_delete=models.CASCADE, related_name='messages', db_index=False)
+    # Not auto_now_add so imported Messages keep their original timestamp
+    created = models.DateTimeField(default=timezone.now, editable=False, db_index=True)
     is_read = models.BooleanField(default=False)
 
+    objects = MessageQuerySet.as_manager()
+
     class Meta:
         ordering = ['-created']
+        indexes = [
+            # Thread history, also serves every other lookup by thread_id
+            models.Index(fields=['thread', '-created', '-id'], name='chat_msg_thread_created_idx'),
+            # Unread Messages of a Thread addressed to the participant who is not the sender
+            models.Index(fields=['thread', 'sender'], condition=Q(is_read=False), name='chat_msg_unread_idx'),
+        ]
+
+
+class ArchivedMessage(models.Model):
+    """
+    Message moved out of the live table (see chat.archive), keeps its id
+    """
+    id = models.BigIntegerField(primary_key=True)
+    sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    text = models.TextField()
+    thread = models.ForeignKey(Thread, on_delete=models.CASCADE, related_name='archived_messages', db_index=False)
+    created = models.DateTimeField()
+    is_read = models.BooleanField(default=True)
+
+    class Meta:
+        ordering = ['-created']
+        indexes = [
+            models.Index(fields=['thread', '-created', '-id'], name='chat_archive_thread_idx'),
+        ]
+
+    def __str__(self):
+        return f'Archived message {self.id}'
+
+
+def unread_messages():
+    """
+    Number of unread Messages of the read state's Thread sent by someone else
+    (chat_msg_unread_idx); the counters are recounted rather than moved by
+    one, so the outbox handlers (chat.tasks) and reads may run in any order
+    """
+    unread = Message.objects.filter(thread=OuterRef('thread'), is_read=False).exclude(sender=OuterRef('user'))
+    return Coalesce(Subquery(unread.order_by().values('thread').annotate(total=Count('id')).values('total')), Value(0))
+
+
+class ThreadReadStateManager(models.Manager):
+    def sync_participants(self, thread):
+        """
+        Make sure every participant of the Thread has a read state and drop the
+        read states of former participants
+        """
+        user_ids = list(thread.participants.values_list('id', flat=True))
+        self.filter(thread=thread).exclude(user_id__in=user_ids).delete()
+        self.bulk_create(
+            [ThreadReadState(thread=thread, user_id=user_id) for user_id in user_ids],
+            ignore_conflicts=True
+        )
+
+    def participants_changed(self, user, thread_ids, action):
+        """
+        Create or drop the read states of a user added to / removed from the
+        given Threads (thread_ids None: every Thread of the user)
+        """
+        if action == 'post_add':
+            self.bulk_create(
+                [ThreadReadState(thread_id=thread_id, user=user) for thread_id in thread_ids], ignore_conflicts=True
+            )
+        else:
+            states = self.filter(user=user)
+            if thread_ids is not None:
+                states = states.filter(thread_id__in=thread_ids)
+            states.delete()
+
+    def rebuild(self, threads):
+        """
+        Recreate the read states of the given Threads from their participants and Messages
+        """
+        memberships = Thread.participants.through.objects.filter(thread__in=threads).values_list('thread_id', 'user_id')
+        self.filter(thread__in=threads).exclude(
+            user_id__in=Thread.participants.through.objects.filter(thread=OuterRef('thread')).values('user_id')
+        ).delete()
+        self.bulk_create(
+            [ThreadReadState(thread_id=thread_id, user_id=user_id) for thread_id, user_id in memberships.iterator()],
+            ignore_conflicts=True
+        )
+        incoming = Message.objects.filter(thread=OuterRef('thread')).exclude(sender=OuterRef('user')).order_by()
+        last_read = incoming.filter(is_read=True).values('thread').annotate(newest=Max('id')).values('newest')
+        # Archived Messages have all been read
+        archived = ArchivedMessage.objects.filter(thread=OuterRef('thread')).exclude(sender=OuterRef('user')).order_by()
+        archived_read = archived.values('thread').annotate(newest=Max('id')).values('newest')
+        return self.filter(thread__in=threads).update(
+            unread_count=unread_messages(),
+            last_read_message_id=NullIf(
+                Greatest(Coalesce(Subquery(last_read), Value(0)), Coalesce(Subquery(archived_read), Value(0))), Value(0)
+            ),
+            updated=timezone.now()
+        )
+
+    def messages_added(self, deltas):
+        """
+        Count Messages created in bulk: deltas maps (thread_id, user_id) to
+        (number of new unread Messages, id of the newest new read one or None),
+        one UPDATE per read state whatever the number of Messages
+        """
+        self.bulk_create(
+            [ThreadReadState(thread_id=thread_id, user_id=user_id) for thread_id, user_id in deltas],
+            ignore_conflicts=True
+        )
+        now = timezone.now()
+        for (thread_id, user_id), (unread, last_read) in deltas.items():
+            self.filter(thread_id=thread_id, user_id=user_id).update(
+                unread_count=F('unread_count') + unread,
+                last_read_message_id=NullIf(
+                    Greatest(Coalesce(F('last_read_message_id'), Value(0)), Value(last_read or 0)), Value(0)
+                ),
+                updated=now
+            )
+
+    def message_created(self, message):
+        """
+        Recount the unread Messages of every participant but the sender after a new Message
+        """
+        return self.filter(thread_id=message.thread_id).exclude(user_id=message.sender_id).update(
+            unread_count=unread_messages(), updated=timezone.now()
+        )
+
+    def message_deleted(self, message):
+        """
+        Recount the unread Messages after deleting one that was still unread
+        """
+        if message.is_read:
+            return 0
+        return self.filter(thread_id=message.thread_id).exclude(user_id=message.sender_id).update(
+            unread_count=unread_messages(), updated=timezone.now()
+        )
+
+    def mark_read(self, thread_id, user_id, message_id):
+        """
+        Recount the unread Messages after a read and move the read watermark up to message_id
+        """
+        return self.filter(thread_id=thread_id, user_id=user_id).update(
+            unread_count=unread_messages(),
+            last_read_message_id=Greatest(Coalesce(F('last_read_message_id'), Value(0)), Value(message_id)),
+            updated=timezone.now()
+        )
+
+
+class ThreadReadState(models.Model):
+    """
+    Read state of a Thread for one of its participants
+    unread_count - number of unread Messages sent by the other participant
+    last_read_message_id - the newest Message id the participant has read
+    """
+    thread = models.ForeignKey(Thread, on_delete=models.CASCADE, related_name='read_states')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='thread_read_states')
+    unread_count = models.PositiveIntegerField(default=0)
+    last_read_message_id = models.BigIntegerField(null=True, blank=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    objects = ThreadReadStateManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=('thread', 'user'), name='chat_readstate_thread_user_uniq'),
+        ]
+
+    def __str__(self):
+        return f'Thread {self.thread_id} read state of {self.user_id}'
+
+
+class OutboxEvent(models.Model):
+    """
+    Side effect of a write, stored in the transaction of the write and deleted
+    once handled (see chat.outbox)
+    kind - name of the handler in CHAT_OUTBOX['HANDLERS'], payload - its keyword arguments
+    """
+    kind = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict)
+    created = models.DateTimeField(default=timezone.now, editable=False)
+    available_at = models.DateTimeField(default=timezone.now, db_index=True)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        ordering = ['id']
+
+    def __str__(self):
+        return f'{self.kind} event {self.id}'
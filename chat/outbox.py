@@ -0,0 +1,191 @@
+"""
+Transactional outbox for the side effects of writes
+
+enqueue() stores an OutboxEvent in the transaction of the write, so a side
+effect is never lost; once the transaction commits the event id goes to a pool
+of worker threads through a bounded queue (when the queue is full the event
+waits for the next poll). Handling an event deletes it in the same transaction
+as the writes of its handler, so those apply once even when the event is
+delivered twice (at-least-once delivery); a failed handler is retried with
+exponential backoff up to MAX_ATTEMPTS times
+
+MODE 'sync' handles events right away in the caller's transaction (tests)
+"""
+import logging
+import queue
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import close_old_connections, connections, transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from chat.models import OutboxEvent
+from chat.sqlite import serialized_write
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'MODE': 'async',
+    'WORKERS': 2,
+    'QUEUE_SIZE': 1000,
+    # Seconds between scans for events left in the outbox (full queue, retries, restarts)
+    'POLL_INTERVAL': 5,
+    'MAX_ATTEMPTS': 5,
+    # Seconds before the first retry, doubled on every attempt
+    'RETRY_DELAY': 1,
+    'HANDLERS': {
+        'message.created': 'chat.tasks.message_created',
+    },
+}
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def get_config():
+    config = {**DEFAULTS, **getattr(settings, 'CHAT_OUTBOX', {})}
+    config['HANDLERS'] = {**DEFAULTS['HANDLERS'], **config['HANDLERS']}
+    return config
+
+
+def enqueue(kind, **payload):
+    """
+    Record the event in the current transaction and hand it to the workers once it commits
+    """
+    event = OutboxEvent.objects.create(kind=kind, payload=payload)
+    if get_config()['MODE'] == 'sync':
+        process(event.id)
+    else:
+        transaction.on_commit(lambda: get_worker().submit(event.id))
+    return event
+
+
+def process(event_id):
+    """
+    Run the handler of the event and delete it, or schedule a retry if the
+    handler fails; False when it failed
+    """
+    event = OutboxEvent.objects.filter(pk=event_id).first()
+    if event is None:
+        return True
+    config = get_config()
+    try:
+        handler = import_string(config['HANDLERS'][event.kind])
+        with serialized_write():
+            # Claim the event: a concurrent delivery finds nothing to delete and backs off
+            if not OutboxEvent.objects.filter(pk=event.pk).delete()[0]:
+                return True
+            handler(**event.payload)
+    except Exception as exc:
+        logger.exception('Outbox event %s (%s) failed', event.pk, event.kind)
+        delay = config['RETRY_DELAY'] * 2 ** event.attempts
+        OutboxEvent.objects.filter(pk=event.pk).update(
+            attempts=F('attempts') + 1, last_error=repr(exc), available_at=timezone.now() + timedelta(seconds=delay)
+        )
+        return False
+    return True
+
+
+def pending():
+    """
+    Ids of the events due now that have attempts left, oldest first
+    """
+    return OutboxEvent.objects.filter(
+        available_at__lte=timezone.now(), attempts__lt=get_config()['MAX_ATTEMPTS']
+    ).values_list('id', flat=True)
+
+
+def process_pending():
+    """
+    Handle every event due now, returns (handled, failed)
+    """
+    results = [process(event_id) for event_id in list(pending())]
+    return results.count(True), results.count(False)
+
+
+class Worker:
+    """
+    Threads handling the submitted events; idle threads poll the outbox for
+    events that never made it to the queue or wait for a retry
+    """
+    def __init__(self, workers, queue_size, poll_interval):
+        self.queue = queue.Queue(queue_size)
+        self.poll_interval = poll_interval
+        self._poll_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self.threads = [
+            threading.Thread(target=self.run, name=f'chat-outbox-{index}', daemon=True) for index in range(workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, event_id):
+        try:
+            self.queue.put_nowait(event_id)
+        except queue.Full:
+            pass  # Stays in the outbox until the next poll
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                event_id = self.queue.get(timeout=self.poll_interval)
+            except queue.Empty:
+                if self._poll_lock.acquire(blocking=False):
+                    try:
+                        self.guard(process_pending)
+                    finally:
+                        self._poll_lock.release()
+                continue
+            try:
+                if event_id is not None:
+                    self.guard(process, event_id)
+            finally:
+                self.queue.task_done()
+        connections.close_all()
+
+    @staticmethod
+    def guard(func, *args):
+        try:
+            func(*args)
+        except Exception:
+            logger.exception('Outbox worker error')
+        finally:
+            close_old_connections()
+
+    def join(self):
+        """
+        Wait until every submitted event has been handled
+        """
+        self.queue.join()
+
+    def stop(self):
+        self._stopped.set()
+        for _ in self.threads:
+            self.submit(None)
+        for thread in self.threads:
+            thread.join()
+
+
+def get_worker():
+    global _worker
+    with _worker_lock:
+        if _worker is None:
+            config = get_config()
+            _worker = Worker(config['WORKERS'], config['QUEUE_SIZE'], config['POLL_INTERVAL'])
+        return _worker
+
+
+def _reset_worker(setting, **kwargs):
+    global _worker
+    if setting == 'CHAT_OUTBOX':
+        with _worker_lock:
+            worker, _worker = _worker, None
+        if worker is not None:
+            worker.stop()
+
+
+setting_changed.connect(_reset_worker)
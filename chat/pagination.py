@@ -0,0 +1,136 @@
+import json
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import Cursor, CursorPagination
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class MessageCursorPagination(CursorPagination):
+    """
+    Keyset pagination of Thread history on (thread_id, created, id)
+    The first page holds the newest Messages, `next` goes to older and
+    `previous` to newer ones; the cursors are opaque and stay stable
+    while new Messages arrive
+
+    The position in a cursor is the whole ordering key (created, id), not only
+    `created` plus an offset as in CursorPagination, so Messages sharing a
+    timestamp (bulk imports) are neither skipped nor repeated across pages
+
+    Views with get_archive_queryset() continue into the archive (chat.archive)
+    when the live Messages run out: `next` of the last live page starts the
+    archive pages, whose links carry `archive=1`. get_archive_queryset() returns
+    the archived rows in the shape of the paginated ones (same .values() columns)
+    """
+    ordering = ('-created', '-id')
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    archive_query_param = 'archive'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.archive_next = False
+        get_archive_queryset = getattr(view, 'get_archive_queryset', None)
+        if get_archive_queryset is None:
+            return self.paginate_keyset(queryset, request)
+        archive = get_archive_queryset()
+        if request.query_params.get(self.archive_query_param):
+            return self.paginate_archive(archive, request)
+
+        page = self.paginate_keyset(queryset, request)
+        if page is None or self.has_next or (self.cursor is not None and self.cursor.reverse):
+            return page
+        if not page and self.cursor is None:
+            return self.paginate_archive(archive, request)
+        self.archive_next = archive.exists()
+        return page
+
+    def paginate_archive(self, archive, request):
+        page = self.paginate_keyset(archive, request)
+        self.base_url = replace_query_param(self.base_url, self.archive_query_param, 1)
+        return page
+
+    def paginate_keyset(self, queryset, request):
+        """
+        CursorPagination.paginate_queryset with the position compared on every
+        field of the ordering; positions are unique, so cursors never need an offset
+        """
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.cursor = self.decode_cursor(request)
+        reverse = self.cursor is not None and self.cursor.reverse
+        current_position = self.cursor.position if self.cursor is not None else None
+
+        if reverse:
+            queryset = queryset.order_by(*[self.reverse_order(order) for order in self.ordering])
+        else:
+            queryset = queryset.order_by(*self.ordering)
+        if current_position is not None:
+            queryset = queryset.filter(self.after_position(queryset.model, current_position, reverse))
+
+        results = list(queryset[:self.page_size + 1])
+        self.page = results[:self.page_size]
+        has_following = len(results) > len(self.page)
+        if reverse:
+            self.page.reverse()
+            self.has_next, self.has_previous = current_position is not None, has_following
+        else:
+            self.has_next, self.has_previous = has_following, current_position is not None
+        # The links continue from the edges of the page, from the cursor for an empty page
+        if self.page:
+            self.next_position = self._get_position_from_instance(self.page[-1], self.ordering)
+            self.previous_position = self._get_position_from_instance(self.page[0], self.ordering)
+        else:
+            self.next_position = self.previous_position = current_position
+        if (self.has_previous or self.has_next) and self.template is not None:
+            self.display_page_controls = True
+        return self.page
+
+    @staticmethod
+    def reverse_order(order):
+        return order[1:] if order.startswith('-') else '-' + order
+
+    def after_position(self, model, position, reverse):
+        """
+        Q of the rows that follow position in the (reverse) ordering:
+        (a < x) OR (a = x AND b < y) for ('-a', '-b')
+        """
+        try:
+            values = json.loads(position)
+            if not isinstance(values, list) or len(values) != len(self.ordering):
+                raise ValueError
+            key = [
+                (order.lstrip('-'), model._meta.get_field(order.lstrip('-')).to_python(value), order.startswith('-'))
+                for order, value in zip(self.ordering, values)
+            ]
+        except (ValueError, TypeError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+        condition, equal = Q(), Q()
+        for name, value, descending in key:
+            lookup = 'lt' if descending != reverse else 'gt'
+            condition |= equal & Q(**{f'{name}__{lookup}': value})
+            equal &= Q(**{name: value})
+        return condition
+
+    def _get_position_from_instance(self, instance, ordering):
+        values = []
+        for order in ordering:
+            name = order.lstrip('-')
+            values.append(str(instance[name] if isinstance(instance, dict) else getattr(instance, name)))
+        return json.dumps(values)
+
+    def get_next_link(self):
+        if self.archive_next:
+            url = remove_query_param(self.base_url, self.cursor_query_param)
+            return replace_query_param(url, self.archive_query_param, 1)
+        if not self.has_next:
+            return None
+        return self.encode_cursor(Cursor(offset=0, reverse=False, position=self.next_position))
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        return self.encode_cursor(Cursor(offset=0, reverse=True, position=self.previous_position))
@@ -0,0 +1,73 @@
+from django.db import transaction
+from rest_framework.exceptions import NotFound
+from rest_framework.permissions import BasePermission
+
+from chat import cache
+from chat.models import Thread
+from chat.routers import use_primary
+
+
+def members_key(thread_id):
+    return f'chat:members:{thread_id}'
+
+
+def get_members(thread_id):
+    """
+    frozenset of the participant ids of the Thread (empty if there is no such
+    Thread), cached in the chat cache until the participants change (at most
+    cache.get_timeout() seconds: another process may have changed them)
+    """
+    config = cache.get_config()
+    if config['ENABLED']:
+        members = cache.get_cache().get(members_key(thread_id))
+        if members is not None:
+            return members
+    with use_primary():
+        members = frozenset(
+            Thread.participants.through.objects.filter(thread_id=thread_id).values_list('user_id', flat=True)
+        )
+    if config['ENABLED']:
+        cache.get_cache().set(members_key(thread_id), members, cache.get_timeout())
+    return members
+
+
+def is_participant(thread_id, user_id):
+    """
+    Whether the user participates in the Thread: a cached membership set, or a
+    single EXISTS on the (thread_id, user_id) unique index when the cache is off
+    """
+    if cache.get_config()['ENABLED']:
+        return user_id in get_members(thread_id)
+    return Thread.participants.through.objects.filter(thread_id=thread_id, user_id=user_id).exists()
+
+
+def forget_members(thread_ids):
+    """
+    Drop the cached membership sets of the Threads, now and once the current transaction commits
+    """
+    if not cache.get_config()['ENABLED'] or not thread_ids:
+        return
+    keys = [members_key(thread_id) for thread_id in thread_ids]
+
+    def delete():
+        cache.get_cache().delete_many(keys)
+
+    delete()
+    transaction.on_commit(delete)
+
+
+class IsThreadParticipant(BasePermission):
+    """
+    Allow the participants of the Thread in the URL (`thread_id`, or the kwarg
+    named by `thread_lookup_url_kwarg` of the view); everybody else gets a 404
+    as if the Thread did not exist
+    """
+    def has_permission(self, request, view):
+        thread_id = view.kwargs.get(getattr(view, 'thread_lookup_url_kwarg', 'thread_id'))
+        if thread_id is None:
+            return True
+        if not request.user or not request.user.is_authenticated:
+            return False
+        if not is_participant(thread_id, request.user.id):
+            raise NotFound()
+        return True
@@ -0,0 +1,123 @@
+"""
+Read-path serializers building list responses straight from .values() rows
+
+They produce exactly the JSON of MessageSerializer / ThreadSerializer but skip
+the per-instance field machinery of ModelSerializer: the field plan (output key,
+row column, converter) is computed once when the serializer is created
+"""
+from collections import defaultdict
+
+from django.conf import settings
+from django.utils import timezone
+from rest_framework import ISO_8601
+from rest_framework.fields import DateTimeField
+from rest_framework.settings import api_settings
+
+from chat.models import Thread
+
+DATETIME = 'datetime'
+
+
+def datetime_converter():
+    """
+    Equivalent of DateTimeField().to_representation with the current time zone
+    looked up once instead of for every value
+    """
+    to_representation = DateTimeField().to_representation
+    if not settings.USE_TZ or api_settings.DATETIME_FORMAT.lower() != ISO_8601:
+        return to_representation
+    current_timezone = timezone.get_current_timezone()
+
+    def convert(value):
+        if value.tzinfo is None:
+            return to_representation(value)
+        value = value.astimezone(current_timezone).isoformat()
+        return value[:-6] + 'Z' if value.endswith('+00:00') else value
+    return convert
+
+
+class RowSerializer:
+    """
+    fields = ((output key, values() column, converter), ...) where converter is a
+    function, DATETIME or None
+    prefix is prepended to the columns to read a related object from the same row
+    """
+    fields = ()
+
+    def __init__(self, prefix=''):
+        self.to_datetime = datetime_converter()
+        self.columns = tuple(prefix + column for _, column, _ in self.fields)
+        self.plan = tuple(
+            (key, prefix + column, self.to_datetime if converter == DATETIME else converter)
+            for key, column, converter in self.fields
+        )
+
+    def to_representation(self, row):
+        data = {}
+        for key, column, converter in self.plan:
+            value = row[column]
+            data[key] = value if converter is None or value is None else converter(value)
+        return data
+
+    def serialize_many(self, rows):
+        to_representation = self.to_representation
+        return [to_representation(row) for row in rows]
+
+
+class MessageRowSerializer(RowSerializer):
+    """
+    Same output as MessageSerializer
+    """
+    fields = (
+        ('id', 'id', None),
+        ('text', 'text', None),
+        ('thread', 'thread_id', None),
+        ('sender', 'sender_id', None),
+        ('is_read', 'is_read', None),
+        ('created', 'created', DATETIME),
+    )
+
+
+class ThreadRowSerializer(RowSerializer):
+    """
+    Same output as ThreadSerializer, rows come from a queryset annotated with
+    unread_count; the participants of a whole page are loaded with one query,
+    as {id, username} with expand=('participants',)
+    """
+    fields = (
+        ('id', 'id', None),
+        ('created', 'created', DATETIME),
+        ('updated', 'updated', DATETIME),
+        ('unread_count', 'unread_count', None),
+    )
+
+    def __init__(self, prefix='', expand=()):
+        super().__init__(prefix)
+        self.expand = expand
+        self.last_message = MessageRowSerializer(prefix='last_message__')
+        self.columns += ('last_message_id',) + self.last_message.columns
+        self.participants = {}
+
+    def to_representation(self, row):
+        return {
+            'id': row['id'],
+            'participants': self.participants.get(row['id'], []),
+            'created': self.to_datetime(row['created']),
+            'updated': self.to_datetime(row['updated']),
+            'last_message': None if row['last_message_id'] is None else self.last_message.to_representation(row),
+            'unread_count': row['unread_count'],
+        }
+
+    def serialize_many(self, rows):
+        rows = list(rows)
+        self.participants = defaultdict(list)
+        memberships = Thread.participants.through.objects.filter(
+            thread_id__in=[row['id'] for row in rows]
+        ).order_by('thread_id', 'user_id')
+        if 'participants' in self.expand:
+            for thread_id, user_id, username in memberships.values_list('thread_id', 'user_id', 'user__username'):
+                self.participants[thread_id].append({'id': user_id, 'username': username})
+        else:
+            for thread_id, user_id in memberships.values_list('thread_id', 'user_id'):
+                self.participants[thread_id].append(user_id)
+        return super().serialize_many(rows)
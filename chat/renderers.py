@@ -0,0 +1,60 @@
+"""
+Compact renderers for the API, selected with the Accept header
+
+ColumnarJSONRenderer (application/vnd.chat.columnar+json) writes a list as
+{"columns": [...], "rows": [[...], ...]} so the keys are not repeated for
+every item; MessagePackRenderer (application/msgpack) is available when the
+optional msgpack package is installed
+"""
+from importlib.util import find_spec
+
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+if find_spec('msgpack') is not None:
+    import msgpack
+else:
+    msgpack = None
+
+
+def columnar(data):
+    """
+    The lists of dicts in data (a list, or the `results` of a page) as columns and rows
+    """
+    if isinstance(data, dict) and isinstance(data.get('results'), list):
+        return {**data, 'results': columnar(data['results'])}
+    if not isinstance(data, list) or not all(isinstance(item, dict) for item in data):
+        return data
+    columns = list(data[0]) if data else []
+    return {'columns': columns, 'rows': [[item.get(column) for column in columns] for item in data]}
+
+
+class ColumnarJSONRenderer(JSONRenderer):
+    """
+    JSON with the lists of objects written as columns and rows, other data as plain JSON
+    """
+    media_type = 'application/vnd.chat.columnar+json'
+    format = 'columnar'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return super(ColumnarJSONRenderer, self).render(columnar(data), accepted_media_type, renderer_context)
+
+
+class MessagePackRenderer(BaseRenderer):
+    """
+    MessagePack, values MessagePack has no type for are encoded as in JSON
+    """
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def __init__(self):
+        if msgpack is None:
+            raise ImportError('MessagePackRenderer requires the msgpack package')
+        self.encoder = JSONEncoder()
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return msgpack.packb(data, default=self.encoder.default)
@@ -0,0 +1,146 @@
+"""
+Read replica routing with read-your-writes stickiness
+
+Reads of GET/HEAD/OPTIONS requests go to a random replica, everything else
+(writes, reads of other requests, reads inside a transaction, management
+commands) to the primary. A user who has just written is pinned to the primary
+for STICKY_SECONDS so they see their own writes whatever the replication lag;
+the pin lives in CACHE, which must be shared by the worker processes since the
+next request of the user may reach any of them
+
+The entries of the database cache (token revocations, stickiness) are always
+read from the primary: a lagging replica would miss a fresh revocation or pin
+"""
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import DEFAULT_DB_ALIAS, connections
+from rest_framework.permissions import SAFE_METHODS
+
+DEFAULTS = {
+    # Aliases of DATABASES serving reads, None for every alias but the primary (`default`)
+    'REPLICAS': None,
+    'STICKY_SECONDS': 10,
+    'CACHE': 'default',
+}
+
+# app_label of the models DatabaseCache makes for its tables
+CACHE_APP_LABEL = 'django_cache'
+
+# The request whose reads may go to a replica, None reads from the primary
+_replica_request = ContextVar('chat_replica_request', default=None)
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_REPLICAS', {})}
+
+
+def get_replicas():
+    replicas = get_config()['REPLICAS']
+    if replicas is None:
+        replicas = [alias for alias in settings.DATABASES if alias != DEFAULT_DB_ALIAS]
+    return replicas
+
+
+def sticky_key(user_id):
+    return f'chat:sticky:{user_id}'
+
+
+def mark_sticky(user_id):
+    """
+    Read from the primary for the next requests of the user
+    """
+    config = get_config()
+    caches[config['CACHE']].set(sticky_key(user_id), True, config['STICKY_SECONDS'])
+
+
+def is_sticky(user_id):
+    return caches[get_config()['CACHE']].get(sticky_key(user_id), False)
+
+
+@contextmanager
+def use_primary():
+    """
+    Read from the primary inside the block, e.g. for data that gets cached
+    """
+    token = _replica_request.set(None)
+    try:
+        yield
+    finally:
+        _replica_request.reset(token)
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label == CACHE_APP_LABEL:
+            return DEFAULT_DB_ALIAS
+        request = _replica_request.get()
+        if request is None or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return None
+        replicas = get_replicas()
+        if not replicas:
+            return None
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated:
+            # Known once DRF has authenticated the request, looked up once per request
+            if getattr(request, '_chat_sticky_user', None) != user.id:
+                request._chat_sticky_user, request._chat_sticky = user.id, is_sticky(user.id)
+            if request._chat_sticky:
+                return None
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db not in get_replicas()
+
+
+class ReplicaRoutingMiddleware:
+    """
+    Let the reads of safe requests go to replicas and make users sticky to the
+    primary after a successful write; removed from the stack without replicas
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not get_replicas():
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        token = _replica_request.set(request if request.method in SAFE_METHODS else None)
+        try:
+            response = self.get_response(request)
+        finally:
+            _replica_request.reset(token)
+        return self.finish(request, response)
+
+    async def __acall__(self, request):
+        token = _replica_request.set(request if request.method in SAFE_METHODS else None)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _replica_request.reset(token)
+        return self.finish(request, response)
+
+    def finish(self, request, response):
+        user = getattr(request, 'user', None)
+        if request.method not in SAFE_METHODS and response.status_code < 400 and user is not None \
+                and user.is_authenticated:
+            mark_sticky(user.id)
+        return response
@@ -0,0 +1,178 @@
+import base64
+import re
+from html import escape
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import connection
+from django.utils.module_loading import import_string
+
+from chat.models import Thread, Message, ArchivedMessage
+
+DEFAULTS = {
+    # None picks SQLiteFTSBackend on SQLite and DatabaseSearchBackend elsewhere
+    'BACKEND': None,
+    'PAGE_SIZE': 20,
+    'MAX_PAGE_SIZE': 100,
+    'SNIPPET_TOKENS': 12,
+}
+
+TERM_RE = re.compile(r'\w+\*?')
+
+# Around the matches of a raw snippet, replaced by <mark> tags once the text is escaped
+MARK_START, MARK_END = '\x02', '\x03'
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_SEARCH', {})}
+
+
+def parse_terms(query):
+    """
+    Split the user query into words, a trailing `*` makes the word a prefix;
+    everything else (quotes, operators, punctuation) is ignored
+    """
+    return TERM_RE.findall(query)
+
+
+def render_snippet(snippet):
+    """
+    HTML of a snippet with its matches between MARK_START and MARK_END: the
+    Message text is escaped, only the <mark> tags are markup
+    """
+    return escape(snippet).replace(MARK_START, '<mark>').replace(MARK_END, '</mark>')
+
+
+class BaseSearchBackend:
+    """
+    Full-text search of Messages
+
+    search() returns at most `limit` Messages matching every term of the query,
+    best match first, with `rank` (lower is better) and `snippet` attributes;
+    `after` is the (rank, id) of the last Message of the previous page
+    Archived Messages (chat.archive) are searched as well as the live ones
+    The snippet is HTML (see render_snippet()): escaped text with the matches in <mark>
+    """
+    def search(self, terms, user_id, thread_id=None, after=None, limit=20):
+        raise NotImplementedError
+
+
+class SQLiteFTSBackend(BaseSearchBackend):
+    """
+    SQLite FTS5 indexes chat_message_fts over Message.text and
+    chat_archivedmessage_fts over ArchivedMessage.text, kept in sync by triggers
+    (see migrations 0008 and 0013), ranked with bm25 (each index with its own statistics)
+    """
+    indexes = (
+        ('chat_message_fts', Message._meta.db_table),
+        ('chat_archivedmessage_fts', ArchivedMessage._meta.db_table),
+    )
+
+    def search(self, terms, user_id, thread_id=None, after=None, limit=20):
+        match = ' '.join(
+            '"{}"{}'.format(term.rstrip('*'), '*' if term.endswith('*') else '') for term in terms
+        )
+        tokens = get_config()['SNIPPET_TOKENS']
+        selects, params = [], []
+        for fts, table in self.indexes:
+            sql = (
+                'SELECT m.id, m.thread_id, m.sender_id, m.text, m.created, m.is_read,'
+                f" snippet({fts}, 0, %s, %s, '…', %s) AS snippet, bm25({fts}) AS rank"
+                f' FROM {fts} JOIN {table} m ON m.id = {fts}.rowid'
+                f' WHERE {fts} MATCH %s'
+                f' AND m.thread_id IN (SELECT thread_id FROM {Thread.participants.through._meta.db_table} WHERE user_id = %s)'
+            )
+            params += [MARK_START, MARK_END, tokens, match, user_id]
+            if thread_id is not None:
+                sql += ' AND m.thread_id = %s'
+                params.append(thread_id)
+            selects.append(sql)
+        sql = ['SELECT * FROM ({}) AS results'.format(' UNION ALL '.join(selects))]
+        if after is not None:
+            sql.append('WHERE rank > %s OR (rank = %s AND id > %s)')
+            params += [after[0], after[0], after[1]]
+        sql.append('ORDER BY rank, id LIMIT %s')
+        params.append(limit)
+        messages = list(Message.objects.raw(' '.join(sql), params))
+        for message in messages:
+            message.snippet = render_snippet(message.snippet)
+        return messages
+
+
+class DatabaseSearchBackend(BaseSearchBackend):
+    """
+    Fallback for databases without an FTS index: `icontains` on every term,
+    newest first; all the Messages have the same rank
+    """
+    def search(self, terms, user_id, thread_id=None, after=None, limit=20):
+        messages = []
+        for model in (Message, ArchivedMessage):
+            matches = model.objects.filter(thread__participants=user_id)
+            if thread_id is not None:
+                matches = matches.filter(thread_id=thread_id)
+            for term in terms:
+                matches = matches.filter(text__icontains=term.rstrip('*'))
+            if after is not None:
+                matches = matches.filter(id__lt=after[1])
+            messages += matches.order_by('-id')[:limit]
+        messages = sorted(messages, key=lambda message: message.id, reverse=True)[:limit]
+        tokens = get_config()['SNIPPET_TOKENS']
+        for message in messages:
+            message.rank = 0.0
+            message.snippet = self.snippet(message.text, terms, tokens)
+        return messages
+
+    @staticmethod
+    def snippet(text, terms, tokens):
+        """
+        `tokens` words around the first match, every match marked as by the FTS5 snippet()
+        """
+        words = text.replace(MARK_START, '').replace(MARK_END, '').split()
+        needles = [term.rstrip('*').lower() for term in terms]
+        start = next(
+            (i for i, word in enumerate(words) if any(needle in word.lower() for needle in needles)), 0
+        )
+        start = max(0, start - tokens // 2)
+        snippet = ' '.join(words[start:start + tokens])
+        needle_re = re.compile('|'.join(re.escape(needle) for needle in needles), re.IGNORECASE)
+        snippet = needle_re.sub(lambda match: f'{MARK_START}{match.group()}{MARK_END}', snippet)
+        return render_snippet(('…' if start else '') + snippet + ('…' if start + tokens < len(words) else ''))
+
+
+_backend = None
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        backend = get_config()['BACKEND']
+        if backend is None:
+            backend = SQLiteFTSBackend if connection.vendor == 'sqlite' else DatabaseSearchBackend
+        else:
+            backend = import_string(backend)
+        _backend = backend()
+    return _backend
+
+
+def _reset_backend(setting, **kwargs):
+    global _backend
+    if setting == 'CHAT_SEARCH':
+        _backend = None
+
+
+setting_changed.connect(_reset_backend)
+
+
+def encode_cursor(message):
+    """
+    Opaque keyset cursor pointing after the given search result
+    """
+    return base64.urlsafe_b64encode(f'{message.rank!r}:{message.id}'.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """
+    (rank, id) of an encode_cursor() value, ValueError if it is malformed
+    """
+    rank, message_id = base64.urlsafe_b64decode(cursor.encode()).decode().split(':')
+    return float(rank), int(message_id)
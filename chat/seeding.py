@@ -0,0 +1,57 @@
+"""
+Synthetic chat data for benchmarks and load tests
+"""
+import random
+from io import StringIO
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection
+
+from chat.models import Thread, Message
+
+
+def seed_chat(users, threads, messages, unread_ratio=0.1, seed=0):
+    """
+    Insert a synthetic dataset: 2-participant Threads between distinct pairs of
+    random users (with their pair_key, as ThreadSerializer creates them) and
+    Messages spread over them with `created` one second apart
+    """
+    if threads > users * (users - 1) // 2:
+        raise ValueError(f'{users} users make fewer than {threads} distinct pairs')
+    rng = random.Random(seed)
+    User.objects.bulk_create([User(username=f'bench{i}', password='!') for i in range(users)], batch_size=1000)
+    user_ids = list(User.objects.filter(username__startswith='bench').values_list('id', flat=True))
+    pair_keys = {}
+    while len(pair_keys) < threads:
+        pair = rng.sample(user_ids, 2)
+        pair_keys.setdefault(Thread.make_pair_key(pair), pair)
+    Thread.objects.bulk_create([Thread(pair_key=pair_key) for pair_key in pair_keys], batch_size=1000)
+    thread_pair_keys = dict(Thread.objects.filter(pair_key__in=pair_keys).values_list('id', 'pair_key'))
+    thread_ids = list(thread_pair_keys)
+
+    pairs = {}
+    memberships = []
+    for thread_id, pair_key in thread_pair_keys.items():
+        pair = pair_keys[pair_key]
+        pairs[thread_id] = pair
+        memberships += [Thread.participants.through(thread_id=thread_id, user_id=user_id) for user_id in pair]
+    Thread.participants.through.objects.bulk_create(memberships, batch_size=1000)
+
+    batch = []
+    for _ in range(messages):
+        thread_id = rng.choice(thread_ids)
+        batch.append(Message(
+            thread_id=thread_id, sender_id=rng.choice(pairs[thread_id]), text='lorem ipsum ' * rng.randint(1, 8),
+            is_read=rng.random() > unread_ratio
+        ))
+        if len(batch) == 5000:
+            Message.objects.bulk_create(batch)
+            batch = []
+    Message.objects.bulk_create(batch)
+
+    with connection.cursor() as cursor:
+        cursor.execute("UPDATE chat_message SET created = datetime('2023-01-01', '+' || id || ' seconds')")
+        cursor.execute('ANALYZE')
+    call_command('rebuild_thread_state', stdout=StringIO())
+    return user_ids, thread_ids
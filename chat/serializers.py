@@ -1,12 +1,29 @@
 from django.contrib.auth.models import User
-from django.shortcuts import get_object_or_404
+from django.db import IntegrityError
 
 from rest_framework import serializers
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt import serializers as jwt_serializers
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
 
-from chat.models import Thread, Message
+from chat import cache, export, ingest, metrics, outbox
+from chat.authentication import is_revoked
+from chat.models import Thread, Message, ThreadReadState
+from chat.permissions import is_participant
+from chat.search import decode_cursor, get_config as get_search_config, parse_terms
+from chat.sqlite import serialized_write
 
 
-class UserSerializer(serializers.ModelSerializer):
+class MeasuredSerializerMixin:
+    """
+    Count to_representation() as serialization time of the request (chat.metrics)
+    """
+    def to_representation(self, instance):
+        with metrics.serializing():
+            return super().to_representation(instance)
+
+
+class UserSerializer(MeasuredSerializerMixin, serializers.ModelSerializer):
     """
     Serializer for User
     """
@@ -24,7 +41,7 @@ class UserSerializer(serializers.ModelSerializer):
         return user
 
 
-class MessageSerializer(serializers.ModelSerializer):
+class MessageSerializer(MeasuredSerializerMixin, serializers.ModelSerializer):
     """
     Serializer for Message
     """
@@ -35,42 +52,174 @@ class MessageSerializer(serializers.ModelSerializer):
 
     def create(self, validated_data):
         request = self.context.get('request')
-        validated_data['sender'] = request.user
+        validated_data['sender_id'] = request.user.id
         thread_id = request.parser_context.get('kwargs').get('thread_id')
-        thread = get_object_or_404(Thread, id=thread_id)
-        if validated_data['sender'] not in thread.participants.all():
+        if not is_participant(thread_id, request.user.id):
             raise serializers.ValidationError("You're not the member of this thread")
-        validated_data['thread'] = thread
-        return super(MessageSerializer, self).create(validated_data)
+        validated_data['thread_id'] = thread_id
+        with serialized_write():
+            message = super(MessageSerializer, self).create(validated_data)
+            # Thread bump, unread counters and notifications: chat.tasks.message_created
+            outbox.enqueue('message.created', message_id=message.id)
+            cache.invalidate([('thread', thread_id)])
+        return message
+
+
+class ThreadReadSerializer(serializers.Serializer):
+    """
+    Serializer for bulk READ of Thread Messages, without message_id everything is read
+    """
+    message_id = serializers.IntegerField(required=False, min_value=1)
+
+
+class MessageSearchSerializer(serializers.Serializer):
+    """
+    Query parameters of Message search: q, cursor (from `next`) and page_size
+    """
+    q = serializers.CharField(max_length=200)
+    cursor = serializers.CharField(required=False)
+    page_size = serializers.IntegerField(required=False, min_value=1)
+
+    def validate_q(self, value):
+        terms = parse_terms(value)
+        if not terms:
+            raise serializers.ValidationError('Enter at least one word to search for.')
+        return terms
+
+    def validate_cursor(self, value):
+        try:
+            return decode_cursor(value)
+        except ValueError:
+            raise serializers.ValidationError('Invalid cursor.')
+
+    def validate_page_size(self, value):
+        return min(value, get_search_config()['MAX_PAGE_SIZE'])
+
+
+class MessageSearchResultSerializer(MeasuredSerializerMixin, serializers.ModelSerializer):
+    """
+    Serializer for a Message search hit, snippet marks the matches with <mark></mark>
+    """
+    snippet = serializers.ReadOnlyField()
+    rank = serializers.ReadOnlyField()
+
+    class Meta:
+        model = Message
+        fields = ('id', 'thread', 'sender', 'text', 'created', 'snippet', 'rank')
+
+
+class ThreadExportSerializer(serializers.Serializer):
+    """
+    Query parameters of Thread export: format and the Message id to resume after
+    """
+    format = serializers.ChoiceField(choices=tuple(export.FORMATS), default='ndjson')
+    after = serializers.IntegerField(required=False, min_value=0)
 
 
-class ThreadSerializer(serializers.ModelSerializer):
+class MessageImportSerializer(serializers.Serializer):
+    """
+    Serializer for one Message of a bulk import, sent by `sender` (a participant of `thread`);
+    created defaults to now
+    """
+    thread = serializers.IntegerField(min_value=1)
+    sender = serializers.IntegerField(min_value=1)
+    text = serializers.CharField()
+    created = serializers.DateTimeField(required=False)
+    is_read = serializers.BooleanField(required=False, default=False)
+
+
+class MessageBatchSerializer(serializers.Serializer):
+    """
+    Serializer for bulk import of Messages into any Threads
+    {
+        "messages": [{"thread": 1, "sender": 2, "text": "text", "created": "..." (optional), "is_read": false}, ...]
+    }
+    """
+    messages = MessageImportSerializer(many=True, allow_empty=False)
+
+    def validate_messages(self, messages):
+        max_batch_size = ingest.get_config()['MAX_BATCH_SIZE']
+        if len(messages) > max_batch_size:
+            raise serializers.ValidationError(f'Ensure this field has no more than {max_batch_size} elements.')
+        members = ingest.memberships({message['thread'] for message in messages})
+        errors = {
+            index: {'sender': ["Thread does not exist or the sender is not the member of it"]}
+            for index, message in enumerate(messages) if (message['thread'], message['sender']) not in members
+        }
+        if errors:
+            raise serializers.ValidationError(errors)
+        return messages
+
+    def create(self, validated_data):
+        return ingest.ingest_messages(validated_data['messages'])
+
+
+class ThreadSerializer(MeasuredSerializerMixin, serializers.ModelSerializer):
     """
     Serializer for Thread
     """
     last_message = serializers.SerializerMethodField()
+    unread_count = serializers.SerializerMethodField()
 
     class Meta:
         model = Thread
-        fields = ('id', 'participants', 'created', 'updated', 'last_message')
+        fields = ('id', 'participants', 'created', 'updated', 'last_message', 'unread_count')
 
     def create(self, validated_data):
         valid_participants = validated_data.get('participants')
         if len(valid_participants) != 2:
             raise serializers.ValidationError("The thread can only have 2 participants")
-        thread = Thread.objects.filter(participants=valid_participants[0]).filter(participants=valid_participants[1]).first()
+        pair_key = Thread.make_pair_key(participant.id for participant in valid_participants)
+        thread = Thread.objects.filter(pair_key=pair_key).first()
         if not thread:
-            thread = Thread.objects.create()
-            thread.participants.set(valid_participants)
-            thread.save()
+            try:
+                with serialized_write():
+                    thread = Thread.objects.create(pair_key=pair_key)
+                    thread.participants.set(valid_participants)
+                    cache.invalidate_thread(thread.id, [participant.id for participant in valid_participants])
+            except IntegrityError:
+                # A concurrent request has just created the Thread of this pair
+                thread = Thread.objects.get(pair_key=pair_key)
         return thread
 
+    def update(self, instance, validated_data):
+        participants = validated_data.get('participants')
+        if participants is not None:
+            former_ids = list(instance.participants.values_list('id', flat=True))
+            instance.pair_key = None
+            if len(participants) == 2:
+                instance.pair_key = Thread.make_pair_key(participant.id for participant in participants)
+        try:
+            with serialized_write():
+                thread = super(ThreadSerializer, self).update(instance, validated_data)
+        except IntegrityError:
+            raise serializers.ValidationError("The thread of these participants already exists")
+        if participants is not None:
+            cache.invalidate_thread(thread.id, former_ids + [participant.id for participant in participants])
+        else:
+            cache.invalidate_thread(thread.id)
+        return thread
+
+    def to_representation(self, instance):
+        data = super(ThreadSerializer, self).to_representation(instance)
+        if 'participants' in self.context.get('expand', ()):
+            data['participants'] = UserSerializer(instance.participants.all(), many=True).data
+        return data
+
     @staticmethod
     def get_last_message(obj):
-        last_message = obj.messages.last()
-        if last_message:
-            return MessageSerializer(last_message).data
-        return None
+        if obj.last_message_id is None:
+            return None
+        return MessageSerializer(obj.last_message).data
+
+    def get_unread_count(self, obj):
+        if hasattr(obj, 'unread_count'):
+            return obj.unread_count
+        request = self.context.get('request')
+        if request is None or not request.user.is_authenticated:
+            return 0
+        state = ThreadReadState.objects.filter(thread=obj, user_id=request.user.id).values_list('unread_count', flat=True)
+        return state.first() or 0
 
 
 class UserRegisterSerializer(serializers.ModelSerializer):
@@ -96,3 +245,30 @@ class UserRegisterSerializer(serializers.ModelSerializer):
         user.set_password(password)
         user.save()
         return user
+
+
+class TokenObtainPairSerializer(jwt_serializers.TokenObtainPairSerializer):
+    """
+    Serializer for JWT-Auth, puts the claims read by TokenUser into the tokens
+    """
+    @classmethod
+    def get_token(cls, user):
+        token = super().get_token(user)
+        token['username'] = user.username
+        token['is_staff'] = user.is_staff
+        token['is_superuser'] = user.is_superuser
+        return token
+
+
+class TokenRefreshSerializer(jwt_serializers.TokenRefreshSerializer):
+    """
+    Serializer for JWT refresh, only for users that still exist and are active:
+    refreshes are rare enough to read the User row, which also catches users
+    deactivated without the post_save signal (QuerySet.update())
+    """
+    def validate(self, attrs):
+        user_id = self.token_class(attrs['refresh']).get(jwt_settings.USER_ID_CLAIM)
+        active = User.objects.filter(**{jwt_settings.USER_ID_FIELD: user_id, 'is_active': True})
+        if user_id is None or is_revoked(user_id) or not active.exists():
+            raise AuthenticationFailed('User is inactive', code='user_inactive')
+        return super().validate(attrs)
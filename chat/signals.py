@@ -0,0 +1,55 @@
+from django.contrib.auth.models import User
+from django.db.backends.signals import connection_created
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from chat.authentication import restore_user, revoke_user
+from chat.models import Thread, ThreadReadState
+from chat.permissions import forget_members
+from chat.sqlite import configure_connection
+
+
+@receiver(post_save, sender=User)
+def sync_user_revocation(sender, instance, created, **kwargs):
+    if instance.is_active:
+        if not created:
+            restore_user(instance.id)
+    else:
+        revoke_user(instance.id)
+
+
+@receiver(post_delete, sender=User)
+def revoke_deleted_user(sender, instance, **kwargs):
+    revoke_user(instance.id)
+
+
+@receiver(m2m_changed, sender=Thread.participants.through)
+def forget_thread_members(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ('post_add', 'post_remove'):
+        forget_members(pk_set if reverse else [instance.pk])
+    elif action == 'pre_clear':
+        forget_members(list(instance.threads.values_list('id', flat=True)) if reverse else [instance.pk])
+
+
+@receiver(m2m_changed, sender=Thread.participants.through)
+def sync_thread_read_states(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Keep one read state per participant whichever way the participants change
+    (serializers, admin, ORM)
+    """
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if reverse:
+        ThreadReadState.objects.participants_changed(instance, pk_set, action)
+    else:
+        ThreadReadState.objects.sync_participants(instance)
+
+
+@receiver(post_delete, sender=Thread)
+def forget_deleted_thread_members(sender, instance, **kwargs):
+    forget_members([instance.pk])
+
+
+@receiver(connection_created)
+def configure_sqlite_connection(sender, connection, **kwargs):
+    configure_connection(connection)
@@ -0,0 +1,70 @@
+"""
+SQLite production profile
+
+Pragmas applied to every new SQLite connection (WAL so readers never wait for
+the writer, `synchronous = NORMAL` which is durable enough with WAL and skips
+most fsyncs, a bigger page cache and memory-mapped reads) and a process-wide
+write lock: SQLite allows a single writer, so the hot write paths queue on the
+lock instead of failing with "database is locked" when their transactions
+collide; busy_timeout covers writers of other processes
+"""
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, OperationalError, connections, transaction
+
+DEFAULTS = {
+    'ENABLED': True,
+    'PRAGMAS': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,
+        'cache_size': -20000,
+        'mmap_size': 268435456,
+        'temp_store': 'MEMORY',
+    },
+    'SERIALIZE_WRITES': True,
+    # Seconds a write waits for the lock before giving up
+    'WRITE_LOCK_TIMEOUT': 30,
+}
+
+_write_lock = threading.RLock()
+
+
+def get_config():
+    config = {**DEFAULTS, **getattr(settings, 'CHAT_SQLITE', {})}
+    config['PRAGMAS'] = {**DEFAULTS['PRAGMAS'], **config['PRAGMAS']}
+    return config
+
+
+def configure_connection(connection):
+    """
+    Apply the configured pragmas to a new SQLite connection
+    """
+    config = get_config()
+    if connection.vendor != 'sqlite' or not config['ENABLED']:
+        return
+    with connection.cursor() as cursor:
+        for name, value in config['PRAGMAS'].items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+
+
+@contextmanager
+def serialized_write(using=DEFAULT_DB_ALIAS):
+    """
+    transaction.atomic() that holds the process write lock on SQLite, so
+    concurrent writers of this process run one after the other
+    """
+    config = get_config()
+    if connections[using].vendor != 'sqlite' or not config['ENABLED'] or not config['SERIALIZE_WRITES']:
+        with transaction.atomic(using=using):
+            yield
+        return
+    if not _write_lock.acquire(timeout=config['WRITE_LOCK_TIMEOUT']):
+        raise OperationalError('database is locked (timed out waiting for the write lock)')
+    try:
+        with transaction.atomic(using=using):
+            yield
+    finally:
+        _write_lock.release()
@@ -0,0 +1,31 @@
+"""
+Handlers of the outbox events (chat.outbox), each runs in the transaction
+that deletes its event
+"""
+from django.db.models import Q
+from django.utils import timezone
+
+from chat import cache
+from chat.broker import publish_to_thread
+from chat.models import Thread, Message, ThreadReadState
+from chat.permissions import get_members
+from chat.serializers import MessageSerializer
+
+
+def message_created(message_id):
+    """
+    Move the Thread of a new Message forward, count the Message as unread for
+    the other participant and notify the participants
+    """
+    message = Message.objects.filter(pk=message_id).first()
+    if message is None:
+        return
+    # An older Message handled late never moves last_message back
+    newer = Q(last_message__isnull=True) | Q(last_message_id__lt=message.id)
+    Thread.objects.filter(newer, pk=message.thread_id).update(last_message=message, updated=timezone.now())
+    if not message.is_read:
+        ThreadReadState.objects.message_created(message)
+    cache.invalidate_thread(message.thread_id, get_members(message.thread_id))
+    publish_to_thread(message.thread_id, {
+        'type': 'message.created', 'thread': message.thread_id, 'message': MessageSerializer(message).data
+    })
@@ -0,0 +1,222 @@
+"""
+Benchmarks of the chat hot paths on a large synthetic SQLite dataset
+
+They are skipped by default, run them with:
+    CHAT_BENCHMARK=1 python manage.py test chat.test_benchmarks
+CHAT_BENCHMARK_MESSAGES / CHAT_BENCHMARK_THREADS / CHAT_BENCHMARK_USERS change the dataset size
+"""
+import gzip
+import os
+import statistics
+import sys
+import time
+from unittest import skipUnless
+
+from django.contrib.auth.models import User
+from django.db import connection, reset_queries
+from django.db.models import Count
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APITestCase
+
+from chat import compression
+from chat.models import Thread, Message, ThreadReadState
+from chat.read_serializers import MessageRowSerializer, ThreadRowSerializer
+from chat.renderers import ColumnarJSONRenderer, MessagePackRenderer, msgpack
+from chat.seeding import seed_chat
+from chat.serializers import MessageSerializer, ThreadSerializer
+
+BENCHMARK_ENABLED = bool(os.environ.get('CHAT_BENCHMARK'))
+USERS = int(os.environ.get('CHAT_BENCHMARK_USERS', 200))
+THREADS = int(os.environ.get('CHAT_BENCHMARK_THREADS', 2000))
+MESSAGES = int(os.environ.get('CHAT_BENCHMARK_MESSAGES', 100000))
+REPEAT = int(os.environ.get('CHAT_BENCHMARK_REPEAT', 20))
+
+HOT_PATH_INDEXES = ('chat_msg_thread_created_idx', 'chat_msg_unread_idx', 'chat_thread_participants_user_thread_idx')
+BASELINE_INDEXES = ('CREATE INDEX bench_baseline_thread_idx ON chat_message (thread_id)',)
+
+
+def measure(call, repeat=REPEAT):
+    """
+    Return (query count, median latency in ms) of `call`, after a first call
+    warming it up (lazily created rows, per-process caches)
+    """
+    call()
+    reset_queries()
+    with CaptureQueriesContext(connection) as queries:
+        call()
+    query_count = len(queries)
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        call()
+        timings.append((time.perf_counter() - start) * 1000)
+    return query_count, statistics.median(timings)
+
+
+def report(title, header, rows):
+    out = sys.stdout
+    out.write(f'\n{title}\n')
+    widths = [max(len(str(row[i])) for row in [header] + rows) for i in range(len(header))]
+    for row in [header] + rows:
+        out.write('  '.join(str(cell).ljust(width) for cell, width in zip(row, widths)) + '\n')
+
+
+@skipUnless(BENCHMARK_ENABLED, 'set CHAT_BENCHMARK=1 to run the benchmarks')
+@override_settings(CHAT_CACHE={'ENABLED': False})
+class HotQueryBenchmark(APITestCase):
+    """
+    Per-endpoint query counts and latency with the baseline indexes ("before")
+    and with the hot path indexes ("after")
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.user_ids, cls.thread_ids = seed_chat(USERS, THREADS, MESSAGES)
+        cls.thread = Thread.objects.annotate(total=Count('messages')).order_by('-total').first()
+        cls.user = cls.thread.participants.first()
+        cls.peer = cls.thread.participants.exclude(pk=cls.user.pk).get()
+
+    def endpoints(self):
+        history = reverse('messages_list_create', kwargs={'thread_id': self.thread.id})
+        deep_page = self.client.get(history, {'page_size': 10}).data['next']
+        return [
+            ('threads list', lambda: self.client.get(reverse('threads_list_create'))),
+            ('user threads', lambda: self.client.get(reverse('user_threads', kwargs={'pk': self.user.id}))),
+            ('thread history', lambda: self.client.get(history, {'page_size': 10})),
+            ('thread history p2', lambda: self.client.get(deep_page)),
+            ('unread messages', lambda: self.client.get(reverse('messages_unread', kwargs={'pk': self.user.id}))),
+            ('unread summary', lambda: self.client.get(reverse('unread_summary', kwargs={'pk': self.user.id}))),
+            ('thread pair lookup', lambda: self.client.post(
+                reverse('threads_list_create'), {'participants': [self.user.id, self.peer.id]}
+            )),
+        ]
+
+    def swap_indexes(self, drop, create):
+        with connection.cursor() as cursor:
+            for name in drop:
+                cursor.execute(f'DROP INDEX IF EXISTS {name}')
+            for sql in create:
+                cursor.execute(sql)
+            cursor.execute('ANALYZE')
+
+    def test_hot_path_indexes(self):
+        self.client.force_authenticate(self.user)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT sql FROM sqlite_master WHERE type = %s AND name IN (%s, %s, %s)', ['index', *HOT_PATH_INDEXES]
+            )
+            hot_path_sql = [row[0] for row in cursor.fetchall()]
+        self.assertEqual(len(hot_path_sql), len(HOT_PATH_INDEXES))
+
+        self.swap_indexes(HOT_PATH_INDEXES, BASELINE_INDEXES)
+        before = [(label, *measure(call)) for label, call in self.endpoints()]
+        self.swap_indexes(['bench_baseline_thread_idx'], hot_path_sql)
+        after = [(label, *measure(call)) for label, call in self.endpoints()]
+        self.assertEqual(Thread.objects.count(), len(self.thread_ids))  # the pair lookup found the seeded Thread
+
+        rows = [
+            (label, queries_before, f'{before_ms:.2f}', queries_after, f'{after_ms:.2f}')
+            for (label, queries_before, before_ms), (_, queries_after, after_ms) in zip(before, after)
+        ]
+        report(
+            f'Hot path indexes ({MESSAGES} messages, {THREADS} threads, {USERS} users, median of {REPEAT})',
+            ('endpoint', 'queries before', 'ms before', 'queries after', 'ms after'), rows
+        )
+
+        plans = {
+            'thread history': Message.objects.filter(thread=self.thread).order_by('-created', '-id')[:50],
+            'unread by recipient': Message.objects.filter(thread=self.thread, is_read=False).exclude(sender=self.user),
+            'inbox': Thread.objects.filter(participants=self.user).values('id'),
+            'read states': ThreadReadState.objects.filter(user=self.user, unread_count__gt=0),
+        }
+        report('Query plans', ('query', 'plan'), [(label, qs.explain()) for label, qs in plans.items()])
+
+
+@skipUnless(BENCHMARK_ENABLED, 'set CHAT_BENCHMARK=1 to run the benchmarks')
+class ReadSerializerBenchmark(APITestCase):
+    """
+    Throughput of the ModelSerializers against the row serializers of chat.read_serializers
+    """
+    sizes = (1000, 10000)
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_chat(users=100, threads=max(cls.sizes), messages=max(cls.sizes))
+        cls.user = User.objects.filter(username__startswith='bench').first()
+
+    def throughput(self, call, rows, repeat=5):
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            call()
+            timings.append(time.perf_counter() - start)
+        return f'{rows / statistics.median(timings):,.0f}'
+
+    def test_read_serializers(self):
+        message_rows = MessageRowSerializer()
+        thread_rows = ThreadRowSerializer()
+        threads = Thread.objects.with_unread_count(self.user)
+        rows = []
+        for size in self.sizes:
+            messages = Message.objects.all()[:size]
+            page = threads[:size]
+            rows.append((
+                'messages', size,
+                self.throughput(lambda: MessageSerializer(messages, many=True).data, size),
+                self.throughput(lambda: message_rows.serialize_many(messages.values(*message_rows.columns)), size),
+            ))
+            rows.append((
+                'threads', size,
+                self.throughput(lambda: ThreadSerializer(page.select_related('last_message'), many=True).data, size),
+                self.throughput(lambda: thread_rows.serialize_many(page.values(*thread_rows.columns)), size),
+            ))
+        report('Read serializers (rows/s, including the queries)', ('list', 'rows', 'ModelSerializer', 'rows'), rows)
+
+
+@skipUnless(BENCHMARK_ENABLED, 'set CHAT_BENCHMARK=1 to run the benchmarks')
+class RendererBenchmark(APITestCase):
+    """
+    Bytes on the wire (raw, gzip, brotli) and encode time of the list pages with
+    the compact renderers of chat.renderers against the default JSONRenderer
+    """
+    sizes = (20, 100, 1000)
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_chat(users=100, threads=max(cls.sizes), messages=max(cls.sizes) * 2)
+        cls.user = User.objects.filter(username__startswith='bench').first()
+
+    def encode_ms(self, call, repeat=REPEAT):
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            call()
+            timings.append((time.perf_counter() - start) * 1000)
+        return f'{statistics.median(timings):.2f}'
+
+    def test_renderers(self):
+        renderers = [('json', JSONRenderer()), ('columnar', ColumnarJSONRenderer())]
+        if msgpack is not None:
+            renderers.append(('msgpack', MessagePackRenderer()))
+        message_rows = MessageRowSerializer()
+        thread_rows = ThreadRowSerializer()
+        threads = Thread.objects.with_unread_count(self.user)
+        rows = []
+        for size in self.sizes:
+            pages = [
+                ('messages', message_rows.serialize_many(Message.objects.values(*message_rows.columns)[:size])),
+                ('threads', thread_rows.serialize_many(threads.values(*thread_rows.columns)[:size])),
+            ]
+            for name, page in pages:
+                data = {'next': None, 'previous': None, 'results': page}
+                for format, renderer in renderers:
+                    body = renderer.render(data)
+                    rows.append((
+                        name, size, format, len(body), len(gzip.compress(body, 6)),
+                        len(compression.brotli.compress(body, quality=5)) if compression.brotli else '-',
+                        self.encode_ms(lambda: renderer.render(data)),
+                    ))
+        report('Renderers (bytes on the wire, median encode ms)',
+               ('list', 'rows', 'format', 'raw', 'gzip', 'br', 'encode ms'), rows)
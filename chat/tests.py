@@ -1,12 +1,67 @@
+import asyncio
+import csv
+import gzip
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from io import StringIO
+from unittest import mock, skipUnless
+
+from asgiref.sync import async_to_sync, sync_to_async
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured, MiddlewareNotUsed
+from django.core.management import call_command
+from django.db import connection, connections
+from django.http import HttpResponse, StreamingHttpResponse
+from django.test import RequestFactory, SimpleTestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
+from django.utils.http import http_date
+from rest_framework.renderers import JSONRenderer
 from rest_framework.test import APITestCase, APIClient
 from rest_framework import status
+from rest_framework_simplejwt.tokens import AccessToken
 from django.contrib.auth.models import User
-from chat.models import Thread, Message
+from DRF_Chat import settings as project_settings
+from chat import archive, cache, compression, export, metrics, outbox, renderers, tasks, throttling
+from chat.authentication import revocation_cache, revoke_user, user_cache
+from chat.checks import check_throttle_store
+from chat.loadtest import percentile
+from chat.routers import ReplicaRouter, ReplicaRoutingMiddleware, use_primary
+from chat.seeding import seed_chat
+from chat.models import Thread, Message, ArchivedMessage, OutboxEvent, ThreadReadState
+from chat.permissions import get_members
+from chat.consumers import websocket_application, CLOSE_UNAUTHORIZED
+from chat.read_serializers import MessageRowSerializer, ThreadRowSerializer
+from chat.renderers import ColumnarJSONRenderer, MessagePackRenderer
 from chat.serializers import ThreadSerializer, MessageSerializer
+from chat.views import MessageReadView
+
 
+@override_settings(CHAT_OUTBOX={'MODE': 'sync'})
+class ChatAPITestCase(APITestCase):
+    """
+    APITestCase starting every test with an empty chat cache (ids are reused between tests),
+    side effects of writes are handled synchronously
+    """
+    def _pre_setup(self):
+        super()._pre_setup()
+        for alias in settings.CACHES:
+            caches[alias].clear()
+        cache.clear()
+        user_cache.clear()
+        revocation_cache.clear()
+        throttling.reset()
 
-class UserRegistrationViewTestCase(APITestCase):
+
+class UserRegistrationViewTestCase(ChatAPITestCase):
     url = reverse('user_register')
 
     def setUp(self):
@@ -36,7 +91,7 @@ class UserRegistrationViewTestCase(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
 
-class ThreadListCreateViewTestCase(APITestCase):
+class ThreadListCreateViewTestCase(ChatAPITestCase):
     url = reverse('threads_list_create')
 
     def setUp(self):
@@ -53,6 +108,14 @@ class ThreadListCreateViewTestCase(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
         self.assertEqual(Thread.objects.count(), 1)
 
+    def test_thread_create_returns_existing_pair(self):
+        self.client.force_authenticate(user=self.user1)
+        first = self.client.post(self.url, self.thread_payload)
+        second = self.client.post(self.url, {'participants': [self.user2.id, self.user1.id]})
+        self.assertEqual(first.data['id'], second.data['id'])
+        self.assertEqual(Thread.objects.count(), 1)
+        self.assertEqual(Thread.objects.get().pair_key, f'{self.user1.id}:{self.user2.id}')
+
     def test_create_thread_invalid_payload(self):
         self.client.force_authenticate(user=self.user1)
         invalid_payload = {
@@ -67,7 +130,7 @@ class ThreadListCreateViewTestCase(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
 
-class ThreadUpdateDeleteViewTestCase(APITestCase):
+class ThreadUpdateDeleteViewTestCase(ChatAPITestCase):
     def setUp(self):
         self.client = APIClient()
         self.user1 = User.objects.create_user(username='user1', password='pass123')
@@ -84,6 +147,18 @@ class ThreadUpdateDeleteViewTestCase(APITestCase):
         response = self.client.put(reverse('threads_update_delete', kwargs={'pk': self.thread.pk}), data=data)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(Thread.objects.get(pk=self.thread.pk).participants.count(), 2)
+        self.assertEqual(Thread.objects.get(pk=self.thread.pk).pair_key, f'{self.user1.id}:{self.user3.id}')
+
+    def test_thread_update_to_existing_pair(self):
+        other = Thread.objects.create(pair_key=Thread.make_pair_key([self.user1.id, self.user3.id]))
+        other.participants.add(self.user1, self.user3)
+        self.client.force_authenticate(self.user1)
+        data = {
+            'participants': [self.user1.id, self.user3.id]
+        }
+        response = self.client.put(reverse('threads_update_delete', kwargs={'pk': self.thread.pk}), data=data)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Thread.objects.get(pk=self.thread.pk).participants.count(), 2)
 
     def test_thread_delete_view(self):
         self.client.force_authenticate(self.user1)
@@ -92,7 +167,7 @@ class ThreadUpdateDeleteViewTestCase(APITestCase):
         self.assertEqual(Thread.objects.count(), 0)
 
 
-class MessageListCreateViewTestCase(APITestCase):
+class MessageListCreateViewTestCase(ChatAPITestCase):
     def setUp(self):
         self.user1 = User.objects.create_user(username='user1', password='pass123')
         self.user2 = User.objects.create_user(username='user2', password='pass123')
@@ -122,7 +197,7 @@ class MessageListCreateViewTestCase(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
 
 
-class MessageReadViewTestCase(APITestCase):
+class MessageReadViewTestCase(ChatAPITestCase):
     def setUp(self):
         self.user1 = User.objects.create_user(username='user1', password='pass123')
         self.user2 = User.objects.create_user(username='user2', password='pass123')
@@ -137,6 +212,18 @@ class MessageReadViewTestCase(APITestCase):
         self.assertTrue(response.data.get('is_read', False))
         self.assertEqual(response.data.get('sender'), self.user1.id)
 
+    def test_read_counted_once(self):
+        Message.objects.create(sender=self.user1, thread=self.thread, text='second message')
+        ThreadReadState.objects.sync_participants(self.thread)
+        ThreadReadState.objects.filter(thread=self.thread, user=self.user2).update(unread_count=2)
+        stale = Message.objects.get(pk=self.message.pk)  # loaded before the first read (replica, concurrent GET)
+        url = reverse('message_read', kwargs={'thread_id': self.thread.id, 'pk': self.message.id})
+        self.client.force_authenticate(self.user2)
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_200_OK)
+        with mock.patch.object(MessageReadView, 'get_object', return_value=stale):
+            self.assertEqual(self.client.get(url).status_code, status.HTTP_200_OK)
+        self.assertEqual(ThreadReadState.objects.get(thread=self.thread, user=self.user2).unread_count, 1)
+
     def test_read_message_by_sender(self):
         self.client.force_authenticate(self.user1)
         response = self.client.get(reverse('message_read', kwargs={'thread_id': self.thread.id, 'pk': self.message.id}))
@@ -152,12 +239,1418 @@ class MessageReadViewTestCase(APITestCase):
         self.assertIsNone(response.data.get('sender'))
 
 
+class ThreadLastMessageTestCase(ChatAPITestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='user1', password='pass123')
+        self.user2 = User.objects.create_user(username='user2', password='pass123')
+        self.thread = Thread.objects.create()
+        self.thread.participants.add(self.user1, self.user2)
+        self.url = reverse('messages_list_create', kwargs={'thread_id': self.thread.id})
+
+    def test_last_message_follows_newest_message(self):
+        self.client.force_authenticate(self.user1)
+        self.client.post(self.url, {'text': 'first'})
+        response = self.client.post(self.url, {'text': 'second'})
+        self.thread.refresh_from_db()
+        self.assertEqual(self.thread.last_message_id, response.data['id'])
+
+        response = self.client.get(reverse('threads_list_create'))
+        self.assertEqual(response.data['results'][0]['last_message']['text'], 'second')
+
+    def test_delete_last_message_falls_back(self):
+        self.client.force_authenticate(self.user1)
+        first = self.client.post(self.url, {'text': 'first'}).data
+        second = self.client.post(self.url, {'text': 'second'}).data
+        self.client.delete(reverse('message_read', kwargs={'thread_id': self.thread.id, 'pk': second['id']}))
+        self.thread.refresh_from_db()
+        self.assertEqual(self.thread.last_message_id, first['id'])
+
+    def test_rebuild_thread_state_command(self):
+        Message.objects.create(sender=self.user1, thread=self.thread, text='old')
+        newest = Message.objects.create(sender=self.user2, thread=self.thread, text='new')
+        self.assertIsNone(Thread.objects.get(pk=self.thread.pk).last_message_id)
+        call_command('rebuild_thread_state', stdout=StringIO())
+        self.assertEqual(Thread.objects.get(pk=self.thread.pk).last_message_id, newest.id)
+
+
+class ThreadReadStateTestCase(ChatAPITestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='user1', password='pass123')
+        self.user2 = User.objects.create_user(username='user2', password='pass123')
+        self.client.force_authenticate(self.user1)
+        response = self.client.post(reverse('threads_list_create'), {'participants': [self.user1.id, self.user2.id]})
+        self.thread = Thread.objects.get(pk=response.data['id'])
+        self.url = reverse('messages_list_create', kwargs={'thread_id': self.thread.id})
+
+    def test_unread_count_follows_create_and_read(self):
+        first = self.client.post(self.url, {'text': 'first'}).data
+        self.client.post(self.url, {'text': 'second'})
+
+        self.client.force_authenticate(self.user2)
+        response = self.client.get(reverse('threads_list_create'))
+        self.assertEqual(response.data['results'][0]['unread_count'], 2)
+
+        self.client.get(reverse('message_read', kwargs={'thread_id': self.thread.id, 'pk': first['id']}))
+        self.client.get(reverse('message_read', kwargs={'thread_id': self.thread.id, 'pk': first['id']}))
+        state = ThreadReadState.objects.get(thread=self.thread, user=self.user2)
+        self.assertEqual(state.unread_count, 1)
+        self.assertEqual(state.last_read_message_id, first['id'])
+
+        response = self.client.get(reverse('threads_list_create'))
+        self.assertEqual(response.data['results'][0]['unread_count'], 1)
+        self.client.force_authenticate(self.user1)
+        response = self.client.get(reverse('threads_list_create'))
+        self.assertEqual(response.data['results'][0]['unread_count'], 0)
+
+    def test_unread_summary(self):
+        self.client.post(self.url, {'text': 'first'})
+        self.client.post(self.url, {'text': 'second'})
+        response = self.client.get(reverse('unread_summary', kwargs={'pk': self.user2.id}))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)  # the counters of someone else
+        self.client.force_authenticate(self.user2)
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('unread_summary', kwargs={'pk': self.user2.id}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['total_unread'], 2)
+        self.assertEqual(response.data['threads'], [{'thread': self.thread.id, 'unread_count': 2}])
+
+    def test_rebuild_thread_state_command(self):
+        Message.objects.create(sender=self.user1, thread=self.thread, text='unread')
+        Message.objects.create(sender=self.user1, thread=self.thread, text='read', is_read=True)
+        ThreadReadState.objects.filter(thread=self.thread).delete()
+        call_command('rebuild_thread_state', stdout=StringIO())
+        self.assertEqual(ThreadReadState.objects.get(thread=self.thread, user=self.user2).unread_count, 1)
+        self.assertEqual(ThreadReadState.objects.get(thread=self.thread, user=self.user1).unread_count, 0)
+
+    def test_read_states_follow_orm_participant_changes(self):
+        user3 = User.objects.create_user(username='user3', password='pass123')
+        thread = Thread.objects.create()
+        thread.participants.add(self.user1, user3)
+        self.assertEqual(set(ThreadReadState.objects.filter(thread=thread).values_list('user_id', flat=True)),
+                         {self.user1.id, user3.id})
+        self.client.post(reverse('messages_list_create', kwargs={'thread_id': thread.id}), {'text': 'hello'})
+        self.assertEqual(ThreadReadState.objects.get(thread=thread, user=user3).unread_count, 1)
+
+        thread.participants.remove(user3)
+        self.assertFalse(ThreadReadState.objects.filter(thread=thread, user=user3).exists())
+        user3.threads.add(thread)
+        self.assertTrue(ThreadReadState.objects.filter(thread=thread, user=user3).exists())
+        user3.threads.clear()
+        self.assertFalse(ThreadReadState.objects.filter(user=user3).exists())
+        thread.participants.clear()
+        self.assertFalse(ThreadReadState.objects.filter(thread=thread).exists())
+
+
+class MessageCursorPaginationTestCase(ChatAPITestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='user1', password='pass123')
+        self.user2 = User.objects.create_user(username='user2', password='pass123')
+        self.thread = Thread.objects.create()
+        self.thread.participants.add(self.user1, self.user2)
+        self.messages = [
+            Message.objects.create(sender=self.user1, thread=self.thread, text=f'message {i}') for i in range(7)
+        ]
+        self.url = reverse('messages_list_create', kwargs={'thread_id': self.thread.id})
+
+    def test_pages_walk_history_from_newest(self):
+        self.client.force_authenticate(self.user1)
+        seen = []
+        url = self.url
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            seen += [message['id'] for message in response.data['results']]
+            url = response.data['next']
+        self.assertEqual(seen, [message.id for message in reversed(self.messages)])
+
+    def test_page_size_and_previous_cursor(self):
+        self.client.force_authenticate(self.user1)
+        first = self.client.get(self.url, {'page_size': 4})
+        self.assertEqual(len(first.data['results']), 4)
+        self.assertIsNone(first.data['previous'])
+        older = self.client.get(first.data['next'])
+        self.assertEqual(len(older.data['results']), 3)
+        Message.objects.create(sender=self.user2, thread=self.thread, text='new arrival')
+        newer = self.client.get(older.data['previous'])
+        self.assertEqual(newer.data['results'], first.data['results'])
+
+    def test_tied_timestamps(self):
+        Message.objects.filter(thread=self.thread).update(created=timezone.now())
+        self.client.force_authenticate(self.user1)
+        pages, url = [], self.url + '?page_size=2'
+        while url:
+            response = self.client.get(url)
+            pages.append(response)
+            url = response.data['next']
+        seen = [message['id'] for page in pages for message in page.data['results']]
+        self.assertEqual(seen, [message.id for message in reversed(self.messages)])
+        previous = self.client.get(pages[-1].data['previous'])
+        self.assertEqual(previous.data['results'], pages[-2].data['results'])
+
+    def test_invalid_cursor(self):
+        self.client.force_authenticate(self.user1)
+        response = self.client.get(self.url, {'cursor': 'cD1ub3BlJTdD'})  # p=nope|
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class WebSocketTestCase(ChatAPITestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='user1', password='pass123')
+        self.user2 = User.objects.create_user(username='user2', password='pass123')
+        self.thread = Thread.objects.create()
+        self.thread.participants.add(self.user1, self.user2)
+
+    def connect(self, token, scenario):
+        async def run():
+            incoming, outgoing = asyncio.Queue(), asyncio.Queue()
+            scope = {'type': 'websocket', 'path': '/ws/chat/', 'query_string': f'token={token}'.encode()}
+            await incoming.put({'type': 'websocket.connect'})
+            socket = asyncio.ensure_future(websocket_application(scope, incoming.get, outgoing.put))
+            try:
+                return await scenario(incoming, lambda: asyncio.wait_for(outgoing.get(), 1))
+            finally:
+                await incoming.put({'type': 'websocket.disconnect'})
+                await asyncio.wait_for(socket, 1)
+        return async_to_sync(run)()
+
+    def post_message(self):
+        self.client.force_authenticate(self.user1)
+        with self.captureOnCommitCallbacks(execute=True):
+            url = reverse('messages_list_create', kwargs={'thread_id': self.thread.id})
+            return self.client.post(url, {'text': 'pushed'}).data
+
+    def test_push_new_message_to_participant(self):
+        async def scenario(incoming, sent):
+            self.assertEqual((await sent())['type'], 'websocket.accept')
+            message = await sync_to_async(self.post_message)()
+            event = json.loads((await sent())['text'])
+            self.assertEqual(event['type'], 'message.created')
+            self.assertEqual(event['message']['id'], message['id'])
+            await incoming.put({'type': 'websocket.receive', 'text': json.dumps({'type': 'ping'})})
+            self.assertEqual(json.loads((await sent())['text']), {'type': 'pong'})
+
+        self.connect(AccessToken.for_user(self.user2), scenario)
+
+    def test_malformed_frames_are_ignored(self):
+        async def scenario(incoming, sent):
+            self.assertEqual((await sent())['type'], 'websocket.accept')
+            for text in ('not json', '[1, 2]', '"ping"', '{"type": "ping"'):
+                await incoming.put({'type': 'websocket.receive', 'text': text})
+            await incoming.put({'type': 'websocket.receive', 'text': json.dumps({'type': 'ping'})})
+            self.assertEqual(json.loads((await sent())['text']), {'type': 'pong'})
+
+        self.connect(AccessToken.for_user(self.user2), scenario)
+
+    def test_reject_invalid_token(self):
+        async def scenario(incoming, sent):
+            self.assertEqual(await sent(), {'type': 'websocket.close', 'code': CLOSE_UNAUTHORIZED})
+
+        self.connect('invalid', scenario)
+
+
+class MessagesSinceViewTestCase(ChatAPITestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='user1', password='pass123')
+        self.user2 = User.objects.create_user(username='user2', password='pass123')
+        self.user3 = User.objects.create_user(username='user3', password='pass123')
+        self.thread = Thread.objects.create()
+        self.thread.participants.add(self.user1, self.user2)
+        self.message = Message.objects.create(sender=self.user1, thread=self.thread, text='first')
+        self.url = reverse('messages_since', kwargs={'thread_id': self.thread.id, 'message_id': 0})
+        self.auth = {'HTTP_AUTHORIZATION': f'Bearer {AccessToken.for_user(self.user2)}'}
+
+    def test_returns_existing_messages_immediately(self):
+        response = self.client.get(self.url, **self.auth)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([message['id'] for message in response.json()['results']], [self.message.id])
+        self.assertEqual(response.json()['last_message_id'], self.message.id)
+
+    def test_times_out_without_new_messages(self):
+        url = reverse('user_messages_since', kwargs={'pk': self.user2.id, 'message_id': self.message.id})
+        response = self.client.get(url, {'timeout': 0}, **self.auth)
+        self.assertEqual(response.json(), {'results': [], 'last_message_id': self.message.id})
+
+    def test_wakes_up_on_new_message(self):
+        url = reverse('messages_since', kwargs={'thread_id': self.thread.id, 'message_id': self.message.id})
+
+        def post_message():
+            self.client.force_authenticate(self.user1)
+            with self.captureOnCommitCallbacks(execute=True):
+                thread_url = reverse('messages_list_create', kwargs={'thread_id': self.thread.id})
+                return self.client.post(thread_url, {'text': 'second'}).data
 
+        async def scenario():
+            headers = {'Authorization': self.auth['HTTP_AUTHORIZATION']}
+            waiting = asyncio.ensure_future(self.async_client.get(url, {'timeout': 5}, headers=headers))
+            await asyncio.sleep(0.1)
+            self.assertFalse(waiting.done())
+            message = await sync_to_async(post_message)()
+            response = await asyncio.wait_for(waiting, 1)
+            self.assertEqual([item['id'] for item in response.json()['results']], [message['id']])
 
+        async_to_sync(scenario)()
+
+    def test_not_participant_and_unauthenticated(self):
+        auth = {'HTTP_AUTHORIZATION': f'Bearer {AccessToken.for_user(self.user3)}'}
+        self.assertEqual(self.client.get(self.url, **auth).status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class ThreadReadViewTestCase(ChatAPITestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='user1', password='pass123')
+        self.user2 = User.objects.create_user(username='user2', password='pass123')
+        self.user3 = User.objects.create_user(username='user3', password='pass123')
+        self.client.force_authenticate(self.user1)
+        response = self.client.post(reverse('threads_list_create'), {'participants': [self.user1.id, self.user2.id]})
+        self.thread = Thread.objects.get(pk=response.data['id'])
+        url = reverse('messages_list_create', kwargs={'thread_id': self.thread.id})
+        self.messages = [self.client.post(url, {'text': f'message {i}'}).data['id'] for i in range(5)]
+        self.url = reverse('thread_read', kwargs={'thread_id': self.thread.id})
+
+    def test_read_up_to_message(self):
+        self.client.force_authenticate(self.user2)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(self.url, {'message_id': self.messages[2]})
+        updates = [query for query in queries if query['sql'].startswith('UPDATE "chat_message"')]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['marked_read'], 3)
+        self.assertEqual(Message.objects.filter(is_read=False).count(), 2)
+        state = ThreadReadState.objects.get(thread=self.thread, user=self.user2)
+        self.assertEqual((state.unread_count, state.last_read_message_id), (2, self.messages[2]))
+
+        response = self.client.post(self.url)
+        self.assertEqual(response.data['marked_read'], 2)
+        self.assertEqual(response.data['last_read_message_id'], self.messages[-1])
+        self.assertEqual(ThreadReadState.objects.get(thread=self.thread, user=self.user2).unread_count, 0)
+
+    def test_watermark_is_clamped_to_thread(self):
+        other = Thread.objects.create()
+        other.participants.add(self.user1, self.user2)
+        foreign = Message.objects.create(sender=self.user1, thread=other, text='elsewhere')
+        self.client.force_authenticate(self.user2)
+        response = self.client.post(self.url, {'message_id': foreign.id + 1000})
+        self.assertEqual(response.data['marked_read'], 5)
+        self.assertEqual(response.data['last_read_message_id'], self.messages[-1])
+        state = ThreadReadState.objects.get(thread=self.thread, user=self.user2)
+        self.assertEqual(state.last_read_message_id, self.messages[-1])
+
+        response = self.client.post(self.url, {'message_id': foreign.id})
+        self.assertEqual(response.data['last_read_message_id'], self.messages[-1])
+        self.assertFalse(Message.objects.get(pk=foreign.pk).is_read)
+
+    def test_sender_and_stranger(self):
+        response = self.client.post(self.url)
+        self.assertEqual(response.data['marked_read'], 0)
+        self.assertFalse(Message.objects.filter(is_read=True).exists())
+        self.client.force_authenticate(self.user3)
+        self.assertEqual(self.client.post(self.url).status_code, status.HTTP_404_NOT_FOUND)
+
+
+class ThreadCacheTestCase(ChatAPITestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='user1', password='pass123')
+        self.user2 = User.objects.create_user(username='user2', password='pass123')
+        self.admin = User.objects.create_user(username='admin', password='pass123', is_staff=True)
+        self.thread = Thread.objects.create()
+        self.thread.participants.add(self.user1, self.user2)
+        self.url = reverse('messages_list_create', kwargs={'thread_id': self.thread.id})
+
+    def test_thread_list_is_cached_until_new_message(self):
+        self.client.force_authenticate(self.user2)
+        self.client.get(reverse('threads_list_create'))
+        with self.assertNumQueries(1):  # only the ETag aggregate
+            response = self.client.get(reverse('threads_list_create'))
+        self.assertIsNone(response.data['results'][0]['last_message'])
+
+        self.client.force_authenticate(self.user1)
+        self.client.post(self.url, {'text': 'hello'})
+        self.client.force_authenticate(self.user2)
+        response = self.client.get(reverse('threads_list_create'))
+        self.assertEqual(response.data['results'][0]['last_message']['text'], 'hello')
+        self.assertEqual(response.data['results'][0]['unread_count'], 1)
+
+    def test_message_page_invalidated_on_read(self):
+        message = Message.objects.create(sender=self.user1, thread=self.thread, text='hello')
+        self.client.force_authenticate(self.user2)
+        self.assertFalse(self.client.get(self.url).data['results'][0]['is_read'])
+        self.client.post(reverse('thread_read', kwargs={'thread_id': self.thread.id}), {'message_id': message.id})
+        self.assertTrue(self.client.get(self.url).data['results'][0]['is_read'])
+
+    def test_stats_for_admins_only(self):
+        self.client.force_authenticate(self.user1)
+        self.client.get(self.url)
+        self.client.get(self.url)
+        self.assertEqual(self.client.get(reverse('cache_stats')).status_code, status.HTTP_403_FORBIDDEN)
+        self.client.force_authenticate(self.admin)
+        response = self.client.get(reverse('cache_stats'))
+        self.assertEqual(response.data['messages']['hits'], 1)
+        self.assertEqual(response.data['messages']['misses'], 1)
+
+
+class ConditionalGetTestCase(ChatAPITestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='user1', password='pass123')
+        self.user2 = User.objects.create_user(username='user2', password='pass123')
+        self.thread = Thread.objects.create()
+        self.thread.participants.add(self.user1, self.user2)
+        self.url = reverse('messages_list_create', kwargs={'thread_id': self.thread.id})
+        self.client.force_authenticate(self.user1)
+        self.client.post(self.url, {'text': 'hello'})
+
+    def test_if_none_match(self):
+        for url in (reverse('threads_list_create'), self.url):
+            etag = self.client.get(url)['ETag']
+            with self.assertNumQueries(1):
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+            self.assertEqual(response['ETag'], etag)
+
+            self.client.post(self.url, {'text': 'changed'})
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_200_OK)
+
+    def test_read_changes_etag(self):
+        self.client.force_authenticate(self.user2)
+        etag = self.client.get(self.url)['ETag']
+        self.client.post(reverse('thread_read', kwargs={'thread_id': self.thread.id}))
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.data['results'][0]['is_read'])
+
+    def test_delete_is_not_hidden_by_if_modified_since(self):
+        deleted = self.client.post(self.url, {'text': 'deleted'}).data['id']
+        response = self.client.get(self.url)
+        self.assertFalse(response.has_header('Last-Modified'))
+        since, etag = http_date(), response['ETag']
+        self.client.delete(reverse('message_read', kwargs={'thread_id': self.thread.id, 'pk': deleted}))
+        response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=since)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([message['text'] for message in response.data['results']], ['hello'])
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_200_OK)
+
+
+class StatelessJWTAuthenticationTestCase(ChatAPITestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='user1', password='pass123', is_staff=True)
+        self.user2 = User.objects.create_user(username='user2', password='pass123')
+        self.thread = Thread.objects.create()
+        self.thread.participants.add(self.user1, self.user2)
+
+    def authenticate(self, username):
+        response = self.client.post(reverse('token_obtain_pair'), {'username': username, 'password': 'pass123'})
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {response.data["access"]}')
+
+    def test_no_user_query(self):
+        self.authenticate('user2')
+        self.client.get(reverse('threads_list_create'))
+        # Without token authentication the request makes the same queries, less the User one
+        force_client = APIClient()
+        force_client.force_authenticate(self.user2)
+        cache.clear()
+        with CaptureQueriesContext(connection) as baseline:
+            force_client.get(reverse('threads_list_create'))
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('threads_list_create'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(queries), len(baseline))
+        self.assertFalse([query for query in queries if 'FROM "auth_user" WHERE' in query['sql']])
+        self.assertFalse([query for query in queries if 'chat_shared_cache' in query['sql']])
+
+        url = reverse('messages_list_create', kwargs={'thread_id': self.thread.id})
+        response = self.client.post(url, {'text': 'hello'})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['sender'], self.user2.id)
+
+    def test_claims_and_revocation(self):
+        self.authenticate('user1')
+        self.assertEqual(self.client.get(reverse('cache_stats')).status_code, status.HTTP_200_OK)
+
+        self.user1.is_active = False
+        self.user1.save()
+        self.assertEqual(self.client.get(reverse('threads_list_create')).status_code, status.HTTP_401_UNAUTHORIZED)
+        self.user1.is_active = True
+        self.user1.save()
+        self.assertEqual(self.client.get(reverse('threads_list_create')).status_code, status.HTTP_200_OK)
+
+    def test_revocation_outlives_refresh_token(self):
+        with mock.patch.object(caches[settings.CHAT_AUTH['CACHE']], 'set') as cache_set:
+            revoke_user(self.user2.id)
+        lifetime = settings.SIMPLE_JWT['REFRESH_TOKEN_LIFETIME'].total_seconds()
+        self.assertGreaterEqual(cache_set.call_args.args[2], lifetime)
+
+    def test_refresh_rejects_inactive_and_deleted_users(self):
+        def refresh(username):
+            response = self.client.post(reverse('token_obtain_pair'), {'username': username, 'password': 'pass123'})
+            return lambda: self.client.post(reverse('token_refresh'), {'refresh': response.data['refresh']})
+
+        refresh_user1, refresh_user2 = refresh('user1'), refresh('user2')
+        self.assertEqual(refresh_user2().status_code, status.HTTP_200_OK)
+        # No post_save signal, no revocation: the refresh still reads the User row
+        User.objects.filter(pk=self.user2.pk).update(is_active=False)
+        self.assertEqual(refresh_user2().status_code, status.HTTP_401_UNAUTHORIZED)
+        self.user1.delete()
+        self.assertEqual(refresh_user1().status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_user_cache(self):
+        self.assertEqual(user_cache.get(self.user2.id), self.user2)
+        with self.assertNumQueries(0):
+            self.assertEqual(user_cache.get(self.user2.id), self.user2)
+        self.assertIsNone(user_cache.get(0))
+
+    @override_settings(CHAT_AUTH={'CACHE': 'shared', 'LOCAL_CACHE_SIZE': 2})
+    def test_local_caches_are_bounded(self):
+        for user_id in range(10):
+            user_cache.get(user_id)
+            revocation_cache.get(user_id)
+        self.assertEqual(list(user_cache._values), [8, 9])
+        self.assertEqual(list(revocation_cache._values), [8, 9])
+
+    def test_revocation_read_again_after_ttl(self):
+        self.authenticate('user2')
+        self.assertEqual(self.client.get(reverse('threads_list_create')).status_code, status.HTTP_200_OK)
+        # Revoked by another process: this one only learns it when its entry expires
+        caches[settings.CHAT_AUTH['CACHE']].set(f'chat:revoked:{self.user2.id}', True)
+        self.assertEqual(self.client.get(reverse('threads_list_create')).status_code, status.HTTP_200_OK)
+        with mock.patch('chat.authentication.time.monotonic', return_value=time.monotonic() + 60):
+            response = self.client.get(reverse('threads_list_create'))
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class RowSerializerTestCase(ChatAPITestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='user1', password='pass123')
+        self.user2 = User.objects.create_user(username='user2', password='pass123')
+        self.user3 = User.objects.create_user(username='user3', password='pass123')
+        self.client.force_authenticate(self.user1)
+        for peer in (self.user2, self.user3):
+            self.client.post(reverse('threads_list_create'), {'participants': [peer.id, self.user1.id]})
+        thread = Thread.objects.get(pair_key=Thread.make_pair_key([self.user1.id, self.user2.id]))
+        self.client.post(reverse('messages_list_create', kwargs={'thread_id': thread.id}), {'text': 'hello'})
+
+    def test_same_json_as_model_serializers(self):
+        threads = Thread.objects.with_unread_count(self.user1)
+        serializer = ThreadRowSerializer()
+        self.assertEqual(
+            JSONRenderer().render(serializer.serialize_many(threads.values(*serializer.columns))),
+            JSONRenderer().render(ThreadSerializer(threads.select_related('last_message'), many=True).data)
+        )
+        serializer = MessageRowSerializer()
+        self.assertEqual(
+            JSONRenderer().render(serializer.serialize_many(Message.objects.values(*serializer.columns))),
+            JSONRenderer().render(MessageSerializer(Message.objects.all(), many=True).data)
+        )
+
+    def test_participants_loaded_once_per_page(self):
+        with self.assertNumQueries(4):  # ETag aggregate, count, page, participants of the page
+            response = self.client.get(reverse('threads_list_create'))
+        self.assertEqual(len(response.data['results']), 2)
+
+
+class MessageSearchTestCase(ChatAPITestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='user1', password='pass123')
+        self.user2 = User.objects.create_user(username='user2', password='pass123')
+        self.user3 = User.objects.create_user(username='user3', password='pass123')
+        self.client.force_authenticate(self.user1)
+        self.threads = []
+        for peer in (self.user2, self.user3):
+            response = self.client.post(reverse('threads_list_create'), {'participants': [self.user1.id, peer.id]})
+            self.threads.append(response.data['id'])
+        self.post(self.threads[0], 'Dinner tonight? The pizza place near the station')
+        self.post(self.threads[0], 'pizza pizza pizza')
+        self.post(self.threads[0], 'see you tomorrow')
+        self.post(self.threads[1], 'Café with pizza, no pizzeria')
+
+    def post(self, thread_id, text):
+        url = reverse('messages_list_create', kwargs={'thread_id': thread_id})
+        return self.client.post(url, {'text': text}).data['id']
+
+    def search(self, q, thread_id=None, **params):
+        if thread_id is None:
+            url = reverse('messages_search')
+        else:
+            url = reverse('thread_messages_search', kwargs={'thread_id': thread_id})
+        return self.client.get(url, {'q': q, **params})
+
+    def test_ranked_matches_with_snippets(self):
+        response = self.search('pizza')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        results = response.data['results']
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[0]['text'], 'pizza pizza pizza')
+        self.assertIn('<mark>pizza</mark>', results[1]['snippet'])
+        self.assertEqual(self.search('cafe').data['results'][0]['thread'], self.threads[1])
+        self.assertEqual(len(self.search('pizz*').data['results']), 3)
+        self.assertEqual(len(self.search('pizza station').data['results']), 1)
 
+    def test_only_threads_of_the_participant(self):
+        self.assertEqual(len(self.search('pizza', self.threads[0]).data['results']), 2)
+        self.client.force_authenticate(self.user2)
+        self.assertEqual(len(self.search('pizza').data['results']), 2)
+        self.assertEqual(self.search('pizza', self.threads[1]).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_keyset_pagination(self):
+        for i in range(5):
+            self.post(self.threads[0], f'more pizza {i}')
+        seen = []
+        response = self.search('pizza', page_size=3)
+        while True:
+            self.assertLessEqual(len(response.data['results']), 3)
+            seen += [message['id'] for message in response.data['results']]
+            if response.data['next'] is None:
+                break
+            response = self.client.get(response.data['next'])
+        self.assertEqual(len(seen), 8)
+        self.assertEqual(len(set(seen)), 8)
+
+    def test_index_follows_deletes_and_bad_queries(self):
+        message_id = self.post(self.threads[0], 'ephemeral note')
+        self.assertEqual(len(self.search('ephemeral').data['results']), 1)
+        Message.objects.filter(pk=message_id).delete()
+        self.assertEqual(len(self.search('ephemeral').data['results']), 0)
+        self.assertEqual(self.search('"pizza" AND (NEAR').status_code, status.HTTP_200_OK)
+        self.assertEqual(self.search('?!').status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.search('pizza', cursor='nope').status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_snippets_are_escaped_in_both_backends(self):
+        message_id = self.post(self.threads[1], '<img src=x onerror=alert(1)> Pizza & <b>beer</b>')
+        for backend in ('chat.search.SQLiteFTSBackend', 'chat.search.DatabaseSearchBackend'):
+            with self.subTest(backend=backend), override_settings(CHAT_SEARCH={'BACKEND': backend}):
+                results = self.search('pizza', self.threads[1]).data['results']
+                snippet = next(message['snippet'] for message in results if message['id'] == message_id)
+                self.assertNotIn('<img', snippet)
+                self.assertNotIn('<b>', snippet)
+                self.assertIn('&lt;img', snippet)
+                self.assertIn('<mark>Pizza</mark> &amp; &lt;b&gt;beer', snippet)
+
+    def test_archived_messages_are_found(self):
+        pizza = sorted(Message.objects.filter(text__icontains='pizza').values_list('id', flat=True))
+        Message.objects.update(is_read=True)
+        self.assertEqual(archive.archive_messages(timezone.now() + timedelta(days=1)), 2)
+        for backend in ('chat.search.SQLiteFTSBackend', 'chat.search.DatabaseSearchBackend'):
+            with self.subTest(backend=backend), override_settings(CHAT_SEARCH={'BACKEND': backend}):
+                response = self.search('pizza', page_size=2)
+                seen = [message['id'] for message in response.data['results']]
+                seen += [message['id'] for message in self.client.get(response.data['next']).data['results']]
+                self.assertEqual(sorted(seen), pizza)
+                results = self.search('station').data['results']
+                self.assertEqual(len(results), 1)
+                self.assertIn('<mark>station</mark>', results[0]['snippet'])
+
+    @override_settings(CHAT_SEARCH={'BACKEND': 'chat.search.DatabaseSearchBackend'})
+    def test_database_backend(self):
+        response = self.search('pizza', page_size=2)
+        self.assertEqual([message['text'] for message in response.data['results']],
+                         ['Café with pizza, no pizzeria', 'pizza pizza pizza'])
+        self.assertEqual(len(self.client.get(response.data['next']).data['results']), 1)
+        self.assertEqual(len(self.search('pizza', self.threads[1]).data['results']), 1)
+        self.assertEqual(response.data['results'][0]['snippet'], 'Café with <mark>pizza</mark>, no pizzeria')
+
+
+class ThreadExportTestCase(ChatAPITestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='user1', password='pass123')
+        self.user2 = User.objects.create_user(username='user2', password='pass123')
+        self.user3 = User.objects.create_user(username='user3', password='pass123')
+        self.client.force_authenticate(self.user1)
+        response = self.client.post(reverse('threads_list_create'), {'participants': [self.user1.id, self.user2.id]})
+        self.thread = Thread.objects.get(pk=response.data['id'])
+        url = reverse('messages_list_create', kwargs={'thread_id': self.thread.id})
+        texts = ['hello', 'multi\nline, "quoted"', 'bye']
+        self.messages = [self.client.post(url, {'text': text}).data for text in texts]
+        self.url = reverse('thread_export', kwargs={'thread_id': self.thread.id})
+
+    def content(self, response):
+        return b''.join(response.streaming_content).decode()
+
+    def test_ndjson_resumable(self):
+        response = self.client.get(self.url)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson; charset=utf-8')
+        lines = [json.loads(line) for line in self.content(response).splitlines()]
+        self.assertEqual(lines, [json.loads(json.dumps(message)) for message in self.messages])
+
+        response = self.client.get(self.url, {'after': self.messages[0]['id']})
+        self.assertEqual(len(self.content(response).splitlines()), 2)
+
+    def test_csv(self):
+        response = self.client.get(self.url, {'format': 'csv'})
+        self.assertEqual(response['Content-Disposition'], f'attachment; filename="thread-{self.thread.id}.csv"')
+        rows = list(csv.DictReader(StringIO(self.content(response))))
+        self.assertEqual([row['text'] for row in rows], [message['text'] for message in self.messages])
+        self.assertEqual(rows[0]['created'], self.messages[0]['created'])
+
+    def test_errors(self):
+        self.assertEqual(self.client.get(self.url, {'format': 'xml'}).status_code, status.HTTP_400_BAD_REQUEST)
+        self.client.force_authenticate(self.user3)
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_streamed_under_asgi(self):
+        iter_messages, stream = export.iter_messages, export.stream
+        read = []
+
+        def counted(*args, **kwargs):
+            for message in iter_messages(*args, **kwargs):
+                read.append(message['id'])
+                yield message
+
+        async def first_chunk():
+            token = AccessToken.for_user(self.user1)
+            response = await self.async_client.get(self.url, headers={'Authorization': f'Bearer {token}'})
+            self.assertTrue(response.is_async)
+            chunks = response.streaming_content
+            chunk = await chunks.__anext__()
+            sent_after = len(read)
+            rest = [chunk async for chunk in chunks]
+            return sent_after, b''.join([chunk] + rest)
+
+        with mock.patch('chat.export.iter_messages', counted), \
+                mock.patch('chat.export.stream', lambda messages, format: stream(messages, format, chunk_size=1)):
+            sent_after, content = async_to_sync(first_chunk)()
+        # The first line went out before the rest of the Thread was read
+        self.assertEqual(sent_after, 1)
+        self.assertEqual([json.loads(line)['id'] for line in content.splitlines()],
+                         [message['id'] for message in self.messages])
+
+    def test_export_threads_command(self):
+        out = StringIO()
+        call_command('export_threads', '--thread', str(self.thread.id), '--chunk-size', '2', stdout=out)
+        self.assertEqual([json.loads(line)['id'] for line in out.getvalue().splitlines()],
+                         [message['id'] for message in self.messages])
+
+
+class MessageBatchTestCase(ChatAPITestCase):
+    url = reverse('messages_batch')
+
+    def setUp(self):
+        self.admin = User.objects.create_user(username='admin', password='pass123', is_staff=True)
+        self.user1 = User.objects.create_user(username='user1', password='pass123')
+        self.user2 = User.objects.create_user(username='user2', password='pass123')
+        self.user3 = User.objects.create_user(username='user3', password='pass123')
+        self.client.force_authenticate(self.user1)
+        self.threads = [
+            self.client.post(reverse('threads_list_create'), {'participants': [self.user1.id, peer.id]}).data['id']
+            for peer in (self.user2, self.user3)
+        ]
+        self.client.force_authenticate(self.admin)
+
+    def batch(self, count):
+        return [
+            {'thread': self.threads[i % 2], 'sender': self.user1.id if i % 3 else (self.user2.id, self.user3.id)[i % 2],
+             'text': f'imported {i}', 'created': f'2020-01-01T00:{i // 60:02d}:{i % 60:02d}Z'}
+            for i in range(count)
+        ]
+
+    def test_import_keeps_threads_consistent(self):
+        with CaptureQueriesContext(connection) as small:
+            self.client.post(self.url, {'messages': self.batch(10)}, format='json')
+        Message.objects.all().delete()
+        ThreadReadState.objects.rebuild(Thread.objects.all())
+        with CaptureQueriesContext(connection) as large:
+            response = self.client.post(self.url, {'messages': self.batch(300)}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data, {'created': 300, 'threads': sorted(self.threads)})
+        # Only the INSERTs depend on the size of the batch
+        self.assertEqual(
+            len([query for query in large if not query['sql'].startswith('INSERT INTO "chat_message"')]),
+            len([query for query in small if not query['sql'].startswith('INSERT INTO "chat_message"')])
+        )
+
+        thread = Thread.objects.get(pk=self.threads[1])
+        self.assertEqual(thread.last_message.text, 'imported 299')
+        self.assertEqual(thread.last_message.created.isoformat(), '2020-01-01T00:04:59+00:00')
+        unread = Message.objects.filter(thread=thread).exclude(sender=self.user1).count()
+        self.assertEqual(ThreadReadState.objects.get(thread=thread, user=self.user1).unread_count, unread)
+        self.assertEqual(ThreadReadState.objects.get(thread=thread, user=self.user3).unread_count, 150 - unread)
+
+    def test_read_states_get_batch_deltas(self):
+        self.client.force_authenticate(self.user2)
+        url = reverse('messages_list_create', kwargs={'thread_id': self.threads[0]})
+        self.client.post(url, {'text': 'live'})
+        self.client.force_authenticate(self.admin)
+        messages = self.batch(4)
+        messages[2]['is_read'] = True
+        with CaptureQueriesContext(connection) as queries:
+            created = self.client.post(self.url, {'messages': messages}, format='json')
+        self.assertEqual(created.status_code, status.HTTP_201_CREATED)
+        self.assertFalse([query for query in queries if 'COUNT(' in query['sql']])  # no rebuild
+
+        imported = Message.objects.filter(text__startswith='imported').order_by('id')
+        state = ThreadReadState.objects.get(thread_id=self.threads[0], user=self.user1)
+        # 'live' and 'imported 0' (sent by user2) unread
+        self.assertEqual((state.unread_count, state.last_read_message_id), (2, None))
+        state = ThreadReadState.objects.get(thread_id=self.threads[0], user=self.user2)
+        # 'imported 2' is read
+        self.assertEqual((state.unread_count, state.last_read_message_id), (0, imported[2].id))
+        ThreadReadState.objects.rebuild(Thread.objects.all())
+        self.assertEqual(ThreadReadState.objects.get(thread_id=self.threads[0], user=self.user2).last_read_message_id,
+                         imported[2].id)
+
+    def test_membership_and_permissions(self):
+        messages = self.batch(3)
+        messages[2]['sender'] = self.user3.id
+        response = self.client.post(self.url, {'messages': messages}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(list(response.data['messages']), [2])
+        self.assertFalse(Message.objects.exists())
+        self.client.force_authenticate(self.user1)
+        response = self.client.post(self.url, {'messages': self.batch(3)}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_import_messages_command(self):
+        lines = ''.join(json.dumps(message) + '\n' for message in self.batch(25))
+        with tempfile.NamedTemporaryFile('w', suffix='.ndjson') as source:
+            source.write(lines)
+            source.flush()
+            out = StringIO()
+            call_command('import_messages', source.name, '--batch-size', '10', stdout=out)
+        self.assertIn('Imported 25 message(s)', out.getvalue())
+        self.assertEqual(Message.objects.count(), 25)
+
+
+class ThreadParticipantPermissionTestCase(ChatAPITestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='user1', password='pass123')
+        self.user2 = User.objects.create_user(username='user2', password='pass123')
+        self.user3 = User.objects.create_user(username='user3', password='pass123')
+        self.client.force_authenticate(self.user1)
+        self.thread = self.client.post(reverse('threads_list_create'), {'participants': [self.user1.id, self.user2.id]}).data['id']
+        other = self.client.post(reverse('threads_list_create'), {'participants': [self.user1.id, self.user3.id]}).data['id']
+        self.message = self.client.post(
+            reverse('messages_list_create', kwargs={'thread_id': self.thread}), {'text': 'hello'}
+        ).data['id']
+        self.other_message = self.client.post(
+            reverse('messages_list_create', kwargs={'thread_id': other}), {'text': 'hello'}
+        ).data['id']
+        self.urls = [
+            reverse('threads_update_delete', kwargs={'pk': self.thread}),
+            reverse('messages_list_create', kwargs={'thread_id': self.thread}),
+            reverse('message_read', kwargs={'thread_id': self.thread, 'pk': self.message}),
+            reverse('thread_export', kwargs={'thread_id': self.thread}),
+            reverse('thread_messages_search', kwargs={'thread_id': self.thread}) + '?q=hello',
+        ]
+
+    def test_only_participants(self):
+        for url in self.urls:
+            self.assertEqual(self.client.get(url).status_code, status.HTTP_200_OK, url)
+        self.client.force_authenticate(self.user3)
+        for url in self.urls:
+            self.assertEqual(self.client.get(url).status_code, status.HTTP_404_NOT_FOUND, url)
+        self.assertEqual(self.client.delete(self.urls[0]).status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.client.post(self.urls[1], {'text': 'hi'}).status_code, status.HTTP_404_NOT_FOUND)
+        self.assertTrue(Thread.objects.filter(pk=self.thread).exists())
+
+    def test_message_scoped_to_thread(self):
+        url = reverse('message_read', kwargs={'thread_id': self.thread, 'pk': self.other_message})
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_membership_cached_until_participants_change(self):
+        self.client.get(self.urls[1])
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(self.urls[1], {'text': 'again'})
+        self.assertFalse([query for query in queries if 'chat_thread_participants' in query['sql']])
+
+        user4 = User.objects.create_user(username='user4', password='pass123')
+        response = self.client.put(self.urls[0], {'participants': [self.user1.id, user4.id]})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.client.force_authenticate(self.user2)
+        self.assertEqual(self.client.get(self.urls[1]).status_code, status.HTTP_404_NOT_FOUND)
+        self.client.force_authenticate(user4)
+        self.assertEqual(self.client.get(self.urls[1]).status_code, status.HTTP_200_OK)
+
+    def test_membership_lifetime_follows_cache_backend(self):
+        for alias, timeout in (('chat', 5), ('shared', 300)):
+            with self.subTest(alias=alias), override_settings(CHAT_CACHE={'CACHE': alias}):
+                cache.clear()
+                with mock.patch.object(cache.get_cache(), 'set') as cache_set:
+                    self.assertEqual(get_members(self.thread), {self.user1.id, self.user2.id})
+                self.assertEqual(cache_set.call_args.args[2], timeout)
+
+    @override_settings(CHAT_CACHE={'ENABLED': False})
+    def test_exists_without_cache(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(self.urls[1]).status_code, status.HTTP_200_OK)
+        self.assertEqual(len([query for query in queries if 'chat_thread_participants' in query['sql']]), 1)
+        self.client.force_authenticate(self.user3)
+        self.assertEqual(self.client.get(self.urls[1]).status_code, status.HTTP_404_NOT_FOUND)
+
+
+class MetricsTestCase(ChatAPITestCase):
+    def setUp(self):
+        metrics.registry.reset()
+        self.admin = User.objects.create_user(username='admin', password='pass123', is_staff=True)
+        self.user1 = User.objects.create_user(username='user1', password='pass123')
+        self.user2 = User.objects.create_user(username='user2', password='pass123')
+        self.client.force_authenticate(self.user1)
+        self.thread = self.client.post(
+            reverse('threads_list_create'), {'participants': [self.user1.id, self.user2.id]}
+        ).data['id']
+        self.url = reverse('messages_list_create', kwargs={'thread_id': self.thread})
+
+    def test_server_timing_and_prometheus_text(self):
+        response = self.client.get(self.url)  # the empty live history falls through into the archive
+        self.assertRegex(
+            response['Server-Timing'],
+            r'^db;dur=[0-9.]+;desc="4 queries", serialize;dur=[0-9.]+, render;dur=[0-9.]+, total;dur='
+        )
+
+        self.client.force_authenticate(self.admin)
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        text = response.content.decode()
+        self.assertIn('chat_request_duration_seconds_bucket{view="messages_list_create",le="+Inf"} 1\n', text)
+        self.assertIn('chat_request_queries_sum{view="messages_list_create"} 4\n', text)
+        self.assertIn('chat_requests_total{view="threads_list_create",status="201"} 1\n', text)
+        self.assertIn('chat_cache_requests_total{namespace="messages",result="miss"} 1\n', text)
+
+    def test_serialization_histogram(self):
+        for text in ('one', 'two'):
+            self.client.post(self.url, {'text': text})
+        self.client.get(self.url)
+        self.client.get(reverse('threads_update_delete', kwargs={'pk': self.thread}))
+        text = metrics.registry.render()
+        self.assertIn('# TYPE chat_request_serialize_seconds histogram\n', text)
+        for view in ('messages_list_create', 'threads_update_delete'):
+            prefix = f'chat_request_serialize_seconds_sum{{view="{view}"}} '
+            total = next(line[len(prefix):] for line in text.splitlines() if line.startswith(prefix))
+            self.assertGreater(float(total), 0, view)
+
+        serialize_time = []
+
+        def build():
+            with metrics.serializing(), metrics.serializing():
+                time.sleep(0.05)
+            serialize_time.append(metrics._current.get().serialize_time)
+            return HttpResponse()
+        metrics.MetricsMiddleware(lambda request: build())(RequestFactory().get('/'))
+        # Nested blocks are counted once
+        self.assertGreaterEqual(serialize_time[0], 0.05)
+        self.assertLess(serialize_time[0], 0.1)
+
+    def test_admins_only(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, status.HTTP_403_FORBIDDEN)
+        with override_settings(CHAT_METRICS={'ENABLED': True, 'PUBLIC': True}):
+            self.assertEqual(self.client.get(reverse('metrics')).status_code, status.HTTP_200_OK)
+
+    @override_settings(CHAT_METRICS={'ENABLED': False})
+    def test_disabled(self):
+        self.client = APIClient()  # the middleware of the old client is already loaded
+        self.client.force_authenticate(self.user1)
+        metrics.registry.reset()
+        response = self.client.get(self.url)
+        self.assertNotIn('Server-Timing', response)
+        self.assertEqual(metrics.registry.render().count('chat_request_duration_seconds_count'), 0)
+
+
+class LoadTestCommandTestCase(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        user_cache.clear()
+        revocation_cache.clear()
+        seed_chat(users=6, threads=8, messages=60)
+
+    def test_seeded_threads_keep_the_pair_invariant(self):
+        threads = list(Thread.objects.prefetch_related('participants'))
+        self.assertEqual(len({thread.pair_key for thread in threads}), 8)
+        for thread in threads:
+            self.assertEqual(thread.pair_key, Thread.make_pair_key([user.id for user in thread.participants.all()]))
+        with self.assertRaises(ValueError):
+            seed_chat(users=3, threads=4, messages=0)
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual([percentile(values, p) for p in (50, 95, 99, 100)], [50, 95, 99, 100])
+        self.assertEqual(percentile([7], 99), 7)
+
+    def test_generated_mix_and_replay(self):
+        with tempfile.TemporaryDirectory() as directory:
+            record = os.path.join(directory, 'mix.ndjson')
+            out = StringIO()
+            call_command('loadtest', '--use-current-database', '--requests', '40', '--concurrency', '2',
+                         '--record', record, '--json', stdout=out)
+            rows = {row['endpoint']: row for row in json.loads(out.getvalue())}
+            self.assertEqual(rows['total']['requests'], 40)
+            self.assertIn('threads_list_create', rows)
+
+            out = StringIO()
+            call_command('loadtest', '--use-current-database', '--replay', record, '--concurrency', '1', stdout=out)
+            self.assertIn('40 requests in', out.getvalue())
+
+
+class SQLiteProfileTestCase(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        user_cache.clear()
+        revocation_cache.clear()
+        self.user1 = User.objects.create_user(username='user1', password='pass123')
+        self.user2 = User.objects.create_user(username='user2', password='pass123')
+        self.thread = Thread.objects.create(pair_key=Thread.make_pair_key([self.user1.id, self.user2.id]))
+        self.thread.participants.add(self.user1, self.user2)
+        ThreadReadState.objects.sync_participants(self.thread)
+
+    def test_pragmas(self):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode')
+            self.assertEqual(cursor.fetchone()[0], 'wal')
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 1)  # NORMAL
+
+    @override_settings(CHAT_THROTTLE={'ENABLED': False})  # one user floods the writer on purpose
+    def test_concurrent_posts_without_lock_errors(self):
+        url = reverse('messages_list_create', kwargs={'thread_id': self.thread.id})
+        statuses, errors = [], []
+
+        def client_thread(user, method, count):
+            client = APIClient()
+            client.force_authenticate(user)
+            try:
+                for i in range(count):
+                    response = client.post(url, {'text': f'message {i}'}) if method == 'post' else client.get(url)
+                    statuses.append((method, response.status_code))
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                connections.close_all()
+
+        workers = [threading.Thread(target=client_thread, args=(self.user1, 'post', 10)) for _ in range(8)]
+        workers += [threading.Thread(target=client_thread, args=(self.user2, 'get', 20)) for _ in range(2)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(statuses.count(('post', status.HTTP_201_CREATED)), 80)
+        self.assertEqual(statuses.count(('get', status.HTTP_200_OK)), 40)
+        self.assertEqual(Message.objects.count(), 80)
+        outbox.get_worker().join()
+        self.assertFalse(OutboxEvent.objects.exists())
+        self.assertEqual(ThreadReadState.objects.get(thread=self.thread, user=self.user2).unread_count, 80)
+        self.thread.refresh_from_db()
+        self.assertEqual(self.thread.last_message_id, Message.objects.order_by('id').last().id)
+
+
+class SendThrottleConcurrencyTestCase(TransactionTestCase):
+    """
+    Concurrent sends to one Thread on the default store and on the database cache
+    """
+    rates = {'user': {'RATE': '1/d', 'BURST': 100}, 'thread': {'RATE': '1/d', 'BURST': 40}}
+
+    def setUp(self):
+        cache.clear()
+        user_cache.clear()
+        revocation_cache.clear()
+        caches['shared'].clear()
+        throttling.reset()
+        self.user1 = User.objects.create_user(username='user1', password='pass123')
+        self.user2 = User.objects.create_user(username='user2', password='pass123')
+        self.thread = Thread.objects.create(pair_key=Thread.make_pair_key([self.user1.id, self.user2.id]))
+        self.thread.participants.add(self.user1, self.user2)
+        ThreadReadState.objects.sync_participants(self.thread)
+
+    def post_concurrently(self):
+        url = reverse('messages_list_create', kwargs={'thread_id': self.thread.id})
+        statuses, errors = [], []
+
+        def client_thread():
+            client = APIClient()
+            client.force_authenticate(self.user1)
+            try:
+                for i in range(8):
+                    statuses.append(client.post(url, {'text': f'message {i}'}).status_code)
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                connections.close_all()
+
+        workers = [threading.Thread(target=client_thread) for _ in range(8)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(set(statuses)), [status.HTTP_201_CREATED, status.HTTP_429_TOO_MANY_REQUESTS])
+        self.assertEqual(statuses.count(status.HTTP_201_CREATED), 40)
+        self.assertEqual(Message.objects.count(), 40)
+        outbox.get_worker().join()
+
+    def test_default_store(self):
+        with override_settings(CHAT_THROTTLE={'RATES': self.rates}):
+            self.assertIsInstance(throttling.get_store(), throttling.LocalBucketStore)
+            self.post_concurrently()
+
+    def test_database_cache_store(self):
+        with override_settings(CHAT_THROTTLE={'RATES': self.rates, 'STORE': 'chat.throttling.CacheBucketStore',
+                                              'OPTIONS': {'cache': 'shared', 'lock_wait': 5}}):
+            self.post_concurrently()
+
+
+class ThreadQueryTestCase(ChatAPITestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='user1', password='pass123')
+        self.peers = [User.objects.create_user(username=f'peer{index}', password='pass123') for index in range(10)]
+        for peer in self.peers:
+            thread = Thread.objects.create(pair_key=Thread.make_pair_key([self.user1.id, peer.id]))
+            thread.participants.set([self.user1, peer])
+            Message.objects.create(thread=thread, sender=peer, text='hello')
+        self.client.force_authenticate(self.user1)
+
+    def test_constant_queries_whatever_the_page_size(self):
+        for limit in (1, 10):
+            for expand in ('', 'participants'):
+                cache.clear()
+                with self.assertNumQueries(4):  # ETag aggregate, count, page, participants of the page
+                    response = self.client.get(reverse('threads_list_create'), {'limit': limit, 'expand': expand})
+                self.assertEqual(len(response.data['results']), limit)
+                cache.clear()
+                user_cache.clear()
+                with self.assertNumQueries(3):  # User, Threads, participants
+                    self.client.get(reverse('user_threads', kwargs={'pk': self.user1.id}), {'expand': expand})
+        for threads in (Thread.objects.all()[:1], Thread.objects.all()):
+            with self.assertNumQueries(2):
+                ThreadSerializer(threads.for_api(self.user1), many=True).data
+
+    def test_expand_participants(self):
+        thread = Thread.objects.get(participants=self.peers[0])
+        expanded = [{'id': self.user1.id, 'username': 'user1'}, {'id': self.peers[0].id, 'username': 'peer0'}]
+        response = self.client.get(reverse('threads_update_delete', kwargs={'pk': thread.id}))
+        self.assertEqual(response.data['participants'], [self.user1.id, self.peers[0].id])
+        response = self.client.get(reverse('threads_update_delete', kwargs={'pk': thread.id}), {'expand': 'participants'})
+        self.assertEqual(response.data['participants'], expanded)
+        response = self.client.get(reverse('threads_list_create'), {'limit': 20, 'expand': 'participants'})
+        listed = next(item for item in response.data['results'] if item['id'] == thread.id)
+        self.assertEqual(listed['participants'], expanded)
+        response = self.client.get(reverse('threads_list_create'), {'limit': 20})
+        listed = next(item for item in response.data['results'] if item['id'] == thread.id)
+        self.assertEqual(listed['participants'], [self.user1.id, self.peers[0].id])
+
+
+flaky_calls = []
+
+
+def flaky_handler(text):
+    flaky_calls.append(text)
+    if len(flaky_calls) == 1:
+        raise ValueError('first attempt fails')
+
+
+@override_settings(CHAT_OUTBOX={'MODE': 'async', 'HANDLERS': {'test.flaky': 'chat.tests.flaky_handler'}})
+class OutboxTestCase(ChatAPITestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='user1', password='pass123')
+        self.user2 = User.objects.create_user(username='user2', password='pass123')
+        self.thread = Thread.objects.create(pair_key=Thread.make_pair_key([self.user1.id, self.user2.id]))
+        self.thread.participants.add(self.user1, self.user2)
+        ThreadReadState.objects.sync_participants(self.thread)
+        self.client.force_authenticate(self.user1)
+
+    def unread_count(self):
+        return ThreadReadState.objects.get(thread=self.thread, user=self.user2).unread_count
+
+    def test_side_effects_handled_once(self):
+        # Test transactions never commit: the event waits in the outbox for the poll
+        response = self.client.post(reverse('messages_list_create', kwargs={'thread_id': self.thread.id}),
+                                    {'text': 'hello'})
+        event = OutboxEvent.objects.get()
+        self.assertEqual((event.kind, event.payload), ('message.created', {'message_id': response.data['id']}))
+        self.assertEqual(self.unread_count(), 0)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(outbox.process_pending(), (1, 0))
+        self.assertTrue(outbox.process(event.id))  # delivered twice
+        self.assertFalse(OutboxEvent.objects.exists())
+        self.assertEqual(self.unread_count(), 1)
+        self.thread.refresh_from_db()
+        self.assertEqual(self.thread.last_message_id, response.data['id'])
+
+    def test_reads_and_late_events_in_any_order(self):
+        older, newer = [Message.objects.create(sender=self.user1, thread=self.thread, text=text)
+                        for text in ('older', 'newer')]
+        tasks.message_created(newer.id)  # the event of `older` waits in another worker
+        Message.objects.mark_read(self.thread.id, self.user2.id, older.id)
+        tasks.message_created(older.id)
+        self.assertEqual(self.unread_count(), 1)
+        self.client.force_authenticate(self.user1)
+        self.client.delete(reverse('message_read', kwargs={'thread_id': self.thread.id, 'pk': newer.id}))
+        self.assertEqual(self.unread_count(), 0)
+
+    def test_failed_event_retried(self):
+        flaky_calls.clear()
+        event = outbox.enqueue('test.flaky', text='hello')
+        with self.assertLogs('chat.outbox', 'ERROR'):
+            self.assertEqual(outbox.process_pending(), (0, 1))
+        event.refresh_from_db()
+        self.assertEqual(event.attempts, 1)
+        self.assertIn('first attempt fails', event.last_error)
+        self.assertFalse(outbox.pending().exists())  # backing off
+
+        OutboxEvent.objects.update(available_at=timezone.now())
+        out = StringIO()
+        call_command('process_outbox', stdout=out)
+        self.assertIn('Handled 1 event(s)', out.getvalue())
+        self.assertFalse(OutboxEvent.objects.exists())
+        self.assertEqual(flaky_calls, ['hello', 'hello'])
+
+
+class MessageArchiveTestCase(ChatAPITestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='user1', password='pass123')
+        self.user2 = User.objects.create_user(username='user2', password='pass123')
+        self.thread = Thread.objects.create(pair_key=Thread.make_pair_key([self.user1.id, self.user2.id]))
+        self.thread.participants.add(self.user1, self.user2)
+        now = timezone.now()
+
+        def message(days, is_read=True):
+            return Message.objects.create(sender=self.user1, thread=self.thread, text=f'{days} days ago',
+                                          created=now - timedelta(days=days), is_read=is_read)
+        self.archived = [message(days) for days in (200, 199, 198, 197)]
+        # Older than the cutoff but not older than the oldest unread Message: stays live
+        self.live = [message(190, is_read=False), message(185), message(1), message(0)]
+        self.thread.refresh_last_message()
+        ThreadReadState.objects.rebuild([self.thread])
+        self.url = reverse('messages_list_create', kwargs={'thread_id': self.thread.id})
+        self.client.force_authenticate(self.user2)
+
+    def test_history_falls_through_into_archive(self):
+        out = StringIO()
+        call_command('archive_messages', '--days', '180', stdout=out)
+        self.assertIn('Archived 4 message(s)', out.getvalue())
+        self.assertEqual(list(Message.objects.order_by('id')), self.live)
+        self.assertEqual(ArchivedMessage.objects.count(), 4)
+
+        seen, url = [], self.url + '?page_size=3'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            seen += [message['id'] for message in response.data['results']]
+            url = response.data['next']
+        self.assertEqual(seen, [message.id for message in reversed(self.archived + self.live)])
+        self.assertEqual(response.data['results'][-1], MessageSerializer(self.archived[0]).data)
+
+        response = self.client.get(reverse('thread_export', kwargs={'thread_id': self.thread.id}))
+        exported = [json.loads(line)['id'] for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual(exported, [message.id for message in self.archived + self.live])
+
+        ThreadReadState.objects.rebuild([self.thread])
+        state = ThreadReadState.objects.get(thread=self.thread, user=self.user2)
+        self.assertEqual((state.unread_count, state.last_read_message_id), (1, self.live[-1].id))
+
+    def test_thread_only_in_archive(self):
+        Message.objects.filter(pk__in=[message.pk for message in self.live[:3]]).update(is_read=True)
+        Thread.objects.filter(pk=self.thread.pk).update(last_message=None)
+        self.assertEqual(archive.archive_messages(timezone.now() + timedelta(days=1), batch_size=3), 8)
+        response = self.client.get(self.url)
+        self.assertEqual(len(response.data['results']), 3)
+        self.assertIn('archive=1', response.data['next'])
+
+
+class SendThrottleTestCase(ChatAPITestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='user1', password='pass123')
+        self.user2 = User.objects.create_user(username='user2', password='pass123')
+        self.thread = Thread.objects.create(pair_key=Thread.make_pair_key([self.user1.id, self.user2.id]))
+        self.thread.participants.add(self.user1, self.user2)
+        self.url = reverse('messages_list_create', kwargs={'thread_id': self.thread.id})
+
+    def post(self, user):
+        self.client.force_authenticate(user)
+        return self.client.post(self.url, {'text': 'hello'})
+
+    @override_settings(CHAT_THROTTLE={'RATES': {'user': {'RATE': '1/m', 'BURST': 2},
+                                                'thread': {'RATE': '1/m', 'BURST': 3}}})
+    def test_429_with_retry_after(self):
+        self.assertEqual([self.post(self.user1).status_code for _ in range(2)], [201, 201])
+        response = self.post(self.user1)
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(response['Retry-After'], '60')
+        # user2 has a bucket of their own, the Thread bucket runs out after its third Message
+        self.assertEqual(self.post(self.user2).status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.post(self.user2).status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.client.force_authenticate(self.user1)
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_200_OK)  # reads are not throttled
+
+    @override_settings(CHAT_THROTTLE={'MODE': 'queue', 'MAX_DELAY': 3,
+                                      'RATES': {'user': {'RATE': '1/s', 'BURST': 1}}})
+    def test_queue_mode_waits_for_a_token(self):
+        with mock.patch('chat.throttling.time.sleep') as sleep:
+            statuses = [self.post(self.user1).status_code for _ in range(5)]
+        self.assertEqual(statuses, [201, 201, 201, 201, 429])
+        for call, expected in zip(sleep.call_args_list, (1, 2, 3)):
+            self.assertAlmostEqual(call.args[0], expected, delta=0.5)
+
+    @override_settings(CHAT_THROTTLE={'MODE': 'queue', 'MAX_DELAY': 3,
+                                      'MAX_WAITING': 1, 'RATES': {'user': {'RATE': '1/s', 'BURST': 1}}})
+    def test_queue_mode_caps_waiting_requests(self):
+        self.assertEqual(self.post(self.user1).status_code, status.HTTP_201_CREATED)
+        waiting = throttling.get_waiting()
+        waiting.acquire()  # another request of this process is already waiting
+        try:
+            with mock.patch('chat.throttling.time.sleep') as sleep:
+                self.assertEqual(self.post(self.user1).status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+            sleep.assert_not_called()
+        finally:
+            waiting.release()
+        with mock.patch('chat.throttling.time.sleep') as sleep:
+            self.assertEqual(self.post(self.user1).status_code, status.HTTP_201_CREATED)
+        sleep.assert_called_once()
+
+    def test_process_local_cache_is_refused(self):
+        with self.assertRaises(ImproperlyConfigured):
+            throttling.CacheBucketStore(cache='default')
+        local_cache_store = {'STORE': 'chat.throttling.CacheBucketStore', 'OPTIONS': {'cache': 'default'}}
+        with override_settings(CHAT_THROTTLE=local_cache_store):
+            self.assertEqual([error.id for error in check_throttle_store(None)], ['chat.E001'])
+        with override_settings(DEBUG=True, CHAT_THROTTLE=local_cache_store):
+            self.assertEqual(check_throttle_store(None), [])
+        self.assertEqual(check_throttle_store(None), [])
+
+    def test_fair_under_concurrent_load(self):
+        with override_settings(DEBUG=True):  # a LocMemCache is enough for the threads of one process
+            cache_store = throttling.CacheBucketStore(lock_wait=5)
+        for store in (throttling.LocalBucketStore(), cache_store):
+            granted = {'flood': 0, 'polite': 0}
+            lock = threading.Lock()
+
+            def client(key, count):
+                for _ in range(count):
+                    if store.take(key, rate=1 / 86400, capacity=20)[0]:
+                        with lock:
+                            granted[key] += 1
+
+            clients = [threading.Thread(target=client, args=('flood', 50)) for _ in range(8)]
+            clients.append(threading.Thread(target=client, args=('polite', 10)))
+            for thread in clients:
+                thread.start()
+            for thread in clients:
+                thread.join()
+            self.assertEqual(granted, {'flood': 20, 'polite': 10})
+
+    def test_bucket_is_never_updated_without_its_lock(self):
+        store = throttling.CacheBucketStore(cache='shared', lock_wait=0.01)
+        self.assertEqual(store.take('bucket', rate=1, capacity=2), (True, 0.0))
+        caches['shared'].add('bucket:lock', 1)  # held by another process
+        self.assertEqual(store.take('bucket', rate=1, capacity=2), (False, 0.01))
+        caches['shared'].delete('bucket:lock')
+        self.assertTrue(store.take('bucket', rate=1 / 86400, capacity=2)[0])
+        self.assertFalse(store.take('bucket', rate=1 / 86400, capacity=2)[0])
+
+
+class CompactResponseTestCase(ChatAPITestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='user1', password='pass123')
+        self.user2 = User.objects.create_user(username='user2', password='pass123')
+        self.thread = Thread.objects.create(pair_key=Thread.make_pair_key([self.user1.id, self.user2.id]))
+        self.thread.participants.add(self.user1, self.user2)
+        for i in range(30):
+            Message.objects.create(sender=self.user1, thread=self.thread, text=f'message number {i}')
+        self.url = reverse('messages_list_create', kwargs={'thread_id': self.thread.id})
+        self.client.force_authenticate(self.user2)
+
+    def test_columnar_json(self):
+        plain = self.client.get(self.url, {'page_size': 20}).json()
+        response = self.client.get(self.url, {'page_size': 20}, HTTP_ACCEPT=ColumnarJSONRenderer.media_type)
+        self.assertEqual(response['Content-Type'], ColumnarJSONRenderer.media_type)
+        data = response.json()
+        self.assertEqual(data['next'], plain['next'])
+        columns = data['results']['columns']
+        self.assertEqual([dict(zip(columns, row)) for row in data['results']['rows']], plain['results'])
+        thread = self.client.get(reverse('threads_update_delete', kwargs={'pk': self.thread.id}),
+                                 HTTP_ACCEPT=ColumnarJSONRenderer.media_type).json()
+        self.assertEqual(thread['id'], self.thread.id)  # not a list: plain JSON
+
+    @skipUnless(renderers.msgpack, 'requires the msgpack package')
+    def test_msgpack(self):
+        plain = self.client.get(self.url).json()
+        response = self.client.get(self.url, HTTP_ACCEPT=MessagePackRenderer.media_type)
+        self.assertEqual(renderers.msgpack.unpackb(response.content), plain)
+
+    def test_negotiated_compression(self):
+        plain = self.client.get(self.url, {'page_size': 30})
+        self.assertNotIn('Content-Encoding', plain)
+        response = self.client.get(self.url, {'page_size': 30}, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertLess(len(response.content), len(plain.content))
+        self.assertEqual(gzip.decompress(response.content), plain.content)
+        self.assertEqual(response['ETag'], 'W/' + plain['ETag'])
+
+        refused = self.client.get(self.url, {'page_size': 30}, HTTP_ACCEPT_ENCODING='gzip;q=0, identity')
+        self.assertNotIn('Content-Encoding', refused)
+        small = self.client.get(self.url, {'page_size': 1}, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertNotIn('Content-Encoding', small)
+
+        export = self.client.get(reverse('thread_export', kwargs={'thread_id': self.thread.id}),
+                                 HTTP_ACCEPT_ENCODING='br, gzip')
+        self.assertEqual(export['Content-Encoding'], 'gzip')  # streamed: gzip even when brotli is installed
+        self.assertEqual(len(gzip.decompress(b''.join(export.streaming_content)).splitlines()), 30)
+
+    def test_async_stream_compression(self):
+        async def chunks():
+            yield b'a' * 2000
+            yield b'b' * 2000
+
+        middleware = compression.CompressionMiddleware(lambda request: StreamingHttpResponse(chunks()))
+        response = middleware(RequestFactory().get('/', HTTP_ACCEPT_ENCODING='gzip'))
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+
+        async def content():
+            return b''.join([chunk async for chunk in response.streaming_content])
+        self.assertEqual(gzip.decompress(async_to_sync(content)()), b'a' * 2000 + b'b' * 2000)
+
+    def test_accepted_encodings(self):
+        self.assertEqual(compression.accepted_encodings('gzip;q=0.5, br , deflate;q=0, x;q=bad'), {'gzip', 'br'})
+
+
+@override_settings(CHAT_REPLICAS={'REPLICAS': ['replica1', 'replica2'], 'STICKY_SECONDS': 10, 'CACHE': 'default'})
+class ReplicaRouterTestCase(SimpleTestCase):
+    def setUp(self):
+        caches['default'].clear()
+        self.router = ReplicaRouter()
+        self.middleware = ReplicaRoutingMiddleware(self.route)
+        self.factory = RequestFactory()
+        self.user1 = User(id=1)
+        self.user2 = User(id=2)
 
+    def route(self, request):
+        response = HttpResponse()
+        response.read_from = self.router.db_for_read(Message)
+        response.cache_read_from = self.router.db_for_read(caches['shared'].cache_model_class)
+        with use_primary():
+            response.cached_from = self.router.db_for_read(Message)
+        return response
 
+    def request(self, method, user=None):
+        request = getattr(self.factory, method)('/api/threads/')
+        if user is not None:
+            request.user = user
+        return self.middleware(request)
 
+    def test_reads_of_safe_requests_go_to_replicas(self):
+        response = self.request('get')
+        self.assertIn(response.read_from, ('replica1', 'replica2'))
+        self.assertIsNone(response.cached_from)
+        self.assertEqual(response.cache_read_from, 'default')  # fresh revocations and pins
+        self.assertIsNone(self.request('post').read_from)
+        self.assertIsNone(self.router.db_for_read(Message))
+        self.assertEqual(self.router.db_for_write(Message), 'default')
+        self.assertFalse(self.router.allow_migrate('replica1', 'chat'))
+        self.assertTrue(self.router.allow_migrate('default', 'chat'))
 
+    def test_read_your_writes(self):
+        self.assertIn(self.request('get', self.user1).read_from, ('replica1', 'replica2'))
+        self.request('post', self.user1)
+        self.assertIsNone(self.request('get', self.user1).read_from)
+        self.assertIn(self.request('get', self.user2).read_from, ('replica1', 'replica2'))
+        caches['default'].clear()  # the sticky window is over
+        self.assertIn(self.request('get', self.user1).read_from, ('replica1', 'replica2'))
 
+    def test_sticky_cache_is_shared(self):
+        # The project settings, not the LocMemCache override of this TestCase
+        self.assertNotIsInstance(caches[project_settings.CHAT_REPLICAS['CACHE']], LocMemCache)
 
+    @override_settings(CHAT_REPLICAS={'REPLICAS': []})
+    def test_disabled_without_replicas(self):
+        with self.assertRaises(MiddlewareNotUsed):
+            ReplicaRoutingMiddleware(self.route)
@@ -0,0 +1,242 @@
+"""
+Token bucket throttling of Message sends
+
+Every user and every Thread has a bucket of BURST tokens refilled at RATE; a
+send takes a token from the bucket of its user, then from the one of its
+Thread. Without a token the request gets 429 with Retry-After, or in MODE
+'queue' it reserves a token up to MAX_DELAY seconds ahead and waits for it, so
+short bursts are smoothed out instead of rejected. A client refused by its own
+bucket never reaches the shared ones, so a flooding client cannot starve the
+others of the SQLite writer
+
+A queued request holds its worker thread while it waits, so at most
+MAX_WAITING requests of a process wait at a time; the others are answered as
+in 'reject' mode. Under ASGI the sync views share one thread: use 'reject' there
+
+Buckets live in a store: LocalBucketStore (this process, the default) or
+CacheBucketStore (a cache shared by the worker processes, meant for Redis);
+outside DEBUG CacheBucketStore refuses a LocMemCache, whose buckets would be
+per process (see chat.checks). A bucket is only updated under its lock: a
+request that cannot get it in time is refused like one without a token. On
+the database cache the updates are SQLite writes, they take the write lock of
+chat.sqlite so they queue with the other writes instead of colliding with them
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.db import DatabaseCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.db import router
+from django.utils.module_loading import import_string
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.throttling import BaseThrottle
+
+from chat.sqlite import serialized_write
+
+DEFAULTS = {
+    'ENABLED': True,
+    'STORE': 'chat.throttling.LocalBucketStore',
+    'OPTIONS': {},
+    # RATE is '<tokens>/<s|m|h|d>', BURST the size of the bucket; None disables a scope
+    'RATES': {
+        'user': {'RATE': '60/m', 'BURST': 20},
+        'thread': {'RATE': '120/m', 'BURST': 40},
+    },
+    # 'reject' answers 429 right away, 'queue' waits up to MAX_DELAY seconds for a token
+    'MODE': 'reject',
+    'MAX_DELAY': 2,
+    # Requests of a process waiting for a token at the same time in MODE 'queue'
+    'MAX_WAITING': 4,
+}
+
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+_store = None
+_waiting = None
+
+
+def get_config():
+    config = {**DEFAULTS, **getattr(settings, 'CHAT_THROTTLE', {})}
+    config['RATES'] = {**DEFAULTS['RATES'], **config['RATES']}
+    return config
+
+
+def parse_rate(rate):
+    """
+    '<tokens>/<period>' as tokens per second, the period is one of s, m, h, d (or a word starting with it)
+    """
+    tokens, period = rate.split('/')
+    return int(tokens) / PERIODS[period[0]]
+
+
+def take_token(state, now, rate, capacity, max_delay):
+    """
+    Refill the bucket state (tokens, timestamp) up to now and take a token,
+    going up to max_delay seconds into debt
+    Returns (new state, granted, seconds): seconds to wait for the token when
+    granted, until the request would be granted otherwise
+    """
+    tokens, updated = state if state is not None else (capacity, now)
+    tokens = min(capacity, tokens + (now - updated) * rate) - 1
+    if tokens >= -max_delay * rate:
+        return (tokens, now), True, max(0.0, -tokens / rate)
+    return (tokens + 1, now), False, (-tokens / rate) - max_delay
+
+
+class BaseBucketStore:
+    def take(self, key, rate, capacity, max_delay=0):
+        """
+        Take a token from the bucket `key`, returns (granted, seconds) as take_token()
+        """
+        raise NotImplementedError
+
+
+class LocalBucketStore(BaseBucketStore):
+    """
+    Buckets in a dict of this process, behind a lock
+    """
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def take(self, key, rate, capacity, max_delay=0):
+        now = time.time()
+        with self.lock:
+            if len(self.buckets) >= self.max_keys:
+                self.buckets.clear()  # Forgetting a bucket refills it, which only lets a few requests more through
+            self.buckets[key], granted, seconds = take_token(self.buckets.get(key), now, rate, capacity, max_delay)
+        return granted, seconds
+
+
+class CacheBucketStore(BaseBucketStore):
+    """
+    Buckets in a Django cache shared by the worker processes, updated under a
+    lock made with cache.add() (atomic on Redis, Memcached and the database cache)
+    """
+    def __init__(self, cache='default', lock_timeout=1, lock_wait=0.5):
+        self.cache = caches[cache]
+        if isinstance(self.cache, LocMemCache) and not settings.DEBUG:
+            raise ImproperlyConfigured(
+                f'CacheBucketStore needs a cache shared by the worker processes, {cache!r} is a LocMemCache '
+                '(LocalBucketStore throttles a single process)'
+            )
+        self.lock_timeout = lock_timeout
+        self.lock_wait = lock_wait
+
+    def take(self, key, rate, capacity, max_delay=0):
+        if not isinstance(self.cache, DatabaseCache):
+            return self.take_locked(key, rate, capacity, max_delay)
+        with serialized_write(using=router.db_for_write(self.cache.cache_model_class)):
+            return self.take_locked(key, rate, capacity, max_delay)
+
+    def take_locked(self, key, rate, capacity, max_delay):
+        lock_key = f'{key}:lock'
+        deadline = time.monotonic() + self.lock_wait
+        while not self.cache.add(lock_key, 1, self.lock_timeout):
+            if time.monotonic() >= deadline:
+                # Refused rather than updated without the lock, which could grant more than the bucket holds
+                return False, self.lock_wait
+            time.sleep(0.001)
+        try:
+            state, granted, seconds = take_token(self.cache.get(key), time.time(), rate, capacity, max_delay)
+            # Once full again the bucket is the same as a missing one
+            self.cache.set(key, state, int(capacity / rate + max_delay) + 1)
+        finally:
+            self.cache.delete(lock_key)
+        return granted, seconds
+
+
+def get_store():
+    global _store
+    if _store is None:
+        config = get_config()
+        _store = import_string(config['STORE'])(**config['OPTIONS'])
+    return _store
+
+
+def get_waiting():
+    """
+    Semaphore of the MAX_WAITING requests of this process allowed to wait for a token
+    """
+    global _waiting
+    if _waiting is None:
+        _waiting = threading.BoundedSemaphore(get_config()['MAX_WAITING'])
+    return _waiting
+
+
+def reset():
+    """
+    Drop the store (with the buckets of a LocalBucketStore) and the waiting slots
+    """
+    global _store, _waiting
+    _store = _waiting = None
+
+
+def _reset_store(setting, **kwargs):
+    if setting in ('CHAT_THROTTLE', 'DEBUG'):
+        reset()
+
+
+setting_changed.connect(_reset_store)
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """
+    Throttle of the unsafe requests with a bucket per scope (rates in
+    CHAT_THROTTLE['RATES']), taken in order: a request refused by a bucket
+    leaves the next ones alone, so put the per-client scope first
+    """
+    scopes = ()
+
+    def get_key(self, request, view, scope):
+        raise NotImplementedError
+
+    def allow_request(self, request, view):
+        config = get_config()
+        if not config['ENABLED'] or request.method in SAFE_METHODS:
+            return True
+        # Without a free waiting slot the request is answered right away
+        waiting = get_waiting() if config['MODE'] == 'queue' else None
+        if waiting is not None and not waiting.acquire(blocking=False):
+            waiting = None
+        try:
+            max_delay = config['MAX_DELAY'] if waiting is not None else 0
+            delay = 0
+            for scope in self.scopes:
+                bucket = config['RATES'].get(scope)
+                key = self.get_key(request, view, scope)
+                if bucket is None or key is None:
+                    continue
+                granted, seconds = get_store().take(
+                    f'chat:throttle:{scope}:{key}', parse_rate(bucket['RATE']), bucket['BURST'], max_delay
+                )
+                if not granted:
+                    self.retry_after = seconds
+                    return False
+                delay = max(delay, seconds)
+            if delay:
+                time.sleep(delay)
+            return True
+        finally:
+            if waiting is not None:
+                waiting.release()
+
+    def wait(self):
+        return self.retry_after
+
+
+class MessageSendThrottle(TokenBucketThrottle):
+    """
+    Buckets per user, then per Thread (`thread_id` of the URL)
+    """
+    scopes = ('user', 'thread')
+
+    def get_key(self, request, view, scope):
+        if scope == 'user':
+            return request.user.id if request.user and request.user.is_authenticated else None
+        return view.kwargs.get('thread_id')
@@ -3,16 +3,28 @@ from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
 
 from chat.views import (ThreadListCreateView, ThreadUpdateDeleteView, MessageListCreateView,
                         MessageReadView, UserThreadListView, GetUnreadMessageView,
-                        UserRegisterView)
+                        UserRegisterView, UnreadSummaryView, MessagesSinceView,
+                        ThreadReadView, CacheStatsView, MessageSearchView,
+                        ThreadExportView, MessageBatchView, MetricsView)
 
 urlpatterns = [
     path('users/register/', UserRegisterView.as_view(), name='user_register'),  # User Register
     path('users/<int:pk>/messages/', GetUnreadMessageView.as_view(), name='messages_unread'),  # Unread Messages by User Id
+    path('users/<int:pk>/unread-summary/', UnreadSummaryView.as_view(), name='unread_summary'),  # Unread Counters by User Id
+    path('users/<int:pk>/messages/since/<int:message_id>/', MessagesSinceView.as_view(), name='user_messages_since'),  # Wait for new Messages of all your Threads
+    path('messages/batch/', MessageBatchView.as_view(), name='messages_batch'),  # Bulk Create Messages (admin only)
     path('threads/', ThreadListCreateView.as_view(), name='threads_list_create'),  # Get or Create Threads
+    path('threads/search/', MessageSearchView.as_view(), name='messages_search'),  # Search Messages of your Threads
     path('threads/user/<int:pk>/', UserThreadListView.as_view(), name='user_threads'),  # Get Thread by User Id
     path('threads/<int:pk>/', ThreadUpdateDeleteView.as_view(), name='threads_update_delete'),  # Update or Delete Thread
+    path('threads/<int:thread_id>/read/', ThreadReadView.as_view(), name='thread_read'),  # Read all Thread Messages (up to message_id) if you Participant
+    path('threads/<int:thread_id>/search/', MessageSearchView.as_view(), name='thread_messages_search'),  # Search Thread Messages if you Participant
+    path('threads/<int:thread_id>/export/', ThreadExportView.as_view(), name='thread_export'),  # Stream the whole Thread history if you Participant
     path('threads/<int:thread_id>/messages/', MessageListCreateView.as_view(), name='messages_list_create'),  # Get Thread Messages or Create if you Participant
     path('threads/<int:thread_id>/messages/<int:pk>/', MessageReadView.as_view(), name='message_read'),  # Read Message if you Participant(not sender)
+    path('threads/<int:thread_id>/messages/since/<int:message_id>/', MessagesSinceView.as_view(), name='messages_since'),  # Wait for new Messages of Thread if you Participant
+    path('cache/stats/', CacheStatsView.as_view(), name='cache_stats'),  # Cache hit/miss counters (admin only)
+    path('metrics/', MetricsView.as_view(), name='metrics'),  # Request metrics in Prometheus text format (admin only)
     path('token/', TokenObtainPairView.as_view(), name='token_obtain_pair'),  # JWT-Auth
     path('token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),  # Refresh JWT token
     path('token/verify/', TokenVerifyView.as_view(), name='token_verify'),  # Verify JWT token
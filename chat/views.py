@@ -1,28 +1,63 @@
+import asyncio
+
+from asgiref.sync import sync_to_async
 from rest_framework import generics, status
-from rest_framework.permissions import IsAuthenticated, AllowAny
+from rest_framework.exceptions import AuthenticationFailed, PermissionDenied
+from rest_framework.permissions import IsAuthenticated, AllowAny, IsAdminUser
 from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.handlers.asgi import ASGIRequest
+from django.db.models import Count, Max, Q, Subquery
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.views import View
 
-from chat.models import Thread, Message
-from chat.serializers import ThreadSerializer, MessageSerializer, UserRegisterSerializer
+from chat import cache, export, metrics, search
+from chat.authentication import StatelessJWTAuthentication, user_cache
+from chat.broker import get_broker, publish_to_thread
+from chat.mixins import ConditionalGetMixin, RowListMixin, ThreadQueryMixin
+from chat.models import Thread, Message, ArchivedMessage, ThreadReadState
+from chat.pagination import MessageCursorPagination
+from chat.permissions import IsThreadParticipant, is_participant
+from chat.read_serializers import MessageRowSerializer, ThreadRowSerializer
+from chat.routers import mark_sticky, use_primary
+from chat.serializers import (ThreadSerializer, MessageSerializer, UserRegisterSerializer, ThreadReadSerializer,
+                              MessageSearchSerializer, MessageSearchResultSerializer, ThreadExportSerializer,
+                              MessageBatchSerializer)
+from chat.sqlite import serialized_write
+from chat.throttling import MessageSendThrottle
 
 
-class ThreadListCreateView(generics.ListCreateAPIView):
+class ThreadListCreateView(ConditionalGetMixin, ThreadQueryMixin, RowListMixin, generics.ListCreateAPIView):
     """
     GET the list of Threads for requested user;
     CREATE Thread
     """
     queryset = Thread.objects.all()
     serializer_class = ThreadSerializer
+    row_serializer_class = ThreadRowSerializer
     permission_classes = (IsAuthenticated, )
 
     def get_queryset(self):
-        user = self.request.user
-        return Thread.objects.filter(participants=user)
+        return self.get_thread_queryset(Thread.objects.filter(participants=self.request.user.id))
+
+    def get_state(self):
+        return Thread.objects.filter(participants=self.request.user.id).aggregate(
+            count=Count('id', distinct=True), updated=Max('updated'), last_message=Max('last_message_id'),
+            read_at=Max('read_states__updated')
+        )
+
+    def list(self, request, *args, **kwargs):
+        data = cache.get_or_build(
+            'threads', [('user', request.user.id)], [request.user.id, request.get_full_path()],
+            self.list_rows
+        )
+        return Response(data)
 
 
-class ThreadUpdateDeleteView(generics.RetrieveUpdateDestroyAPIView):
+class ThreadUpdateDeleteView(ThreadQueryMixin, generics.RetrieveUpdateDestroyAPIView):
     """
     GET Thread by id
     UPDATE Thread by id
@@ -30,50 +65,108 @@ class ThreadUpdateDeleteView(generics.RetrieveUpdateDestroyAPIView):
     """
     queryset = Thread.objects.all()
     serializer_class = ThreadSerializer
-    permission_classes = (IsAuthenticated, )
+    permission_classes = (IsAuthenticated, IsThreadParticipant)
+    thread_lookup_url_kwarg = 'pk'
 
+    def get_queryset(self):
+        return self.get_thread_queryset()
 
-class UserThreadListView(generics.ListAPIView):
+    def perform_destroy(self, instance):
+        cache.invalidate_thread(instance.id)
+        instance.delete()
+
+
+class UserThreadListView(ThreadQueryMixin, RowListMixin, generics.ListAPIView):
     """
     GET Threads by User id
     """
     serializer_class = ThreadSerializer
+    row_serializer_class = ThreadRowSerializer
     permission_classes = (IsAuthenticated,)
 
     def get_queryset(self, **kwargs):
         pk = kwargs.get('pk', None)
 
         if pk is not None:
-            instance = User.objects.get(pk=pk)
+            instance = user_cache.get(pk)
             if instance:
-                return Thread.objects.filter(participants=instance)
+                return self.get_thread_queryset(Thread.objects.filter(participants=instance))
             else:
                 return Thread.objects.none()
         else:
             return Thread.objects.none()
 
     def list(self, request, *args, **kwargs):
-        queryset = self.get_queryset(**kwargs)
-        if queryset.exists():
-            serializer = self.get_serializer(queryset, many=True)
-            return Response(serializer.data)
+        data = cache.get_or_build(
+            'user_threads', [('user', kwargs.get('pk')), ('user', request.user.id)],
+            [request.user.id, request.get_full_path()],
+            lambda: self.build_list(**kwargs)
+        )
+        return Response(data)
+
+    def build_list(self, **kwargs):
+        threads = self.serialize_rows(self.get_queryset(**kwargs))
+        if threads:
+            return threads
         else:
-            return Response({"error": "Invalid pk or object does not exist"})
+            return {"error": "Invalid pk or object does not exist"}
 
 
-class MessageListCreateView(generics.ListCreateAPIView):
+class MessageListCreateView(ConditionalGetMixin, RowListMixin, generics.ListCreateAPIView):
     """
     GET Messages of thread by id(thread)
     CREATE Message of thread by id(thread) IF you are participant of this Thread
     """
     queryset = Message.objects.all()
     serializer_class = MessageSerializer
-    permission_classes = (IsAuthenticated,)
+    row_serializer_class = MessageRowSerializer
+    permission_classes = (IsAuthenticated, IsThreadParticipant)
+    throttle_classes = (MessageSendThrottle,)
+    pagination_class = MessageCursorPagination
 
     def get_queryset(self):
         thread_id = self.kwargs['thread_id']
         return Message.objects.filter(thread_id=thread_id)
 
+    def get_archive_queryset(self):
+        columns = self.get_row_serializer().columns
+        return ArchivedMessage.objects.filter(thread_id=self.kwargs['thread_id']).values(*columns)
+
+    def get_state(self):
+        thread_id = self.kwargs['thread_id']
+        read_at = ThreadReadState.objects.filter(thread_id=thread_id).order_by('-updated').values('updated')[:1]
+        return Message.objects.filter(thread_id=thread_id).aggregate(
+            count=Count('id'), newest_id=Max('id'), newest=Max('created'), read=Count('id', filter=Q(is_read=True)),
+            read_at=Max(Subquery(read_at))
+        )
+
+    def list(self, request, *args, **kwargs):
+        data = cache.get_or_build(
+            'messages', [('thread', kwargs['thread_id'])], [request.get_full_path()],
+            self.list_rows
+        )
+        return Response(data)
+
+
+class MessageBatchView(generics.CreateAPIView):
+    """
+    CREATE Messages in bulk in any Threads (admins only, for imports and replays)
+    {
+        "messages": [{"thread": 1, "sender": 2, "text": "text", "created": "..." (optional)}, ...]
+    }
+    """
+    serializer_class = MessageBatchSerializer
+    permission_classes = (IsAdminUser,)
+
+    def post(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        messages = serializer.save()
+        return Response({
+            'created': len(messages),
+            'threads': sorted({message.thread_id for message in messages})
+        }, status=status.HTTP_201_CREATED)
+
 
 class MessageReadView(generics.RetrieveDestroyAPIView):
     """
@@ -82,45 +175,269 @@ class MessageReadView(generics.RetrieveDestroyAPIView):
     """
     queryset = Message.objects.all()
     serializer_class = MessageSerializer
-    permission_classes = (IsAuthenticated,)
+    permission_classes = (IsAuthenticated, IsThreadParticipant)
+
+    def get_queryset(self):
+        return Message.objects.filter(thread_id=self.kwargs['thread_id'])
 
     def get(self, request, *args, **kwargs):
         message = self.get_object()
-        if message.sender != request.user:
+        if message.sender_id != request.user.id and not message.is_read:
             message.is_read = True
-            message.save()
+            # Only the request flipping the row counts it: `message` may be a stale copy (replica, concurrent read)
+            with serialized_write():
+                count = Message.objects.filter(pk=message.pk, is_read=False).update(is_read=True)
+                if count:
+                    ThreadReadState.objects.mark_read(message.thread_id, request.user.id, message.id)
+                    cache.invalidate_thread(message.thread_id)
+            mark_sticky(request.user.id)
+            if count:
+                publish_to_thread(message.thread_id, {
+                    'type': 'message.read', 'thread': message.thread_id, 'message': message.id,
+                    'reader': request.user.id
+                })
         serialize_obj = self.get_serializer(message)
         return Response(serialize_obj.data)
 
+    def perform_destroy(self, instance):
+        thread = instance.thread
+        was_last = thread.last_message_id == instance.id
+        instance.delete()
+        ThreadReadState.objects.message_deleted(instance)
+        cache.invalidate_thread(thread.id)
+        if was_last:
+            thread.refresh_last_message()
+
 
-class GetUnreadMessageView(generics.ListAPIView):
+class ThreadReadView(generics.GenericAPIView):
+    """
+    READ all Messages of Thread by id(thread) up to `message_id` (or all of them)
+    if you are participant of this Thread; the ones you sent are skipped
+    {
+        "message_id": 123 (optional)
+    }
+    """
+    serializer_class = ThreadReadSerializer
+    permission_classes = (IsAuthenticated, IsThreadParticipant)
+
+    def post(self, request, *args, **kwargs):
+        thread_id = kwargs['thread_id']
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        count, watermark = Message.objects.mark_read(
+            thread_id, request.user.id, serializer.validated_data.get('message_id')
+        )
+        if count:
+            cache.invalidate_thread(thread_id)
+            publish_to_thread(thread_id, {
+                'type': 'thread.read', 'thread': thread_id, 'reader': request.user.id, 'last_read_message': watermark
+            })
+        return Response({'thread': thread_id, 'marked_read': count, 'last_read_message_id': watermark})
+
+
+class MessageSearchView(generics.GenericAPIView):
+    """
+    GET Messages matching `q` from all your Threads, or from the Thread by
+    id(thread) if you are participant of this Thread; best match first,
+    `next` holds the cursor of the following page
+    """
+    serializer_class = MessageSearchResultSerializer
+    permission_classes = (IsAuthenticated, IsThreadParticipant)
+
+    def get(self, request, *args, **kwargs):
+        thread_id = kwargs.get('thread_id')
+        params = MessageSearchSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        page_size = params.validated_data.get('page_size', search.get_config()['PAGE_SIZE'])
+
+        messages = search.get_backend().search(
+            params.validated_data['q'], request.user.id, thread_id,
+            after=params.validated_data.get('cursor'), limit=page_size + 1
+        )
+        next_url = None
+        if len(messages) > page_size:
+            messages = messages[:page_size]
+            next_url = replace_query_param(
+                request.build_absolute_uri(), 'cursor', search.encode_cursor(messages[-1])
+            )
+        return Response({'next': next_url, 'results': self.get_serializer(messages, many=True).data})
+
+
+class ThreadExportView(generics.GenericAPIView):
+    """
+    GET the whole history of Thread by id(thread) as a stream if you are
+    participant of this Thread, oldest Message first
+    ?format=ndjson (default) or csv, ?after=<message id> resumes an export
+    """
+    serializer_class = ThreadExportSerializer
+    permission_classes = (IsAuthenticated, IsThreadParticipant)
+
+    def perform_content_negotiation(self, request, force=False):
+        # `format` selects the export format, errors are always rendered as JSON
+        return super(ThreadExportView, self).perform_content_negotiation(request, force=True)
+
+    def get(self, request, *args, **kwargs):
+        thread_id = kwargs['thread_id']
+        params = self.get_serializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        format = params.validated_data['format']
+
+        messages = export.iter_messages([thread_id], params.validated_data.get('after'))
+        chunks = export.stream(messages, format)
+        if isinstance(request._request, ASGIRequest):
+            chunks = export.aiter_chunks(chunks)
+        response = StreamingHttpResponse(chunks, content_type=export.FORMATS[format])
+        response['Content-Disposition'] = f'attachment; filename="thread-{thread_id}.{format}"'
+        return response
+
+
+class GetUnreadMessageView(RowListMixin, generics.ListAPIView):
     """
     GET Unread Messages from all Threads by id(User)
     """
     serializer_class = MessageSerializer
+    row_serializer_class = MessageRowSerializer
     permission_classes = (IsAuthenticated,)
 
     def get_queryset(self, **kwargs):
         pk = kwargs.get('pk', None)
 
         if pk is not None:
-            instance = User.objects.get(pk=pk)
+            instance = user_cache.get(pk)
             if instance:
                 return Message.objects.filter(thread__participants=instance, is_read=False).exclude(sender=instance)
             else:
-                Message.objects.none()
+                return Message.objects.none()
         else:
             return Message.objects.none()
 
     def list(self, request, *args, **kwargs):
-        queryset = self.get_queryset(**kwargs)
-        if queryset.exists():
-            serializer = self.get_serializer(queryset, many=True)
-            return Response(serializer.data)
+        messages = self.serialize_rows(self.get_queryset(**kwargs))
+        if messages:
+            return Response(messages)
         else:
             return Response({"error": "Invalid pk or object does not exist"})
 
 
+class UnreadSummaryView(generics.GenericAPIView):
+    """
+    GET unread totals from all Threads by id(User) using the read states only,
+    for your own id(User)
+    """
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request, *args, **kwargs):
+        if kwargs['pk'] != request.user.id:
+            raise PermissionDenied('You can only read your own unread counters.')
+        states = ThreadReadState.objects.filter(user_id=kwargs['pk'], unread_count__gt=0).order_by('thread_id')
+        threads = [
+            {'thread': thread_id, 'unread_count': unread_count}
+            for thread_id, unread_count in states.values_list('thread_id', 'unread_count')
+        ]
+        return Response({
+            'user': kwargs['pk'],
+            'total_unread': sum(thread['unread_count'] for thread in threads),
+            'threads': threads
+        })
+
+
+class MessagesSinceView(View):
+    """
+    GET Messages newer than id(message) of Thread by id(thread), or of all Threads
+    of the requesting User by id(User); waits until there is at least one of them
+    or `timeout` seconds have passed (long polling, async so parked requests
+    don't hold a worker thread)
+    """
+    authentication = StatelessJWTAuthentication()
+
+    async def get(self, request, message_id, thread_id=None, pk=None):
+        user = await self.authenticate(request)
+        if user is None:
+            return JsonResponse({'detail': 'Authentication credentials were not provided.'},
+                                status=status.HTTP_401_UNAUTHORIZED)
+        if pk is not None and pk != user.id:
+            return JsonResponse({'detail': 'You can only wait for your own messages.'},
+                                status=status.HTTP_403_FORBIDDEN)
+        if thread_id is not None:
+            if not await sync_to_async(is_participant)(thread_id, user.id):
+                return JsonResponse({'detail': 'Not found.'}, status=status.HTTP_404_NOT_FOUND)
+
+        config = getattr(settings, 'CHAT_LONG_POLL', {})
+        try:
+            timeout = float(request.GET.get('timeout', config.get('TIMEOUT', 25)))
+        except ValueError:
+            return JsonResponse({'timeout': ['A number is required.']}, status=status.HTTP_400_BAD_REQUEST)
+        timeout = max(0.0, min(timeout, config.get('MAX_TIMEOUT', 60)))
+        limit = config.get('LIMIT', 100)
+
+        # Subscribe before the first look at the database so nothing created in between is missed
+        broker = get_broker()
+        subscription = broker.subscribe(user.id)
+        try:
+            messages = await self.get_messages(user, thread_id, message_id, limit)
+            deadline = asyncio.get_running_loop().time() + timeout
+            while not messages:
+                remaining = deadline - asyncio.get_running_loop().time()
+                if remaining <= 0:
+                    break
+                try:
+                    event = await asyncio.wait_for(subscription.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                if event['type'] == 'message.created' and thread_id in (None, event['thread']):
+                    messages = await self.get_messages(user, thread_id, message_id, limit)
+        finally:
+            broker.unsubscribe(subscription)
+
+        return JsonResponse({
+            'results': messages,
+            'last_message_id': messages[-1]['id'] if messages else message_id
+        })
+
+    @sync_to_async
+    def authenticate(self, request):
+        try:
+            authenticated = self.authentication.authenticate(request)
+        except AuthenticationFailed:
+            return None
+        return authenticated[0] if authenticated else None
+
+    @sync_to_async
+    def get_messages(self, user, thread_id, message_id, limit):
+        messages = Message.objects.filter(id__gt=message_id)
+        if thread_id is not None:
+            messages = messages.filter(thread_id=thread_id)
+        else:
+            messages = messages.filter(thread__participants=user.id)
+        # A replica may not have the Message the wake-up event is about yet
+        with use_primary():
+            return MessageSerializer(messages.order_by('id')[:limit], many=True).data
+
+
+class CacheStatsView(generics.GenericAPIView):
+    """
+    GET hit/miss counters of the chat cache of this process (admins only)
+    """
+    permission_classes = (IsAdminUser,)
+
+    def get(self, request, *args, **kwargs):
+        return Response(cache.stats.snapshot())
+
+
+class MetricsView(generics.GenericAPIView):
+    """
+    GET request metrics of this process in the Prometheus text format
+    (admins only unless CHAT_METRICS['PUBLIC'])
+    """
+    def get_permissions(self):
+        if metrics.get_config()['PUBLIC']:
+            return [AllowAny()]
+        return [IsAdminUser()]
+
+    def get(self, request, *args, **kwargs):
+        return HttpResponse(metrics.registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 class UserRegisterView(generics.CreateAPIView):
     """
     CREATE USER